@@ -0,0 +1,39 @@
+"""Writes benchmark results with the machine they were measured on."""
+import json
+import platform
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def write_report(
+    name: str,
+    parameters: dict[str, Any],
+    results: list[dict[str, Any]],
+    output: Optional[Path] = None,
+) -> Path:
+    """
+    Writes the results as JSON and returns the path written.
+
+    Without an `output`, the report is written to the results directory,
+    named after the benchmark and the time.
+    """
+    created = datetime.now(timezone.utc)
+    if output is None:
+        output = RESULTS_DIR / f"{name}-{created.strftime('%Y%m%dT%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "created": created.isoformat(),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "parameters": parameters,
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {output}")
+    return output
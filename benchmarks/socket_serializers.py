@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the socket.io packet serializers on our payloads.
+
+Every payload is encoded and decoded with the default packet format,
+which sends binary fields as separate attachment frames, and with the
+msgpack format, which sends the whole packet as one binary frame.
+Timings are the median of `--repeat` runs of `--number` round trips.
+
+    python -m benchmarks.socket_serializers
+    python -m benchmarks.socket_serializers --scale 0.5 --output small.json
+"""
+import argparse
+import random
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+from socketio.msgpack_packet import MsgPackPacket
+from socketio.packet import EVENT, Packet
+
+from benchmarks.report import write_report
+
+Encoded = Union[str, bytes, list[Union[str, bytes]]]
+
+
+def payloads(scale: float) -> dict[str, list[Any]]:
+    """Returns event data shaped like our traffic, by name."""
+    rng = random.Random(0)
+
+    def blob(kb: float) -> bytes:
+        # media is already compressed, so random bytes are representative
+        return rng.randbytes(int(kb * 1024 * scale))
+
+    def resource(kb: float, mimetype: str) -> dict[str, Any]:
+        return {"raw": blob(kb), "mimetype": mimetype}
+
+    audio = resource(48, "audio/webm")
+    return {
+        "detect": ["detect", resource(256, "video/webm")],
+        "query": ["query", audio, resource(256, "video/webm"), "audio"],
+        "query_with_images": [
+            "query_with_images",
+            audio,
+            [resource(120, "image/jpeg") for _ in range(4)],
+        ],
+        "clip-chunk": [
+            "clip-chunk",
+            {"request_id": "2f1c9a7e", "seq": 3, "raw": blob(64)},
+        ],
+        "audio-chunk": ["audio-chunk", blob(16), 7],
+        "recognition": [
+            "recognition",
+            [
+                {"name": f"concept-{i}", "value": rng.random(), "id": f"ai_{i:08d}"}
+                for i in range(20)
+            ],
+        ],
+        "detection": [
+            "detection",
+            "There is a person ahead of you, slightly to the left, and a car"
+            " on your right.",
+        ],
+    }
+
+
+def encode_default(data: list[Any]) -> Encoded:
+    return Packet(EVENT, data, namespace="/").encode()
+
+
+def decode_default(encoded: Encoded) -> Any:
+    if isinstance(encoded, list):
+        packet = Packet(encoded_packet=encoded[0])
+        for attachment in encoded[1:]:
+            packet.add_attachment(attachment)
+    else:
+        packet = Packet(encoded_packet=encoded)
+    return packet.data
+
+
+def encode_msgpack(data: list[Any]) -> Encoded:
+    return MsgPackPacket(EVENT, data, namespace="/").encode()
+
+
+def decode_msgpack(encoded: Encoded) -> Any:
+    return MsgPackPacket(encoded_packet=encoded).data
+
+
+SERIALIZERS: dict[str, tuple[Callable[[list[Any]], Encoded], Callable]] = {
+    "default": (encode_default, decode_default),
+    "msgpack": (encode_msgpack, decode_msgpack),
+}
+
+
+def wire_size(encoded: Encoded) -> tuple[int, int]:
+    """Returns the bytes sent and the number of frames they are sent in."""
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    size = sum(len(part.encode() if isinstance(part, str) else part) for part in parts)
+    return size, len(parts)
+
+
+def time_per_call(run: Callable[[], Any], number: int, repeat: int) -> float:
+    """Returns the median time of one call, in microseconds."""
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        runs.append((time.perf_counter() - started) / number)
+    return statistics.median(runs) * 1e6
+
+
+def benchmark(scale: float, number: int, repeat: int) -> list[dict[str, Any]]:
+    results = []
+    for name, data in payloads(scale).items():
+        for serializer, (encode, decode) in SERIALIZERS.items():
+            encoded = encode(data)
+            if decode(encoded) != data:
+                raise AssertionError(f"{serializer} changed the {name} payload")
+            size, frames = wire_size(encoded)
+            results.append(
+                {
+                    "payload": name,
+                    "serializer": serializer,
+                    "size": size,
+                    "frames": frames,
+                    "encode_us": time_per_call(lambda: encode(data), number, repeat),
+                    "decode_us": time_per_call(lambda: decode(encoded), number, repeat),
+                }
+            )
+    return results
+
+
+def print_results(results: list[dict[str, Any]]) -> None:
+    columns = ["size", "frames", "encode_us", "decode_us"]
+    print(
+        " ".join(
+            [
+                "payload".ljust(20),
+                "serializer".ljust(10),
+                *(c.rjust(12) for c in columns),
+            ]
+        )
+    )
+    for result in results:
+        cells = [f"{result[column]:.1f}".rjust(12) for column in columns]
+        print(
+            " ".join(
+                [result["payload"].ljust(20), result["serializer"].ljust(10), *cells]
+            )
+        )
+
+
+def main() -> Optional[int]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplies every binary size"
+    )
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    results = benchmark(args.scale, args.number, args.repeat)
+    print_results(results)
+
+    parameters = {"scale": args.scale, "number": args.number, "repeat": args.repeat}
+    write_report("socket_serializers", parameters, results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
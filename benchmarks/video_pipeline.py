@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the video frame-selection pipeline.
+
+Synthetic clips are generated with ffmpeg for every container and
+resolution. Each clip is put through the decode, grayscale, sharpness
+and encode stages of `AsyncVideoProcessor` separately, then through
+`process_video` end to end. Timings are the median of `--repeat` runs;
+the peak memory of each stage is measured in a separate run, as tracing
+slows everything down.
+
+Results are written as JSON. Pass a previous result file as
+`--baseline` to print the change of every metric.
+
+    python -m benchmarks.video_pipeline --output before.json
+    python -m benchmarks.video_pipeline --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+import cv2
+
+from benchmarks.report import write_report
+from ilens.server.clarifai.image_processor import AsyncVideoProcessor
+from ilens.server.clarifai.video_decoders import get_ffmpeg_exe
+
+CONTAINERS = {
+    "webm": ["-c:v", "libvpx", "-b:v", "2M"],
+    "mp4": ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"],
+    "ogg": ["-c:v", "libtheora", "-q:v", "7"],
+}
+
+RESOLUTIONS = {
+    "480p": (854, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+}
+
+MIMETYPES = {
+    "webm": "video/webm",
+    "mp4": "video/mp4",
+    "ogg": "video/ogg",
+}
+
+
+def generate_clip(
+    container: str, size: tuple[int, int], duration: float, fps: int
+) -> bytes:
+    """Renders a moving test pattern with a short blurred stretch."""
+    width, height = size
+    source = f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}"
+    # blur the middle third so frame selection has something to reject
+    blur = f"gblur=sigma=8:enable='between(t,{duration / 3},{2 * duration / 3})'"
+    with tempfile.NamedTemporaryFile(suffix=f".{container}") as output:
+        subprocess.run(
+            [
+                get_ffmpeg_exe(),
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-y",
+                "-f",
+                "lavfi",
+                "-i",
+                source,
+                "-vf",
+                blur,
+                *CONTAINERS[container],
+                output.name,
+            ],
+            check=True,
+        )
+        return Path(output.name).read_bytes()
+
+
+def median_of(repeat: int, run: Callable[[], dict[str, float]]) -> dict[str, float]:
+    runs = [run() for _ in range(repeat)]
+    return {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+
+
+def peak_memory(run: Callable[[], Any]) -> float:
+    """Returns the peak memory allocated by `run`, in MB."""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+STAGES = ["decode", "grayscale", "sharpness", "encode"]
+
+
+class Stages:
+    """
+    Adds up the time spent in each stage and, while tracemalloc is
+    tracing, the peak memory each stage allocated on top of what was
+    allocated when it began.
+    """
+
+    def __init__(self) -> None:
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.peaks = dict.fromkeys(STAGES, 0.0)
+        self.frames = 0
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - started
+            if tracing:
+                peak = (tracemalloc.get_traced_memory()[1] - allocated) / 1024 / 1024
+                self.peaks[stage] = max(self.peaks[stage], peak)
+
+
+def run_stages(
+    processor: AsyncVideoProcessor, clip: bytes, extension: str, decoder: str
+) -> Stages:
+    """Runs every stage on every frame, measuring each stage separately."""
+    stages = Stages()
+    frames = processor.iter_frames(clip, extension, decoder)
+    best_index, best_score, best_frame = -1, -1.0, None
+    while True:
+        with stages.measure("decode"):
+            decoded = next(frames, None)
+        if decoded is None:
+            break
+        index, frame = decoded
+        with stages.measure("grayscale"):
+            if frame.ndim == 3:
+                gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            else:
+                gray = frame
+        with stages.measure("sharpness"):
+            score = processor.sharpness(gray)
+            if score > best_score:
+                best_index, best_score, best_frame = index, score, frame.copy()
+        stages.frames += 1
+    if best_frame is None:
+        raise ValueError(f"No frames decoded from the {extension} clip")
+    if best_frame.ndim == 2:
+        # the ffmpeg decoder scores small grayscale frames; the selected
+        # frame is decoded again in colour, as `process_video` does
+        with stages.measure("decode"):
+            best_frame = processor.decoders.ffmpeg.read_frame(
+                clip, extension, best_index, processor.analysis_fps
+            )
+    with stages.measure("encode"):
+        processor.convert_result_image_to_bytes(best_frame)
+    return stages
+
+
+def stage_timings(
+    processor: AsyncVideoProcessor, clip: bytes, extension: str, decoder: str
+) -> dict[str, float]:
+    stages = run_stages(processor, clip, extension, decoder)
+    decode = stages.seconds["decode"]
+    return {
+        **stages.seconds,
+        "frames": stages.frames,
+        "decode_fps": stages.frames / decode if decode else 0.0,
+    }
+
+
+def stage_peaks(
+    processor: AsyncVideoProcessor, clip: bytes, extension: str, decoder: str
+) -> dict[str, float]:
+    """
+    Returns the peak memory of each stage, in MB.
+
+    Only memory allocated by Python is traced, not that of the ffmpeg
+    processes.
+    """
+    tracemalloc.start()
+    try:
+        stages = run_stages(processor, clip, extension, decoder)
+    finally:
+        tracemalloc.stop()
+    return {f"{stage}_peak_mb": peak for stage, peak in stages.peaks.items()}
+
+
+def run_end_to_end(
+    processor: AsyncVideoProcessor, clip: bytes, mimetype: str
+) -> dict[str, float]:
+    started = time.perf_counter()
+    frame = asyncio.run(processor.process_video(clip, mimetype))
+    selected = time.perf_counter()
+    processor.convert_result_image_to_bytes(frame)
+    finished = time.perf_counter()
+    return {
+        "process_video": selected - started,
+        "end_to_end": finished - started,
+    }
+
+
+def benchmark(
+    containers: list[str],
+    resolutions: list[str],
+    decoders: list[str],
+    duration: float,
+    fps: int,
+    repeat: int,
+) -> list[dict[str, Any]]:
+    results = []
+    for container in containers:
+        for resolution in resolutions:
+            clip = generate_clip(container, RESOLUTIONS[resolution], duration, fps)
+            measured = set()
+            for decoder in decoders:
+                processor = AsyncVideoProcessor(decoder=decoder)
+                extension = f".{container}"
+                chosen = processor.decoders.choose(extension, decoder)
+                if chosen in measured:
+                    # the requested decoder fell back to one already measured
+                    continue
+                measured.add(chosen)
+                print(f"{container} {resolution} ({len(clip) / 1024:.0f}KB) {chosen}")
+
+                def stages():
+                    return stage_timings(processor, clip, extension, chosen)
+
+                def end_to_end():
+                    return run_end_to_end(processor, clip, MIMETYPES[container])
+
+                result: dict[str, Any] = {
+                    "container": container,
+                    "resolution": resolution,
+                    "decoder": chosen,
+                    "clip_size": len(clip),
+                    **median_of(repeat, stages),
+                    **median_of(repeat, end_to_end),
+                    **stage_peaks(processor, clip, extension, chosen),
+                    "end_to_end_peak_mb": peak_memory(end_to_end),
+                }
+                results.append(result)
+    return results
+
+
+def key_of(result: dict[str, Any]) -> tuple[str, str, str]:
+    return result["container"], result["resolution"], result["decoder"]
+
+
+METRICS = [
+    "decode",
+    "grayscale",
+    "sharpness",
+    "encode",
+    "decode_fps",
+    "process_video",
+    "end_to_end",
+    *(f"{stage}_peak_mb" for stage in STAGES),
+    "end_to_end_peak_mb",
+]
+
+
+def print_results(
+    results: list[dict[str, Any]], baseline: Optional[list[dict[str, Any]]]
+) -> None:
+    previous = {key_of(result): result for result in baseline or []}
+    print()
+    print(" ".join(["clip".ljust(24), *(metric.rjust(18) for metric in METRICS)]))
+    for result in results:
+        name = " ".join(key_of(result))
+        cells = []
+        for metric in METRICS:
+            cell = f"{result[metric]:.3f}"
+            before = previous.get(key_of(result), {}).get(metric)
+            if before:
+                cell += f" ({(result[metric] - before) / before:+.0%})"
+            cells.append(cell.rjust(18))
+        print(" ".join([name.ljust(24), *cells]))
+
+
+def main() -> Optional[int]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--container", action="append", choices=CONTAINERS, dest="containers"
+    )
+    parser.add_argument(
+        "--resolution", action="append", choices=RESOLUTIONS, dest="resolutions"
+    )
+    parser.add_argument(
+        "--decoder",
+        action="append",
+        choices=["auto", "pyav", "ffmpeg", "imageio"],
+        dest="decoders",
+    )
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    args = parser.parse_args()
+
+    results = benchmark(
+        args.containers or list(CONTAINERS),
+        args.resolutions or list(RESOLUTIONS),
+        args.decoders or ["auto"],
+        args.duration,
+        args.fps,
+        args.repeat,
+    )
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+    print_results(results, baseline)
+
+    parameters = {"duration": args.duration, "fps": args.fps, "repeat": args.repeat}
+    write_report("video_pipeline", parameters, results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
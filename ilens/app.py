@@ -1,9 +1,11 @@
+import json as jsonlib
+import math
 from pathlib import Path
 from sanic import Sanic
-from sanic.response import text
-from ilens.server.settings import SERVER_ID
+from sanic.response import json, text
+from ilens.server.settings import BATCH_MAX_FILES, SERVER_ID
 from sanic.response import file_stream
-from sanic.exceptions import NotFound
+from sanic.exceptions import BadRequest, NotFound, PayloadTooLarge
 from aiofiles import os
 
 BASE_DIR = Path(__file__).parent
@@ -32,6 +34,63 @@ async def get_resource(request, filename: str):
         raise NotFound("File not found")
 
 
+@app.get("/load")
+async def get_load(request):
+    """
+    Reports the node's load.
+
+    Responds 503 while the node turns new events away, so the load
+    balancer can steer new connections elsewhere.
+    """
+    from ilens.server.consumers import load_monitor
+
+    report = load_monitor.report()
+    return json(report, status=503 if report["overloaded"] else 200)
+
+
+@app.post("/batch/<event>")
+async def post_batch(request, event: str):
+    """
+    Runs a batch of images or clips through detection or recognition.
+
+    The files are sent as `multipart/form-data`, each part with the
+    mimetype of the file. Results are streamed back as NDJSON, one line
+    per file as soon as the request its frame went in finishes, each with
+    the `index` of the file among the parts and either a `result` or an
+    `error`. Responds 429 over the rate limit and 503 while the node is
+    over capacity.
+    """
+    from ilens.server.batch import BATCH_EVENTS, stream_batch
+    from ilens.server.consumers import load_monitor, rate_limiter, resource
+
+    if event not in BATCH_EVENTS:
+        raise NotFound(f"Unknown batch event {event}")
+    files = [file for parts in request.files.values() for file in parts]
+    if not files:
+        raise BadRequest("The batch contains no files")
+    if len(files) > BATCH_MAX_FILES:
+        raise PayloadTooLarge(f"A batch may contain {BATCH_MAX_FILES} files")
+
+    address = rate_limiter.address(request.ip, request.headers.get("x-forwarded-for"))
+    # like socket clients, a request with no known address is not limited by
+    # address rather than sharing one bucket with every other such request
+    limited = None
+    if address:
+        limited = await rate_limiter.check_address(address, "batch")
+    busy = load_monitor.check("batch")
+    for rejection, status in ((limited, 429), (busy, 503)):
+        if rejection is not None:
+            retry_after = str(math.ceil(rejection["retry_after"]))
+            return json(rejection, status=status, headers={"Retry-After": retry_after})
+
+    items = [resource(raw=file.body, mimetype=file.type) for file in files]
+    response = await request.respond(content_type="application/x-ndjson")
+    async for line in stream_batch(event, items):
+        line["name"] = files[line["index"]].name
+        await response.send(jsonlib.dumps(line) + "\n")
+    await response.eof()
+
+
 def create_app():
     from ilens.server.socket import server
 
@@ -0,0 +1,177 @@
+import asyncio
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import Any, Awaitable, Callable, Iterator, Optional
+
+from ilens.server.logger import CustomLogger
+from ilens.server.scheduler import PriorityLimiter
+
+admission_logger = CustomLogger("Admission").get_logger()
+
+
+@dataclass
+class LoadMonitor:
+    """
+    Decides whether the node can take on more work.
+
+    Load is measured three ways: the number of events being handled,
+    the number of jobs waiting for a worker thread or a Clarifai slot,
+    and how late the event loop runs its callbacks. Each is compared
+    with its limit; the node is over capacity when any of them reaches
+    it. Events of priority 0 are admitted until the limits are exceeded
+    by `critical_headroom`, so detection keeps working after queries
+    are turned away.
+    """
+
+    max_in_flight: int
+    """The number of events handled at once. 0 disables the limit."""
+    max_waiting: int
+    """The number of jobs waiting for a slot. 0 disables the limit."""
+    max_loop_lag: float
+    """The event loop lag in seconds. 0 disables the limit."""
+    retry_after: float
+    """The retry hint in seconds when the node is just at capacity."""
+    critical_headroom: float
+    """How far priority 0 events may exceed the limits."""
+    limiters: list[PriorityLimiter] = field(default_factory=list)
+    """The limiters whose waiting jobs count towards the load."""
+    priorities: dict[str, int] = field(default_factory=dict)
+    """The priority of each kind of event."""
+    on_busy: Optional[Callable[[str, dict[str, Any]], Awaitable[Any]]] = None
+    """Called with the client and the `busy` payload of a rejected event."""
+    lag_interval: float = 0.1
+    """How often the event loop lag is sampled, in seconds."""
+    in_flight: int = field(default=0, init=False)
+    loop_lag: float = field(default=0.0, init=False)
+    rejected: int = field(default=0, init=False)
+    _watcher: Optional["asyncio.Task[None]"] = field(
+        default=None, init=False, repr=False
+    )
+
+    async def _watch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - started - self.lag_interval)
+            # rise at once, settle gradually
+            self.loop_lag = max(lag, self.loop_lag / 2)
+
+    def start(self) -> None:
+        """Starts sampling the event loop lag, if it has not started."""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._watch_loop())
+
+    @property
+    def waiting(self) -> int:
+        return sum(limiter.waiting for limiter in self.limiters)
+
+    def pressure(self) -> tuple[float, str]:
+        """
+        Returns the highest load relative to its limit, and what it is.
+
+        1.0 means the node is exactly at capacity.
+        """
+        loads = [(0.0, "none")]
+        if self.max_in_flight:
+            loads.append((self.in_flight / self.max_in_flight, "in-flight"))
+        if self.max_waiting:
+            loads.append((self.waiting / self.max_waiting, "queue"))
+        if self.max_loop_lag:
+            loads.append((self.loop_lag / self.max_loop_lag, "loop-lag"))
+        return max(loads, key=lambda load: load[0])
+
+    def check(self, name: str) -> Optional[dict[str, Any]]:
+        """Returns the `busy` payload if an event must be rejected."""
+        pressure, reason = self.pressure()
+        limit = 1.0
+        if self.priorities.get(name, 0) == 0:
+            limit = self.critical_headroom
+        if pressure < limit:
+            return None
+        return {
+            "event": name,
+            "reason": reason,
+            "retry_after": round(self.retry_after * pressure, 1),
+        }
+
+    async def turn_away(self, sid: str, name: str, **details: Any) -> bool:
+        """
+        Rejects an event if the node is over capacity.
+
+        The `busy` payload, with `details` added, is passed to `on_busy`.
+        Returns whether the event was rejected.
+        """
+        self.start()
+        busy = self.check(name)
+        if busy is None:
+            return False
+        self.rejected += 1
+        admission_logger.info(
+            f"Rejected {name} from {sid}: {busy['reason']}"
+            f" (retry after {busy['retry_after']}s)"
+        )
+        if self.on_busy is not None:
+            await self.on_busy(sid, {**busy, **details})
+        return True
+
+    def admit(self, name: str):
+        """
+        Decorates an event handler to reject it when over capacity.
+
+        Rejected events are passed to `on_busy` instead of the handler;
+        admitted events count as in flight until the handler returns.
+        """
+
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(sid, *args, **kwargs):
+                if await self.turn_away(sid, name):
+                    return None
+                with self.handling():
+                    return await handler(sid, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def handling(self) -> Iterator[None]:
+        """Counts work as in flight for the duration of the block."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def report(self) -> dict[str, Any]:
+        """Describes the node's load, for the load balancer and operators."""
+        self.start()
+        pressure, reason = self.pressure()
+        return {
+            "overloaded": pressure >= 1.0,
+            "pressure": round(pressure, 3),
+            "reason": reason,
+            "retry_after": round(self.retry_after * max(pressure, 1.0), 1),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "loop_lag": round(self.loop_lag, 4),
+            "rejected": self.rejected,
+            "limiters": {
+                limiter.name: {
+                    "slots": limiter.slots,
+                    "in_use": limiter.in_use,
+                    "waiting": limiter.waiting,
+                    "delay": {
+                        priority: {
+                            "granted": stats.granted,
+                            "mean": round(stats.mean_delay, 4),
+                            "max": round(stats.max_delay, 4),
+                        }
+                        for priority, stats in sorted(limiter.stats.items())
+                    },
+                }
+                for limiter in self.limiters
+            },
+        }
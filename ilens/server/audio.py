@@ -0,0 +1,326 @@
+import io
+import subprocess
+import tempfile
+import wave
+from dataclasses import dataclass, field
+from typing import Literal, Optional
+
+import numpy as np
+
+from ilens.server.clarifai.video_decoders import (
+    SEEKABLE_CONTAINERS,
+    SNIFF_SIZE,
+    get_ffmpeg_exe,
+    sniff_container,
+)
+from ilens.server.logger import CustomLogger
+from ilens.server.utils import getboolenv, getenv, getfloatenv, getintenv
+
+audio_logger = CustomLogger("AudioProcessor").get_logger()
+
+# the event sent back for each reason audio is rejected
+Verdict = Literal["ok", "no-audio", "short-audio", "long-audio"]
+
+# the codecs speech can be sent to the transcriber in, with their mimetype
+# and ffmpeg output arguments. `none` sends the recording as it was received
+AUDIO_CODECS = {
+    "none": ("", []),
+    "wav": ("audio/wav", []),
+    "flac": ("audio/flac", ["-c:a", "flac", "-compression_level", "5", "-f", "flac"]),
+    "opus": ("audio/ogg", ["-c:a", "libopus", "-application", "voip", "-f", "ogg"]),
+}
+
+# the formats query responses can be delivered in, with their file
+# extension, mimetype and ffmpeg output arguments. `wav` is what the
+# workflow returns
+RESPONSE_FORMATS = {
+    "wav": ("wav", "audio/wav", []),
+    "opus": ("ogg", "audio/ogg", ["-c:a", "libopus", "-f", "ogg"]),
+    "aac": ("aac", "audio/aac", ["-c:a", "aac", "-f", "adts"]),
+    "mp3": ("mp3", "audio/mpeg", ["-c:a", "libmp3lame", "-f", "mp3"]),
+}
+
+
+@dataclass
+class SpeechAnalysis:
+    """Where speech was found in a recording."""
+
+    duration: float
+    """The length of the recording in seconds."""
+    speech: float
+    """The total length of the frames that contain speech, in seconds."""
+    start: float
+    """Where the speech begins, padding included, in seconds."""
+    end: float
+    """Where the speech ends, padding included, in seconds."""
+
+
+@dataclass
+class PreparedAudio:
+    """A recording checked and trimmed before transcription."""
+
+    verdict: Verdict
+    """`ok`, or the event to send instead of transcribing the recording."""
+    audio: bytes
+    """The audio to transcribe."""
+    mimetype: str
+    """The mimetype of `audio`."""
+    analysis: Optional[SpeechAnalysis] = None
+    """The speech analysis, when the recording could be decoded."""
+
+
+@dataclass
+class AudioProcessor:
+    """
+    Finds the speech in a recording before it is transcribed.
+
+    The recording is decoded to mono PCM with ffmpeg and split into short
+    frames. Frames louder than the noise floor by a margin count as
+    speech. Recordings without enough speech, or with too much of it,
+    are rejected; the silence around the speech is trimmed off the rest.
+    """
+
+    enabled: bool = field(default_factory=lambda: getboolenv("AUDIO_VAD", True))
+    """Whether recordings are analysed. When disabled they are sent as is."""
+    sample_rate: int = field(
+        default_factory=lambda: getintenv("AUDIO_SAMPLE_RATE", 16000)
+    )
+    """The rate recordings are resampled to, in Hz."""
+    frame_ms: int = field(default_factory=lambda: getintenv("AUDIO_FRAME_MS", 30))
+    """The length of the frames whose energy is measured, in milliseconds."""
+    silence_threshold: float = field(
+        default_factory=lambda: getfloatenv("AUDIO_SILENCE_THRESHOLD", -45.0)
+    )
+    """Frames quieter than this (in dBFS) are never speech."""
+    noise_margin: float = field(
+        default_factory=lambda: getfloatenv("AUDIO_NOISE_MARGIN", 10.0)
+    )
+    """How far above the noise floor (in dB) a frame must be to be speech."""
+    padding: float = field(
+        default_factory=lambda: getfloatenv("AUDIO_SPEECH_PADDING", 0.25)
+    )
+    """Seconds of audio kept around the speech when trimming."""
+    min_speech: float = field(
+        default_factory=lambda: getfloatenv("AUDIO_MIN_SPEECH", 0.4)
+    )
+    """Recordings with less speech than this (in seconds) are too short."""
+    max_speech: float = field(
+        default_factory=lambda: getfloatenv("AUDIO_MAX_SPEECH", 30.0)
+    )
+    """Recordings whose speech spans more than this (in seconds) are too long."""
+    codec: str = field(default_factory=lambda: getenv("AUDIO_CODEC", "none"))
+    """
+    The codec speech is sent to the transcriber in (none, wav, flac or
+    opus). `none`, the default, sends recordings as they were received.
+    """
+    opus_bitrate: str = field(
+        default_factory=lambda: getenv("AUDIO_OPUS_BITRATE", "24k")
+    )
+    """The bitrate of opus encoded speech."""
+    response_format: str = field(
+        default_factory=lambda: getenv("AUDIO_RESPONSE_FORMAT", "wav")
+    )
+    """The format query responses are delivered in unless the client asks."""
+    response_bitrate: str = field(
+        default_factory=lambda: getenv("AUDIO_RESPONSE_BITRATE", "48k")
+    )
+    """The bitrate of compressed query responses."""
+    ffmpeg: str = field(
+        default_factory=lambda: getenv("FFMPEG_BINARY", None) or get_ffmpeg_exe()
+    )
+    """The ffmpeg binary."""
+
+    def __post_init__(self):
+        assert self.codec in AUDIO_CODECS, f"Audio codec {self.codec} not supported."
+        assert (
+            self.response_format in RESPONSE_FORMATS
+        ), f"Response format {self.response_format} not supported."
+
+    def decode(self, audio_bytes: bytes) -> np.ndarray:
+        """Decodes a recording to mono 16-bit PCM at `sample_rate`."""
+        extension = sniff_container(audio_bytes[:SNIFF_SIZE])
+        args = [self.ffmpeg, "-hide_banner", "-loglevel", "error"]
+        spill = None
+        if extension in SEEKABLE_CONTAINERS:
+            # mp4 audio may keep its index at the end of the file
+            spill = tempfile.NamedTemporaryFile(suffix=extension)
+            spill.write(audio_bytes)
+            spill.flush()
+            args.extend(["-i", spill.name])
+        else:
+            args.extend(["-i", "pipe:0"])
+        args.extend(
+            ["-vn", "-ac", "1", "-ar", str(self.sample_rate), "-f", "s16le", "pipe:1"]
+        )
+        try:
+            result = subprocess.run(
+                args,
+                input=None if spill else audio_bytes,
+                stdin=subprocess.DEVNULL if spill else None,
+                capture_output=True,
+            )
+        finally:
+            if spill is not None:
+                spill.close()
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"ffmpeg exited with code {result.returncode}: "
+                f"{result.stderr.decode(errors='replace').strip()}"
+            )
+        return np.frombuffer(result.stdout, dtype=np.int16)
+
+    def detect_speech(self, pcm: np.ndarray) -> SpeechAnalysis:
+        """Finds the frames that contain speech."""
+        duration = len(pcm) / self.sample_rate
+        frame_size = self.sample_rate * self.frame_ms // 1000
+        count = len(pcm) // frame_size
+        if count == 0:
+            return SpeechAnalysis(duration, 0.0, 0.0, 0.0)
+        frames = pcm[: count * frame_size].reshape(count, frame_size)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1)) / 32768
+        energy = 20 * np.log10(np.maximum(rms, 1e-10))
+        # speech always has quieter gaps between syllables, so the quietest
+        # frames give the noise floor even when someone talks throughout
+        noise_floor = float(np.percentile(energy, 10))
+        threshold = max(self.silence_threshold, noise_floor + self.noise_margin)
+        voiced = np.flatnonzero(energy > threshold)
+        if len(voiced) == 0:
+            return SpeechAnalysis(duration, 0.0, 0.0, 0.0)
+        frame_length = self.frame_ms / 1000
+        return SpeechAnalysis(
+            duration,
+            speech=len(voiced) * frame_length,
+            start=max(0.0, voiced[0] * frame_length - self.padding),
+            end=min(duration, (voiced[-1] + 1) * frame_length + self.padding),
+        )
+
+    def to_wav(self, pcm: np.ndarray) -> bytes:
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(self.sample_rate)
+            output.writeframes(pcm.tobytes())
+        return buffer.getvalue()
+
+    def encode(self, pcm: np.ndarray) -> tuple[bytes, str]:
+        """
+        Encodes mono PCM with the configured codec.
+
+        The samples are written to ffmpeg's stdin from memory, without a
+        copy; speech detection needs the whole recording decoded anyway.
+        Returns the encoded audio and its mimetype; falls back to WAV if
+        ffmpeg cannot encode the codec.
+        """
+        mimetype, codec_args = AUDIO_CODECS[self.codec]
+        if not codec_args:
+            return self.to_wav(pcm), "audio/wav"
+        args = [
+            self.ffmpeg,
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "s16le",
+            "-ar",
+            str(self.sample_rate),
+            "-ac",
+            "1",
+            "-i",
+            "pipe:0",
+            *codec_args,
+        ]
+        if self.codec == "opus":
+            args.extend(["-b:a", self.opus_bitrate])
+        args.append("pipe:1")
+        result = subprocess.run(
+            args, input=np.ascontiguousarray(pcm).data, capture_output=True
+        )
+        if result.returncode != 0:
+            audio_logger.warning(
+                f"Could not encode the audio as {self.codec}, sending WAV: "
+                f"{result.stderr.decode(errors='replace').strip()}"
+            )
+            return self.to_wav(pcm), "audio/wav"
+        return result.stdout, mimetype
+
+    def prepare(self, audio_bytes: bytes, mimetype: str) -> PreparedAudio:
+        """
+        Checks a recording for speech and trims the silence around it.
+
+        The speech is resampled to 16 kHz mono and encoded with `codec`,
+        unless `codec` is `none`, in which case the recording is sent as
+        it was received. Recordings that cannot be decoded are passed
+        through unchanged so the transcription model can have a go at
+        them.
+        """
+        if not self.enabled and self.codec == "none":
+            return PreparedAudio("ok", audio_bytes, mimetype)
+        try:
+            pcm = self.decode(audio_bytes)
+        except Exception:
+            audio_logger.warning("Could not decode the audio", exc_info=True)
+            return PreparedAudio("ok", audio_bytes, mimetype)
+        if not self.enabled:
+            speech, speech_type = self.encode(pcm)
+            return PreparedAudio("ok", speech, speech_type)
+        analysis = self.detect_speech(pcm)
+        audio_logger.info(
+            f"Found {analysis.speech:.2f}s of speech between {analysis.start:.2f}s"
+            f" and {analysis.end:.2f}s of {analysis.duration:.2f}s of audio"
+        )
+        verdict: Verdict = "ok"
+        if analysis.speech == 0:
+            verdict = "no-audio"
+        elif analysis.speech < self.min_speech:
+            verdict = "short-audio"
+        elif analysis.end - analysis.start > self.max_speech:
+            verdict = "long-audio"
+        if verdict != "ok":
+            return PreparedAudio(verdict, b"", mimetype, analysis)
+        if self.codec == "none":
+            return PreparedAudio("ok", audio_bytes, mimetype, analysis)
+        start = int(analysis.start * self.sample_rate)
+        end = int(analysis.end * self.sample_rate)
+        speech, speech_type = self.encode(pcm[start:end])
+        audio_logger.info(
+            f"Encoded {len(audio_bytes) / 1024:.1f}KB of {mimetype} audio"
+            f" as {len(speech) / 1024:.1f}KB of {speech_type}"
+        )
+        return PreparedAudio("ok", speech, speech_type, analysis)
+
+    def transcode(self, audio_bytes: bytes, format: str) -> tuple[bytes, str]:
+        """
+        Transcodes a query response to one of `RESPONSE_FORMATS`.
+
+        Returns the audio and the format it is in, which is `wav` when
+        the audio could not be transcoded.
+        """
+        _, _, codec_args = RESPONSE_FORMATS[format]
+        if not codec_args:
+            return audio_bytes, format
+        args = [
+            self.ffmpeg,
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-i",
+            "pipe:0",
+            "-vn",
+            *codec_args,
+            "-b:a",
+            self.response_bitrate,
+            "pipe:1",
+        ]
+        result = subprocess.run(args, input=audio_bytes, capture_output=True)
+        if result.returncode != 0 or not result.stdout:
+            audio_logger.warning(
+                f"Could not transcode the response to {format}, sending WAV: "
+                f"{result.stderr.decode(errors='replace').strip()}"
+            )
+            return audio_bytes, "wav"
+        audio_logger.info(
+            f"Transcoded {len(audio_bytes) / 1024:.1f}KB response"
+            f" to {len(result.stdout) / 1024:.1f}KB of {format}"
+        )
+        return result.stdout, format
@@ -0,0 +1,163 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from ilens.server.clarifai import Image, Status
+from ilens.server.clarifai.image_processor import SelectedFrame
+from ilens.server.consumers import (
+    cpu_limiter,
+    encode_for,
+    image_detection,
+    image_processor,
+    image_recognition,
+    in_thread,
+    resource,
+    upstream_limiter,
+)
+from ilens.server.logger import CustomLogger
+from ilens.server.scheduler import PriorityLimiter, current_priority
+from ilens.server.settings import (
+    BATCH_CONCURRENCY,
+    BATCH_SIZE,
+    EVENT_PRIORITIES,
+    PRIORITY_AGING,
+)
+from ilens.server.utils import timed
+
+batch_logger = CustomLogger("Batch").get_logger()
+
+# frame selection for batches. the files of a batch wait here rather than
+# in the cpu limiter, so a large batch does not count as load and turn
+# socket events away; the frames being selected still take cpu slots, at
+# most BATCH_CONCURRENCY of them
+batch_limiter = PriorityLimiter("batch", BATCH_CONCURRENCY, PRIORITY_AGING)
+
+
+async def describe_detection(obstacles: list[Any]) -> dict[str, Any]:
+    warning = await in_thread(image_detection.construct_warning, list(obstacles))
+    return {"warning": warning, "obstacles": obstacles}
+
+
+async def describe_recognition(concepts: list[Any]) -> list[Any]:
+    return concepts
+
+
+# the model and the formatting of its results, by batch event
+BATCH_EVENTS: dict[str, tuple[Any, Callable[[Any], Awaitable[Any]]]] = {
+    "detect": (image_detection, describe_detection),
+    "recognize": (image_recognition, describe_recognition),
+}
+
+
+async def select_frame(item: resource) -> SelectedFrame:
+    """
+    Selects the frame of an image or a clip, by its mimetype.
+
+    Batch frames are not memoized: a batch would push the clips of the
+    socket clients out of the memo.
+    """
+    async with batch_limiter.slot():
+        async with cpu_limiter.slot():
+            if item["mimetype"].startswith("image/"):
+                selection = await image_processor.select_image([item["raw"]])
+            else:
+                selection = await image_processor.select_frame(
+                    item["raw"], item["mimetype"]
+                )
+        return await in_thread(image_processor.prepare_selection, selection)
+
+
+async def run_sub_batch(
+    event: str,
+    indices: range,
+    selections: list["asyncio.Task[SelectedFrame]"],
+) -> list[dict[str, Any]]:
+    """
+    Runs the model on the frames of a sub-batch in a single request.
+
+    Returns a result or an error for every file of the sub-batch; a file
+    the model failed on, or returned no output for, does not fail the
+    others.
+    """
+    model, describe = BATCH_EVENTS[event]
+    await asyncio.wait([selections[index] for index in indices])
+    lines: list[dict[str, Any]] = []
+    frames: dict[int, SelectedFrame] = {}
+    for index in indices:
+        error = selections[index].exception()
+        if error is not None:
+            batch_logger.info(f"Batch file {index} could not be decoded: {error}")
+            lines.append({"index": index, "error": "invalid file"})
+        else:
+            frames[index] = selections[index].result()
+    if not frames:
+        return lines
+    images = await asyncio.gather(
+        *(encode_for(frame, model) for frame in frames.values())
+    )
+    try:
+        async with upstream_limiter.slot(), timed(f"Batch {event} ({len(images)})"):
+            outputs = await model.run_each_async(
+                *({"image": Image(base64=image)} for image in images)
+            )
+    except Exception as e:
+        batch_logger.error("BatchError", exc_info=True)
+        lines.extend({"index": index, "error": str(e)} for index in frames)
+        return lines
+    if len(outputs) < len(frames):
+        batch_logger.warning(
+            f"Batch {event} got {len(outputs)} outputs for {len(frames)} files"
+        )
+    for position, index in enumerate(frames):
+        if position >= len(outputs):
+            lines.append({"index": index, "error": "no output"})
+            continue
+        output = outputs[position]
+        if isinstance(output, Status):
+            lines.append(
+                {
+                    "index": index,
+                    "error": f"{output.description} {output.details}".strip(),
+                }
+            )
+            continue
+        try:
+            lines.append({"index": index, "result": await describe(output)})
+        except Exception as e:
+            batch_logger.error("BatchError", exc_info=True)
+            lines.append({"index": index, "error": str(e)})
+    return lines
+
+
+async def stream_batch(
+    event: str, items: list[resource], batch_size: Optional[int] = None
+) -> AsyncIterator[dict[str, Any]]:
+    """
+    Runs a batch of images or clips through the event's model.
+
+    Frames are selected in parallel and sent to the model in requests
+    of `batch_size` images. The results of each request are yielded as
+    soon as it finishes, so they may come out of order; each carries the
+    `index` of its file. Abandoning the iteration cancels the batch.
+    """
+    batch_size = max(1, batch_size or BATCH_SIZE)
+    token = current_priority.set(EVENT_PRIORITIES.get("batch", 0))
+    try:
+        selections = [asyncio.ensure_future(select_frame(item)) for item in items]
+        sub_batches = [
+            asyncio.ensure_future(
+                run_sub_batch(
+                    event, range(start, min(start + batch_size, len(items))), selections
+                )
+            )
+            for start in range(0, len(items), batch_size)
+        ]
+    finally:
+        current_priority.reset(token)
+    batch_logger.info(f"Batch {event} of {len(items)} files began")
+    try:
+        for sub_batch in asyncio.as_completed(sub_batches):
+            for line in await sub_batch:
+                yield line
+    finally:
+        for task in [*sub_batches, *selections]:
+            task.cancel()
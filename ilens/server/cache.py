@@ -0,0 +1,86 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class AsyncMemo(Generic[K, V]):
+    """
+    A bounded, expiring memo for coroutine results.
+
+    Concurrent calls for the same key share a single computation; the
+    computation keeps running while any of its callers is waiting for it
+    and is cancelled once all of them are. Failures are not memoized.
+    """
+
+    max_size: int
+    """The number of results kept. The least recently used are dropped first."""
+    ttl: float
+    """Seconds a result stays valid."""
+    keep: Optional[Callable[[V], bool]] = None
+    """Whether a result is memoized. Others are only shared by concurrent calls."""
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    _entries: "OrderedDict[K, tuple[float, V]]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _pending: "dict[K, asyncio.Task[V]]" = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _waiters: "dict[K, int]" = field(default_factory=dict, init=False, repr=False)
+
+    def _get(self, key: K) -> tuple[bool, V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None  # type: ignore[return-value]
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return False, None  # type: ignore[return-value]
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _put(self, key: K, value: V) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _done(self, key: K, task: "asyncio.Task[V]") -> None:
+        self._pending.pop(key, None)
+        self._waiters.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            result = task.result()
+            if self.keep is None or self.keep(result):
+                self._put(key, result)
+
+    async def get(self, key: K, compute: Callable[[], Awaitable[V]]) -> V:
+        """Returns the memoized result for `key`, computing it if needed."""
+        found, value = self._get(key)
+        if found:
+            self.hits += 1
+            return value
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self._pending[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            self.hits += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    task.cancel()
+            raise
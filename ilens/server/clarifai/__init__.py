@@ -5,6 +5,8 @@ from ilens.server.clarifai.base import (
     media_from_text,  # noqa: F401
 )
 from ilens.server.clarifai.base import Audio, Video, Image, Text, Concept  # noqa: F401
+from ilens.server.clarifai.base import ImageProfile  # noqa: F401
+from ilens.server.clarifai.base import Status  # noqa: F401
 from ilens.server.clarifai.text_generation import (
     ClarifaiGPT4,  # noqa: F401
     ClarifaiGPT4V,  # noqa: F401
@@ -1,13 +1,24 @@
+import asyncio
 from dataclasses import dataclass, field
 import io
 from pathlib import Path
-from typing import Any, Generic, Optional, Protocol, Type, TypeAlias, TypeVar, Union
-from ilens.server.utils import getenv, loadenv
+from typing import (
+    Any,
+    Generic,
+    Literal,
+    Optional,
+    Protocol,
+    Type,
+    TypeAlias,
+    TypeVar,
+    Union,
+)
+from ilens.server.utils import getenv, getintenv, loadenv
 import clarifai_grpc.grpc.api.resources_pb2 as resources_pb2
 import clarifai_grpc.grpc.api.service_pb2 as service_pb2
 import clarifai_grpc.grpc.api.service_pb2_grpc as service_pb2_grpc
 from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
-from grpc import Channel
+from grpc import Channel, Future
 
 from google.protobuf.internal.containers import RepeatedCompositeFieldContainer
 from google.protobuf.struct_pb2 import Struct
@@ -70,6 +81,64 @@ def media_from_text(type: Type[MediaType], text: str, **kwargs) -> MediaType:
     return type(raw=text, **kwargs)
 
 
+@dataclass(frozen=True)
+class ImageProfile:
+    """How images are prepared before they are sent to a model."""
+
+    max_width: int = 1280
+    """The maximum width of the image."""
+    max_height: int = 1280
+    """The maximum height of the image."""
+    crop: Literal["none", "center"] = "none"
+    """
+    `none` keeps the whole image; `center` crops it to the aspect ratio of
+    `max_width x max_height` first.
+    """
+    format: str = "jpeg"
+    """The image format."""
+    quality: int = 80
+    """The encoding quality, for lossy formats."""
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults: Any) -> "ImageProfile":
+        """Reads the profile from `<prefix>_IMAGE_*` environment variables."""
+        profile = cls(**defaults)
+        return cls(
+            max_width=getintenv(f"{prefix}_IMAGE_MAX_WIDTH", profile.max_width),
+            max_height=getintenv(f"{prefix}_IMAGE_MAX_HEIGHT", profile.max_height),
+            crop=getenv(f"{prefix}_IMAGE_CROP", profile.crop),  # type: ignore
+            format=getenv(f"{prefix}_IMAGE_FORMAT", profile.format),
+            quality=getintenv(f"{prefix}_IMAGE_QUALITY", profile.quality),
+        )
+
+
+async def await_grpc(call: Future) -> Any:
+    """
+    Waits for a gRPC call made with `.future` without blocking the loop.
+
+    Cancelling the wait cancels the call.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def transfer(call: Future) -> None:
+        if future.done():
+            return
+        if call.cancelled():
+            future.cancel()
+        elif call.exception() is not None:
+            future.set_exception(call.exception())
+        else:
+            future.set_result(call.result())
+
+    call.add_done_callback(lambda call: loop.call_soon_threadsafe(transfer, call))
+    try:
+        return await future
+    except asyncio.CancelledError:
+        call.cancel()
+        raise
+
+
 def logger(model_name="", model_id=""):
     """Logger for my run function"""
 
@@ -95,6 +164,34 @@ def logger(model_name="", model_id=""):
     return decorator
 
 
+def async_logger(model_name="", model_id=""):
+    """Logger for my run_async function"""
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            clarifai_logger.info(f"Running {model_name} model with id {model_id}")
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                clarifai_logger.info(f"Cancelled {model_name} model with id {model_id}")
+                raise
+            except Exception as e:
+                clarifai_logger.error(
+                    f"Error running {model_name} model with id {model_id}",
+                    exc_info=True,
+                )
+                raise e
+            clarifai_logger.info(
+                f"Finished running {model_name} model with id {model_id}"
+            )
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 @dataclass
 class BaseModel(Generic[MediaType, ResponseType]):
     model_id: str
@@ -107,6 +204,8 @@ class BaseModel(Generic[MediaType, ResponseType]):
     """The model version id."""
     """A name describing the model's function"""
     pat: str = field(default_factory=lambda: getenv("CLARIFAI_PAT"))
+    image_profile: ImageProfile = field(default_factory=ImageProfile)
+    """How images are prepared for the model."""
 
     @property
     def model_name(self) -> str:
@@ -246,6 +345,12 @@ class BaseModel(Generic[MediaType, ResponseType]):
         stub, metadata = self._create_channel()
         return stub.PostModelOutputs(request, metadata=metadata)
 
+    def _execute_request_future(
+        self, request: service_pb2.PostModelOutputsRequest
+    ) -> Future:
+        stub, metadata = self._create_channel()
+        return stub.PostModelOutputs.future(request, metadata=metadata)
+
     def parse_output(self, output: Any) -> ResponseType:
         return output
 
@@ -257,21 +362,87 @@ class BaseModel(Generic[MediaType, ResponseType]):
     def handle_error(self, error: Status) -> None:
         raise Exception(f"{error.description} {error.details}")
 
+    def _build_request(
+        self, data: tuple[dict[str, MediaType], ...]
+    ) -> service_pb2.PostModelOutputsRequest:
+        """Builds the request that runs the model on the data."""
+        return self._create_request([self._create_input(d) for d in data])
+
+    def _parse_response(
+        self, response: service_pb2.MultiOutputResponse
+    ) -> list[ResponseType]:
+        """Returns the parsed outputs, handing a failed status to `handle_error`."""
+        if response.status.code != status_code_pb2.SUCCESS:
+            self.handle_error(response.status)
+            return []
+        return self.parse_outputs(response.outputs)
+
     def run(self, *data: dict[str, MediaType]) -> list[ResponseType]:
         @logger(model_name=self.model_name, model_id=self.model_id)
         def main_run(*data: dict[str, MediaType]) -> list[ResponseType]:
             """Runs the model on the data."""
-            inputs = [self._create_input(d) for d in data]
-            request = self._create_request(inputs)
-            response = self._execute_request(request)
-            if response.status.code != status_code_pb2.SUCCESS:
-                self.handle_error(response.status)
-                return []
-            else:
-                return self.parse_outputs(response.outputs)
+            response = self._execute_request(self._build_request(data))
+            return self._parse_response(response)
 
         return main_run(*data)
 
+    async def run_async(self, *data: dict[str, MediaType]) -> list[ResponseType]:
+        """
+        Runs the model on the data without blocking the event loop.
+
+        Cancelling the run cancels the request.
+        """
+
+        @async_logger(model_name=self.model_name, model_id=self.model_id)
+        async def main_run(*data: dict[str, MediaType]) -> list[ResponseType]:
+            call = self._execute_request_future(self._build_request(data))
+            return self._parse_response(await await_grpc(call))
+
+        return await main_run(*data)
+
+    def _parse_each(
+        self, response: service_pb2.MultiOutputResponse
+    ) -> list[Union[ResponseType, Status]]:
+        """
+        Returns the parsed output of every input, or its status when that
+        input failed; only a request that failed as a whole is handed to
+        `handle_error`.
+        """
+        if response.status.code not in (
+            status_code_pb2.SUCCESS,
+            status_code_pb2.MIXED_STATUS,
+        ):
+            self.handle_error(response.status)
+            return []
+        return [
+            (
+                self.parse_output(output)
+                if output.status.code == status_code_pb2.SUCCESS
+                else output.status
+            )
+            for output in response.outputs
+        ]
+
+    async def run_each_async(
+        self, *data: dict[str, MediaType]
+    ) -> list[Union[ResponseType, Status]]:
+        """
+        Runs the model on the data like `run_async`, without failing the
+        whole request when some of the inputs fail.
+
+        Outputs come in the order of the inputs; an input the response has
+        no output for has nothing in the list.
+        """
+
+        @async_logger(model_name=self.model_name, model_id=self.model_id)
+        async def main_run(
+            *data: dict[str, MediaType]
+        ) -> list[Union[ResponseType, Status]]:
+            call = self._execute_request_future(self._build_request(data))
+            return self._parse_each(await await_grpc(call))
+
+        return await main_run(*data)
+
 
 @dataclass
 class BaseWorkflow(Generic[MediaType, ResponseType]):
@@ -284,6 +455,8 @@ class BaseWorkflow(Generic[MediaType, ResponseType]):
     workflow_id: str
     """The workflow id."""
     pat: str = field(default_factory=lambda: getenv("CLARIFAI_PAT"))
+    image_profile: ImageProfile = field(default_factory=ImageProfile)
+    """How images are prepared for the workflow."""
 
     @property
     def model_name(self) -> str:
@@ -337,6 +510,12 @@ class BaseWorkflow(Generic[MediaType, ResponseType]):
         stub, metadata = self._create_channel()
         return stub.PostWorkflowResults(request, metadata=metadata)
 
+    def _execute_request_future(
+        self, request: service_pb2.PostWorkflowResultsRequest
+    ) -> Future:
+        stub, metadata = self._create_channel()
+        return stub.PostWorkflowResults.future(request, metadata=metadata)
+
     def parse_output(self, output: Any) -> ResponseType:
         return output
 
@@ -348,19 +527,42 @@ class BaseWorkflow(Generic[MediaType, ResponseType]):
     def handle_error(self, error: Status) -> None:
         raise Exception(f"{error.description}")
 
+    def _build_request(
+        self, data: tuple[dict[str, MediaType], ...]
+    ) -> service_pb2.PostWorkflowResultsRequest:
+        """Builds the request that runs the workflow on the data."""
+        return self._create_workflow_request([self._create_input(d) for d in data])
+
+    def _parse_response(
+        self, response: service_pb2.PostWorkflowResultsResponse
+    ) -> list[ResponseType]:
+        """Returns the parsed results, handing a failed status to `handle_error`."""
+        if response.status.code != status_code_pb2.SUCCESS:
+            self.handle_error(response.status)
+            return []
+        return self.parse_outputs(response.results)
+
     # @profile  # noqa: F821 # type: ignore
     def run(self, *data: dict[str, MediaType]) -> list[ResponseType]:
         """Runs the workflow on the data."""
 
         @logger(model_name=self.model_name, model_id=self.workflow_id)
         def main_run(*data: dict[str, MediaType]) -> list[ResponseType]:
-            inputs = [self._create_input(d) for d in data]
-            request = self._create_workflow_request(inputs)
-            response = self._execute_request(request)
-            if response.status.code != status_code_pb2.SUCCESS:
-                self.handle_error(response.status)
-                return []
-            else:
-                return self.parse_outputs(response.results)
+            response = self._execute_request(self._build_request(data))
+            return self._parse_response(response)
 
         return main_run(*data)
+
+    async def run_async(self, *data: dict[str, MediaType]) -> list[ResponseType]:
+        """
+        Runs the workflow on the data without blocking the event loop.
+
+        Cancelling the run cancels the request.
+        """
+
+        @async_logger(model_name=self.model_name, model_id=self.workflow_id)
+        async def main_run(*data: dict[str, MediaType]) -> list[ResponseType]:
+            call = self._execute_request_future(self._build_request(data))
+            return self._parse_response(await await_grpc(call))
+
+        return await main_run(*data)
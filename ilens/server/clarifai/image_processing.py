@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from typing import Any, Optional, TypedDict
 from itertools import groupby
-from ilens.server.clarifai.base import BaseModel, Concept, Image
+from ilens.server.clarifai.base import BaseModel, Concept, Image, ImageProfile
 from ilens.server.utils import getenv, getfloatenv, getintenv, getlistenv
 
 DEFAULT_OBSTACLES = [
@@ -108,6 +108,7 @@ class ObstacleInfo(TypedDict):
     distance: str
     depth: float
     value: float
+    location: LocationInfo
 
 
 @dataclass
@@ -130,6 +131,11 @@ class ClarifaiImageDetection(BaseModel[Image, list[ObstacleInfo]]):
     user_id: str = field(
         default_factory=lambda: getenv("CLARIFAI_DETECTION_USER_ID", "clarifai")
     )
+    image_profile: ImageProfile = field(
+        default_factory=lambda: ImageProfile.from_env(
+            "CLARIFAI_DETECTION", max_width=640, max_height=640
+        )
+    )
 
     # PREDICTION PARAMS
     selected_concept_names: list[str] = field(
@@ -190,6 +196,7 @@ class ClarifaiImageDetection(BaseModel[Image, list[ObstacleInfo]]):
                     "position": position,
                     "distance": distance,
                     "depth": depth,
+                    "location": location_info,
                 }
                 result.append(object_info)
         return result
@@ -247,6 +254,11 @@ class ClarifaiImageRecognition(BaseModel[Image, list[ObjectRecognitionInfo]]):
     user_id: str = field(
         default_factory=lambda: getenv("CLARIFAI_RECOGNITION_USER_ID", "clarifai")
     )
+    image_profile: ImageProfile = field(
+        default_factory=lambda: ImageProfile.from_env(
+            "CLARIFAI_RECOGNITION", max_width=512, max_height=512
+        )
+    )
     model_name = "image recognition"
 
     # PREDICTION PARAMS
@@ -1,14 +1,27 @@
 import asyncio
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
 from io import BytesIO
-from math import floor
-from typing import List
+from typing import Generator, Optional
 
 import cv2
-import imageio.v3 as iio
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 
+from ilens.server.clarifai.base import ImageProfile
+from ilens.server.clarifai.video_decoders import (
+    KEYFRAME_DECODERS,
+    SNIFF_SIZE,
+    ClipStream,
+    DecoderRegistry,
+    VideoSource,
+    sniff_container,
+)
 from ilens.server.logger import CustomLogger
+from ilens.server.similarity import dhash
+from ilens.server.utils import getenv, getfloatenv, getintenv
 
 video_processor_logger = CustomLogger("VideoProcessor").get_logger()
 
@@ -16,76 +29,558 @@ VIDEO_MIMETYPES = {
     "video/ogg": "ogg",
     "video/mp4": "mp4",
     "video/webm": "webm",
+    "video/quicktime": "mov",
+    "video/x-m4v": "m4v",
+    "video/3gpp": "3gp",
+    "video/x-matroska": "mkv",
+    "video/x-msvideo": "avi",
+    "video/x-flv": "flv",
+    "video/mpeg": "mpeg",
+    "video/mp2t": "ts",
 }
 
+IMAGE_FORMATS = {
+    "jpeg": "JPEG",
+    "jpg": "JPEG",
+    "webp": "WEBP",
+    "png": "PNG",
+}
+
+IMAGE_ENCODERS = ["pil", "cv2"]
+
+VIDEO_DECODERS = ["auto", "pyav", "ffmpeg", "imageio"]
+
+
+@dataclass
+class FrameSelection:
+    """The frame selected from a video."""
+
+    frame: np.ndarray
+    """The selected frame as an RGB array."""
+    index: int
+    """The position of the frame among the decoded frames."""
+    score: float
+    """The sharpness score of the frame."""
+    evaluated: int = 0
+    """The number of frames that were scored."""
+    skipped: int = 0
+    """The number of near-duplicate frames that were not scored."""
+    rejected: int = 0
+    """The number of frames rejected for strong motion."""
+    timed_out: bool = False
+    """
+    Whether the selection stopped before the end of the video, because its
+    budget ran out or its upload stalled.
+    """
+    keyframe: bool = False
+    """Whether `index` counts keyframes, the frame was found by the keyframe pass."""
+
+
+@dataclass
+class SelectedFrame:
+    """A selected frame, ready to be encoded for the models."""
+
+    frame: np.ndarray
+    """The frame as an RGB array, downscaled to the processor's `image_max_size`."""
+    hash: int
+    """The perceptual hash of the frame."""
+    index: int
+    """The position of the frame among the decoded frames."""
+    score: float
+    """The sharpness score of the frame."""
+    timed_out: bool = False
+    """Whether the selection ran out of its budget before the end of the video."""
+    encodings: dict[ImageProfile, bytes] = field(default_factory=dict, repr=False)
+    """The frame encoded for each image profile it was requested for."""
+
+
+@dataclass
+class MotionFilter:
+    """
+    Decides which frames are worth a full sharpness score.
+
+    Frames are compared through tiny grayscale thumbnails. A frame that
+    barely differs from the last scored frame is a near duplicate and is
+    skipped; a frame that differs a lot from the previous frame is most
+    likely motion blurred and is rejected.
+    """
+
+    still_threshold: float
+    """Mean absolute difference below which a frame is a near duplicate."""
+    motion_threshold: float
+    """Mean absolute difference above which a frame is rejected."""
+    size: int = 32
+    """The width and height of the thumbnails."""
+    skipped: int = field(default=0, init=False)
+    rejected: int = field(default=0, init=False)
+    _previous: Optional[np.ndarray] = field(default=None, init=False, repr=False)
+    _reference: Optional[np.ndarray] = field(default=None, init=False, repr=False)
+
+    def _thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        thumbnail = cv2.resize(
+            frame, (self.size, self.size), interpolation=cv2.INTER_AREA
+        )
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_RGB2GRAY)
+        return thumbnail
+
+    def _difference(self, a: np.ndarray, b: np.ndarray) -> float:
+        return float(cv2.absdiff(a, b).mean())
+
+    def should_score(self, frame: np.ndarray) -> bool:
+        """Returns True if the frame should be scored."""
+        thumbnail = self._thumbnail(frame)
+        previous, self._previous = self._previous, thumbnail
+        if (
+            self.motion_threshold
+            and previous is not None
+            and self._difference(previous, thumbnail) > self.motion_threshold
+        ):
+            self.rejected += 1
+            return False
+        if (
+            self.still_threshold
+            and self._reference is not None
+            and self._difference(self._reference, thumbnail) < self.still_threshold
+        ):
+            self.skipped += 1
+            return False
+        self._reference = thumbnail
+        return True
 
+
+@dataclass
 class AsyncVideoProcessor:
     """this class is for handling videos to select the best frame for processing"""
 
+    # ENCODING PARAMS
+    image_format: str = field(
+        default_factory=lambda: getenv("FRAME_ENCODE_FORMAT", "jpeg")
+    )
+    """The format the selected frame is encoded to (jpeg, webp or png)."""
+    image_quality: int = field(
+        default_factory=lambda: getintenv("FRAME_ENCODE_QUALITY", 80)
+    )
+    """The quality used for lossy formats (1-100)."""
+    image_max_size: Optional[int] = field(
+        default_factory=lambda: getintenv("FRAME_MAX_SIZE", 1280)
+    )
+    """The maximum length of the longest edge. Larger frames are downscaled."""
+    image_encoder: str = field(default_factory=lambda: getenv("FRAME_ENCODER", "pil"))
+    """The library used to encode the frame (pil or cv2)."""
+
+    # DECODING PARAMS
+    decoder: str = field(default_factory=lambda: getenv("VIDEO_DECODER", "auto"))
+    """
+    The backend used to decode videos (pyav, ffmpeg or imageio). `auto`
+    picks the fastest one available for each container.
+    """
+    analysis_fps: Optional[float] = field(
+        default_factory=lambda: getfloatenv("VIDEO_ANALYSIS_FPS", 10.0)
+    )
+    """The rate at which the ffmpeg decoder samples frames. 0 keeps every frame."""
+    analysis_width: int = field(
+        default_factory=lambda: getintenv("VIDEO_ANALYSIS_WIDTH", 320)
+    )
+    """The maximum width of the grayscale frames scored by the ffmpeg decoder."""
+    analysis_height: int = field(
+        default_factory=lambda: getintenv("VIDEO_ANALYSIS_HEIGHT", 240)
+    )
+    """The maximum height of the grayscale frames scored by the ffmpeg decoder."""
+    decoders: DecoderRegistry = field(default_factory=DecoderRegistry, repr=False)
+
+    # SELECTION PARAMS
+    still_threshold: float = field(
+        default_factory=lambda: getfloatenv("VIDEO_STILL_THRESHOLD", 2.0)
+    )
+    """Frames closer than this to the last scored frame are skipped. 0 disables."""
+    motion_threshold: float = field(
+        default_factory=lambda: getfloatenv("VIDEO_MOTION_THRESHOLD", 40.0)
+    )
+    """Frames further than this from the previous frame are rejected. 0 disables."""
+    thumbnail_size: int = field(
+        default_factory=lambda: getintenv("VIDEO_THUMBNAIL_SIZE", 32)
+    )
+    """The size of the thumbnails used to compare consecutive frames."""
+
+    def __post_init__(self):
+        assert (
+            self.image_format.lower() in IMAGE_FORMATS
+        ), f"Image format {self.image_format} not supported."
+        assert (
+            self.image_encoder in IMAGE_ENCODERS
+        ), f"Image encoder {self.image_encoder} not available."
+        assert (
+            self.decoder in VIDEO_DECODERS
+        ), f"Video decoder {self.decoder} not available."
+
     def bytes_to_ndarray(self, image_bytes: bytes) -> np.ndarray:
         """Converts image bytes to numpy array."""
         image = Image.open(BytesIO(image_bytes))
         return np.array(image)
 
-    # @profile  # noqa: F821 # type: ignore
-    async def process_video(self, video_bytes: bytes, extension: str) -> np.ndarray:
-        if ";" in extension:
-            extension = extension.split(";")[0]
+    def decode_image(
+        self, image_bytes: bytes, max_size: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        Decodes an image to an RGB array.
+
+        JPEGs are decoded at a reduced scale (PIL's draft mode) when the
+        result would still be at least `max_size` on its longest edge.
+        The image is turned upright according to its EXIF orientation, as
+        phone cameras store photos sideways.
+        """
+        max_size = max_size or self.image_max_size
+        image = Image.open(BytesIO(image_bytes))
+        if max_size:
+            image.draft("RGB", (max_size, max_size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image = ImageOps.exif_transpose(image)
+        return np.asarray(image)
+
+    async def select_image(self, images: list[bytes]) -> FrameSelection:
+        """Decodes the images in parallel and selects the sharpest one."""
+        video_processor_logger.info(f"Began processing {len(images)} images")
+        try:
+            frames = await asyncio.gather(
+                *(asyncio.to_thread(self.decode_image, image) for image in images)
+            )
+            if len(frames) == 1:
+                return FrameSelection(frames[0], 0, 0.0, 0)
+            scores = await asyncio.to_thread(
+                lambda: [
+                    self.sharpness(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY))
+                    for frame in frames
+                ]
+            )
+            index = int(np.argmax(scores))
+            video_processor_logger.info(f"Selected image {index}")
+            return FrameSelection(frames[index], index, scores[index], len(frames))
+        except Exception as e:
+            video_processor_logger.error("VideoProcessorError", exc_info=True)
+            raise e
+
+    def _get_extension(self, extension: str) -> str:
+        """Converts a mimetype or extension to a dotted extension, "" if unknown."""
+        extension = extension.split(";")[0].strip().lower()
         if "/" in extension:
-            extension = VIDEO_MIMETYPES[extension]
-        if not extension.startswith("."):
+            extension = VIDEO_MIMETYPES.get(extension, "")
+        if extension and not extension.startswith("."):
             extension = "." + extension
+        return extension
+
+    def _resolve_extension(
+        self,
+        source: VideoSource,
+        mimetype: str,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> str:
+        """
+        Works out the container of a video.
+
+        The magic bytes are trusted over the mimetype the client sent.
+        """
+        if isinstance(source, ClipStream):
+            head = source.peek(SNIFF_SIZE, deadline, cancelled)
+        else:
+            head = source[:SNIFF_SIZE]
+        extension = sniff_container(head) or self._get_extension(mimetype)
+        if not extension:
+            raise ValueError(f"Unsupported video type {mimetype}")
+        return extension
+
+    # @profile  # noqa: F821 # type: ignore
+    async def process_video(
+        self, video_bytes: bytes, extension: str, budget: Optional[float] = None
+    ) -> np.ndarray:
+        selection = await self.select_frame(video_bytes, extension, budget)
+        return selection.frame
+
+    async def select_frame(
+        self, source: VideoSource, extension: str, budget: Optional[float] = None
+    ) -> FrameSelection:
+        """
+        Selects the sharpest frame of the video.
+
+        When a `budget` (in seconds) is given, decoding stops when the
+        budget runs out and the best frame found by then is returned.
+        `source` may be a `ClipStream` that is still being uploaded; it
+        is always decoded with ffmpeg. Cancelling the selection stops
+        decoding.
+        """
+        deadline = time.monotonic() + budget if budget else None
+        cancelled = threading.Event()
         video_processor_logger.info("Began processing video")
         try:
-            frames = await asyncio.to_thread(
-                self._bytes_to_frames, video_bytes, extension
+            selection = await asyncio.to_thread(
+                self._select_frame, source, extension, deadline, cancelled
             )
-            gray_frames = await asyncio.to_thread(self._grays_scale_image, frames)
-            best_frame_index = await asyncio.to_thread(
-                self._get_sharpest_frame, gray_frames
+            video_processor_logger.info(
+                "Finished processing video successfully"
+                f" (selected frame {selection.index}, scored {selection.evaluated},"
+                f" skipped {selection.skipped}, rejected {selection.rejected}"
+                f"{', timed out' if selection.timed_out else ''})"
             )
-            best_frame = frames[best_frame_index]
-            # return cv2.resize(best_frame, (0, 0), fx=0.95, fy=0.95)
-            video_processor_logger.info("Finished processing video successfully")
-            return best_frame
+            return selection
+        except asyncio.CancelledError:
+            # the thread cannot be interrupted, it stops at the next frame
+            # or chunk
+            cancelled.set()
+            video_processor_logger.info("Video processing cancelled")
+            raise
         except Exception as e:
             video_processor_logger.error("VideoProcessorError", exc_info=True)
             raise e
 
-    def _bytes_to_frames(self, video_bytes: bytes, extension: str) -> List[np.ndarray]:
-        video_processor_logger.info("Converting video bytes to frames")
-        frames = iio.imread(video_bytes, index=None, extension=extension)
-        video_processor_logger.info("Finished converting video bytes to frames")
-        return frames  # type: ignore
-
-    def _grays_scale_image(self, frames: List[np.ndarray]) -> List[np.ndarray]:
-        video_processor_logger.info("Converting frames to grayscale")
-        res = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
-        video_processor_logger.info("Finished converting frames to grayscale")
-        return res
-
-    def _get_sharpest_frame(self, gray_frames: List[np.ndarray]):
-        video_processor_logger.info("Getting sharpest frame")
-        sharpest_frame_index = np.argmax(
-            [cv2.Laplacian(gray_frame, cv2.CV_64F).var() for gray_frame in gray_frames]
+    def sharpness(self, gray_frame: np.ndarray) -> float:
+        """Scores a grayscale frame by the variance of its Laplacian."""
+        return cv2.Laplacian(gray_frame, cv2.CV_64F).var()
+
+    def iter_frames(
+        self,
+        source: VideoSource,
+        extension: str,
+        decoder: str,
+        keyframes: bool = False,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Generator[tuple[int, np.ndarray], None, None]:
+        """
+        Yields `(index, frame)` for every frame of the video, or for its
+        keyframes only with `keyframes`.
+
+        The pyav and imageio decoders yield RGB frames; the ffmpeg decoder
+        yields small grayscale frames. A clip stream is read until
+        `deadline` or `cancelled`.
+        """
+        if decoder == "ffmpeg":
+            yield from self.decoders.ffmpeg.iter_gray_frames(
+                source,
+                extension,
+                self.analysis_fps,
+                self.analysis_width,
+                self.analysis_height,
+                keyframes,
+                deadline,
+                cancelled,
+            )
+            return
+        if isinstance(source, ClipStream):
+            raise ValueError(f"The {decoder} decoder cannot decode a clip stream")
+        if decoder == "pyav":
+            yield from self.decoders.pyav.iter_frames(source, keyframes)
+        elif keyframes:
+            raise ValueError(f"The {decoder} decoder cannot decode keyframes only")
+        else:
+            yield from self.decoders.imageio.iter_frames(source, extension)
+
+    def _select_frame(
+        self,
+        source: VideoSource,
+        mimetype: str,
+        deadline: Optional[float],
+        cancelled: Optional[threading.Event] = None,
+    ) -> FrameSelection:
+        """
+        Scores frames as they are decoded, keeping only the best so far.
+
+        Memory stays bounded by a couple of frames whatever the length of
+        the clip. With a deadline, the keyframes spread over the whole
+        clip are scored first, then the clip is filled in at the analysis
+        frame rate, so a selection cut short still covers the end of the
+        clip. When the deadline is reached, decoding stops and the best
+        frame so far is selected; a clip stream stops being read, as it
+        does when its upload stalls. Frames picked by the ffmpeg decoder
+        are decoded again at full colour resolution. Setting `cancelled`
+        stops decoding and kills the decoder.
+        """
+        extension = self._resolve_extension(source, mimetype, deadline, cancelled)
+        if isinstance(source, ClipStream):
+            # only ffmpeg decodes a clip while it is being uploaded
+            decoder = "ffmpeg"
+        else:
+            decoder = self.decoders.choose(extension, self.decoder)
+        video_processor_logger.info(
+            f"Scoring frames of a {extension} video decoded by {decoder}"
         )
-        video_processor_logger.info("Finished getting sharpest frame")
-        # print(sharpest_frame_index)
-        return sharpest_frame_index
+        passes = [False]
+        if (
+            deadline
+            and decoder in KEYFRAME_DECODERS
+            and not isinstance(source, ClipStream)
+        ):
+            # a clip stream can only be read once, and arrives in order
+            passes = [True, False]
+        best_index, best_score, best_keyframe = -1, -1.0, False
+        best_frame: Optional[np.ndarray] = None
+        evaluated = skipped = rejected = 0
+        timed_out = False
+        for keyframes in passes:
+            # both passes score frames of the same size, so their scores
+            # can be compared
+            motion_filter = MotionFilter(
+                self.still_threshold, self.motion_threshold, self.thumbnail_size
+            )
+            with closing(
+                self.iter_frames(
+                    source, extension, decoder, keyframes, deadline, cancelled
+                )
+            ) as frames:
+                for index, frame in frames:
+                    if cancelled is not None and cancelled.is_set():
+                        raise asyncio.CancelledError()
+                    if evaluated and deadline and time.monotonic() >= deadline:
+                        timed_out = True
+                        break
+                    if not motion_filter.should_score(frame):
+                        continue
+                    if frame.ndim == 3:
+                        gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+                    else:
+                        gray_frame = frame
+                    score = self.sharpness(gray_frame)
+                    evaluated += 1
+                    if score > best_score:
+                        best_index, best_score = index, score
+                        best_keyframe = keyframes
+                        best_frame = frame if frame.ndim == 3 else None
+            skipped += motion_filter.skipped
+            rejected += motion_filter.rejected
+            if timed_out:
+                break
+        if cancelled is not None and cancelled.is_set():
+            raise asyncio.CancelledError()
+        if isinstance(source, ClipStream) and source.truncated:
+            timed_out = True
+        if best_index < 0:
+            raise ValueError("No frames could be decoded from the video")
+        if best_frame is None:
+            video_processor_logger.info(f"Decoding sharpest frame ({best_index})")
+            if isinstance(source, ClipStream):
+                source = source.getvalue()
+            best_frame = self.decoders.ffmpeg.read_frame(
+                source, extension, best_index, self.analysis_fps, best_keyframe
+            )
+        return FrameSelection(
+            best_frame,
+            best_index,
+            best_score,
+            evaluated,
+            skipped,
+            rejected,
+            timed_out,
+            best_keyframe,
+        )
+
+    def _resize_image(self, image: np.ndarray, max_size: Optional[int]) -> np.ndarray:
+        """Downscales the image so that its longest edge is at most `max_size`."""
+        height, width = image.shape[:2]
+        if not max_size or max(height, width) <= max_size:
+            return image
+        scale = max_size / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def _encode_with_pil(self, image: np.ndarray, format: str, quality: int) -> bytes:
+        image_pil: Image.Image = Image.fromarray(image)
+        if format == "JPEG" and image_pil.mode not in ("RGB", "L"):
+            image_pil = image_pil.convert("RGB")
+        buffer = BytesIO()
+        if format == "PNG":
+            image_pil.save(buffer, format=format, compress_level=1)
+        else:
+            image_pil.save(buffer, format=format, quality=quality)
+        return buffer.getvalue()
+
+    def _encode_with_cv2(self, image: np.ndarray, format: str, quality: int) -> bytes:
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+        elif image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        if format == "JPEG":
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif format == "WEBP":
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        success, buffer = cv2.imencode(f".{format.lower()}", image, params)
+        if not success:
+            raise ValueError(f"Failed to encode image as {format}")
+        return buffer.tobytes()
 
     # @profile  # noqa: F821 # type: ignore
-    def convert_result_image_to_bytes(self, image: np.ndarray) -> bytes:
+    def convert_result_image_to_bytes(
+        self,
+        image: np.ndarray,
+        format: Optional[str] = None,
+        quality: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ) -> bytes:
+        """
+        Encodes the selected frame.
+
+        The frame is downscaled to `max_size` (longest edge) and encoded
+        to `format` at `quality`. Unset arguments fall back to the
+        processor's configuration.
+        """
         video_processor_logger.info("Converting result image to bytes")
-        image_pil: Image.Image = Image.fromarray(image)
-        # initial_size = len(image_pil.tobytes()) / 1024
-        x, y = image_pil.size
-        if image_pil.width > image_pil.height:
-            x2, y2 = floor(x - 50), floor(y - 20)
+        format = IMAGE_FORMATS[(format or self.image_format).lower()]
+        quality = quality or self.image_quality
+        image = self._resize_image(image, max_size or self.image_max_size)
+        if self.image_encoder == "cv2":
+            image_bytes = self._encode_with_cv2(image, format, quality)
         else:
-            x2, y2 = floor(x - 20), floor(y - 50)
-        image_pil.resize((x2, y2), Image.LANCZOS)
-        buffer = BytesIO()
-        image_pil.save(buffer, format="PNG", optimize=True, quality=75)
-        image_bytes = buffer.getvalue()
-        video_processor_logger.info("Finished converting result image to bytes")
+            image_bytes = self._encode_with_pil(image, format, quality)
+        video_processor_logger.info(
+            f"Finished converting result image to bytes ({len(image_bytes) / 1024}KB)"
+        )
+        return image_bytes
+
+    def prepare_selection(self, selection: FrameSelection) -> SelectedFrame:
+        """Downscales the selected frame and computes its perceptual hash."""
+        frame = self._resize_image(selection.frame, self.image_max_size)
+        return SelectedFrame(
+            frame=frame,
+            hash=dhash(frame),
+            index=selection.index,
+            score=selection.score,
+            timed_out=selection.timed_out,
+        )
+
+    def _apply_profile(self, image: np.ndarray, profile: ImageProfile) -> np.ndarray:
+        """Crops and downscales the image to fit the profile."""
+        height, width = image.shape[:2]
+        if profile.crop == "center":
+            aspect = profile.max_width / profile.max_height
+            if width / height > aspect:
+                crop_width = max(1, round(height * aspect))
+                left = (width - crop_width) // 2
+                image = image[:, left : left + crop_width]
+            else:
+                crop_height = max(1, round(width / aspect))
+                top = (height - crop_height) // 2
+                image = image[top : top + crop_height]
+            height, width = image.shape[:2]
+        scale = min(profile.max_width / width, profile.max_height / height)
+        if scale >= 1:
+            return image
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def encode_for(self, frame: SelectedFrame, profile: ImageProfile) -> bytes:
+        """
+        Encodes the frame for a model's image profile.
+
+        Encodings are kept on the frame, so each profile is encoded once
+        however many models or requests share it.
+        """
+        image_bytes = frame.encodings.get(profile)
+        if image_bytes is None:
+            image = self._apply_profile(frame.frame, profile)
+            image_bytes = self.convert_result_image_to_bytes(
+                image, profile.format, profile.quality, max(image.shape[:2])
+            )
+            frame.encodings[profile] = image_bytes
         return image_bytes
@@ -1,6 +1,6 @@
 import base64
 from typing import Any, TypedDict, Optional, Union
-from ilens.server.clarifai.base import BaseModel, Text, Image
+from ilens.server.clarifai.base import BaseModel, Text, Image, ImageProfile
 from dataclasses import dataclass, field
 from ilens.server.utils import getenv, getfloatenv, getintenv
 
@@ -74,6 +74,11 @@ class ClarifaiGPT4V(BaseModel[Union[Image, Text], TextResponse]):
     user_id: str = field(
         default_factory=lambda: getenv("CLARIFAI_GPT4V_USER_ID", "openai")
     )
+    image_profile: ImageProfile = field(
+        default_factory=lambda: ImageProfile.from_env(
+            "CLARIFAI_GPT4V", max_width=1024, max_height=1024
+        )
+    )
 
     def _get_inference_params(self) -> dict[str, Any] | None:
         """Returns the model's inference params."""
@@ -0,0 +1,570 @@
+import importlib.util
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import IO, Iterator, Optional, Union
+
+import imageio.v3 as iio
+import imageio_ffmpeg  # type: ignore
+import numpy as np
+from PIL import Image
+
+from ilens.server.logger import CustomLogger
+from ilens.server.utils import getenv
+
+decoder_logger = CustomLogger("VideoDecoder").get_logger()
+
+# containers whose index may live at the end of the file. ffmpeg needs
+# to seek to read them, so they are spilled to a temporary file instead
+# of being piped through stdin.
+SEEKABLE_CONTAINERS = {".mp4", ".m4v", ".mov", ".3gp"}
+
+# containers imageio's legacy ffmpeg plugin accepts
+LEGACY_CONTAINERS = {".mp4", ".mov", ".webm", ".mkv", ".avi", ".mpeg"}
+
+# decoders by preference. ffmpeg samples, scales and converts frames in
+# its own process and only sends small analysis frames over its pipe; it
+# stays ahead of pyav even when it has to spill a clip to disk. pyav and
+# imageio convert every frame to full-size RGB.
+DECODER_PREFERENCE = ["ffmpeg", "pyav", "imageio"]
+
+# decoders that can decode the keyframes of a clip on their own
+KEYFRAME_DECODERS = {"ffmpeg", "pyav"}
+
+# the number of bytes needed to recognise a container
+SNIFF_SIZE = 512
+
+# the longest time in seconds a wait for a clip chunk goes without
+# checking whether the decoding was cancelled
+CHUNK_POLL_INTERVAL = 0.1
+
+
+def get_ffmpeg_exe() -> str:
+    """Returns the ffmpeg binary, preferring the one installed on the node."""
+    return shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def sniff_container(head: bytes) -> Optional[str]:
+    """
+    Recognises a video container by its magic bytes.
+
+    Returns the container's dotted extension, or None if it is unknown.
+    """
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return ".webm" if b"webm" in head[:64] else ".mkv"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand == b"qt  ":
+            return ".mov"
+        if brand.startswith(b"3g"):
+            return ".3gp"
+        if brand in (b"M4V ", b"M4VH", b"M4VP"):
+            return ".m4v"
+        return ".mp4"
+    if head[4:8] in (b"moov", b"mdat", b"wide", b"free", b"skip"):
+        # quicktime files written without a file type box
+        return ".mov"
+    if head.startswith(b"OggS"):
+        return ".ogg"
+    if head.startswith(b"RIFF") and head[8:12] == b"AVI ":
+        return ".avi"
+    if head.startswith(b"FLV"):
+        return ".flv"
+    if head.startswith(b"\x00\x00\x01\xba"):
+        return ".mpeg"
+    if len(head) > 188 and head[0] == head[188] == 0x47:
+        return ".ts"
+    return None
+
+
+class ClipStream:
+    """
+    A clip that is uploaded in chunks while it is being decoded.
+
+    Chunks are handed to the decoder as they arrive. They are also kept
+    (still compressed) so the selected frame can be decoded again once
+    the upload is complete.
+    """
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        """Seconds to wait for the next chunk before giving up on the clip."""
+        self.size = 0
+        """The number of bytes received so far."""
+        self.truncated = False
+        """Whether reading stopped before the end of the clip."""
+        self._chunks: queue.Queue[Optional[bytes]] = queue.Queue()
+        self._buffer = bytearray()
+        self._started = threading.Event()
+
+    def write(self, chunk: bytes) -> None:
+        """Appends a chunk to the clip."""
+        self._buffer.extend(chunk)
+        self.size += len(chunk)
+        self._chunks.put(chunk)
+        self._started.set()
+
+    def close(self) -> None:
+        """Marks the end of the clip."""
+        self._chunks.put(None)
+        self._started.set()
+
+    def _wait_time(
+        self,
+        limit: float,
+        deadline: Optional[float],
+        cancelled: Optional[threading.Event],
+    ) -> float:
+        """
+        Returns how long the next wait may last, 0 when reading must
+        stop: at `limit`, at `deadline` or once `cancelled` is set.
+        """
+        if cancelled is not None and cancelled.is_set():
+            return 0.0
+        if deadline is not None:
+            limit = min(limit, deadline)
+        return max(0.0, min(limit - time.monotonic(), CHUNK_POLL_INTERVAL))
+
+    def peek(
+        self,
+        size: int,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> bytes:
+        """
+        Returns the start of the clip, waiting for the first chunk until
+        the chunk timeout, `deadline` or `cancelled`.
+        """
+        limit = time.monotonic() + self.timeout
+        while not self._started.is_set():
+            wait = self._wait_time(limit, deadline, cancelled)
+            if not wait:
+                break
+            self._started.wait(wait)
+        return bytes(self._buffer[:size])
+
+    def chunks(
+        self,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Iterator[bytes]:
+        """
+        Yields the chunks of the clip as they arrive.
+
+        Stops at the end of the clip, when no chunk arrives within the
+        chunk timeout, at `deadline` or once `cancelled` is set; in the
+        latter cases `truncated` is set.
+        """
+        limit = time.monotonic() + self.timeout
+        while True:
+            wait = self._wait_time(limit, deadline, cancelled)
+            if not wait:
+                if time.monotonic() >= limit:
+                    decoder_logger.warning("Timed out waiting for the next clip chunk")
+                self.truncated = True
+                return
+            try:
+                chunk = self._chunks.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                return
+            limit = time.monotonic() + self.timeout
+            yield chunk
+
+    def getvalue(self) -> bytes:
+        """Returns the chunks received so far."""
+        return bytes(self._buffer)
+
+
+VideoSource = Union[bytes, ClipStream]
+
+
+def _feed(
+    stdin: IO[bytes],
+    source: VideoSource,
+    deadline: Optional[float],
+    cancelled: Optional[threading.Event],
+) -> None:
+    """
+    Writes the clip to ffmpeg's stdin and closes it.
+
+    A clip stream is written until its end, `deadline` or `cancelled`.
+    """
+    try:
+        if isinstance(source, ClipStream):
+            for chunk in source.chunks(deadline, cancelled):
+                stdin.write(chunk)
+                stdin.flush()
+        else:
+            stdin.write(source)
+    except (BrokenPipeError, ValueError):
+        # ffmpeg exited early, e.g. after `-frames:v 1`
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _read_into(stream: IO[bytes], buffer: np.ndarray) -> bool:
+    """Fills `buffer` from `stream`. Returns False on a short read (EOF)."""
+    view = buffer.data.cast("B")
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])  # type: ignore[attr-defined]
+        if not n:
+            return False
+        filled += n
+    return True
+
+
+def _read_pgm_header(stream: IO[bytes]) -> Optional[tuple[int, int]]:
+    """
+    Reads the header of a binary PGM frame.
+
+    Returns the `(width, height)` of the frame, or None at the end of
+    the stream.
+    """
+    magic = stream.readline()
+    if not magic:
+        return None
+    if magic.strip() != b"P5":
+        raise RuntimeError(f"Unexpected ffmpeg output {magic[:16]!r}")
+    width, height = map(int, stream.readline().split())
+    stream.readline()  # the maximum value, 255
+    return width, height
+
+
+@dataclass
+class FFmpegPipeDecoder:
+    """
+    Decodes videos by piping them through an ffmpeg subprocess.
+
+    Sampling, scaling and grayscale conversion are done by ffmpeg's
+    filter graph, so only small analysis frames cross the pipe.
+    """
+
+    ffmpeg: str = field(
+        default_factory=lambda: getenv("FFMPEG_BINARY", None) or get_ffmpeg_exe()
+    )
+    """The ffmpeg binary."""
+
+    def _input_args(self, spill: Optional[IO[bytes]], keyframes: bool) -> list[str]:
+        # skipping is a hint some codecs (vp9) ignore, the `select`
+        # filter of `_sample_filters` drops what they still decode
+        skip = ["-skip_frame", "nokey"] if keyframes else []
+        if spill is not None:
+            return [*skip, "-i", spill.name]
+        return [*skip, "-i", "pipe:0"]
+
+    def _sample_filters(self, fps: Optional[float], keyframes: bool) -> list[str]:
+        if keyframes:
+            return ["select=eq(pict_type\\,I)"]
+        if fps:
+            return [f"fps={fps}"]
+        return []
+
+    def _spill(
+        self,
+        source: VideoSource,
+        extension: str,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Optional[IO[bytes]]:
+        """
+        Writes seek-only containers to a temporary file.
+
+        A streamed clip in such a container cannot be decoded before it
+        is complete, so this waits for the end of the upload, `deadline`
+        or `cancelled`.
+        """
+        if extension not in SEEKABLE_CONTAINERS:
+            return None
+        spill = tempfile.NamedTemporaryFile(suffix=extension)
+        if isinstance(source, ClipStream):
+            for chunk in source.chunks(deadline, cancelled):
+                spill.write(chunk)
+        else:
+            spill.write(source)
+        spill.flush()
+        return spill
+
+    def _popen(
+        self,
+        args: list[str],
+        source: VideoSource,
+        spill: Optional[IO[bytes]],
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> tuple[subprocess.Popen, Optional[threading.Thread]]:
+        decoder_logger.debug(f"Running ffmpeg {' '.join(args)}")
+        process = subprocess.Popen(
+            [self.ffmpeg, "-hide_banner", "-loglevel", "error", *args],
+            stdin=subprocess.PIPE if spill is None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        writer = None
+        if spill is None:
+            writer = threading.Thread(
+                target=_feed,
+                args=(process.stdin, source, deadline, cancelled),
+                daemon=True,
+            )
+            writer.start()
+        return process, writer
+
+    def _finish(
+        self,
+        process: subprocess.Popen,
+        writer: Optional[threading.Thread],
+        check: bool,
+    ) -> None:
+        if not check and process.poll() is None:
+            # the caller stopped reading early, ffmpeg is no longer needed
+            process.kill()
+        if writer is not None:
+            writer.join()
+        stderr = process.stderr.read()  # type: ignore[union-attr]
+        process.wait()
+        process.stdout.close()  # type: ignore[union-attr]
+        process.stderr.close()  # type: ignore[union-attr]
+        if check and process.returncode != 0:
+            raise RuntimeError(
+                f"ffmpeg exited with code {process.returncode}: "
+                f"{stderr.decode(errors='replace').strip()}"
+            )
+
+    def iter_gray_frames(
+        self,
+        source: VideoSource,
+        extension: str,
+        fps: Optional[float],
+        width: int,
+        height: int,
+        keyframes: bool = False,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        Yields `(index, frame)` for every frame sampled at `fps`.
+
+        With `keyframes`, only the keyframes of the clip are decoded and
+        `fps` is ignored. Frames are grayscale arrays scaled to fit
+        within `width x height`, keeping the clip's aspect ratio. The
+        same buffer is reused for every frame, so callers must copy a
+        frame to keep it.
+
+        `source` may be a `ClipStream`, in which case decoding starts
+        while the clip is still being uploaded. The upload is then read
+        until `deadline` or `cancelled`, and nothing is decoded when the
+        decoding is cancelled while a seek-only clip is being spilled.
+        """
+        filters = self._sample_filters(fps, keyframes)
+        filters.append(
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease:flags=area"
+        )
+        filters.append("format=gray")
+        spill = self._spill(source, extension, deadline, cancelled)
+        if cancelled is not None and cancelled.is_set():
+            if spill is not None:
+                spill.close()
+            return
+        # PGM frames carry their size, which depends on the aspect ratio
+        args = [
+            *self._input_args(spill, keyframes),
+            "-an",
+            "-vf",
+            ",".join(filters),
+            "-vsync",
+            "passthrough",
+            "-c:v",
+            "pgm",
+            "-f",
+            "image2pipe",
+            "pipe:1",
+        ]
+        process, writer = self._popen(args, source, spill, deadline, cancelled)
+        stdout: IO[bytes] = process.stdout  # type: ignore[assignment]
+        buffer: Optional[np.ndarray] = None
+        completed = False
+        try:
+            index = 0
+            while True:
+                size = _read_pgm_header(stdout)
+                if size is None:
+                    break
+                if buffer is None or buffer.shape != size[::-1]:
+                    buffer = np.empty(size[::-1], dtype=np.uint8)
+                if not _read_into(stdout, buffer):
+                    break
+                yield index, buffer
+                index += 1
+            completed = True
+        finally:
+            self._finish(process, writer, check=completed)
+            if spill is not None:
+                spill.close()
+
+    def read_frame(
+        self,
+        video_bytes: bytes,
+        extension: str,
+        index: int,
+        fps: Optional[float],
+        keyframes: bool = False,
+    ) -> np.ndarray:
+        """
+        Decodes a single frame at full resolution as an RGB array.
+
+        `index` is the position of the frame in the stream sampled at
+        `fps` (or in the source stream when `fps` is not set), or among
+        the keyframes with `keyframes`, as in `iter_gray_frames`.
+        """
+        filters = self._sample_filters(fps, keyframes)
+        filters.append(f"select=eq(n\\,{index})")
+        filters.append("format=rgb24")
+        spill = self._spill(video_bytes, extension)
+        args = [
+            *self._input_args(spill, keyframes),
+            "-an",
+            "-vf",
+            ",".join(filters),
+            "-frames:v",
+            "1",
+            "-c:v",
+            "bmp",
+            "-f",
+            "image2pipe",
+            "pipe:1",
+        ]
+        process, writer = self._popen(args, video_bytes, spill)
+        try:
+            output = process.stdout.read()  # type: ignore[union-attr]
+        finally:
+            self._finish(process, writer, check=False)
+            if spill is not None:
+                spill.close()
+        if not output:
+            raise RuntimeError(f"ffmpeg could not decode frame {index}")
+        return np.asarray(Image.open(BytesIO(output)).convert("RGB"))
+
+
+@dataclass
+class PyAVDecoder:
+    """
+    Decodes videos in-process with PyAV.
+
+    PyAV is optional; the decoder is only used when it is installed.
+    """
+
+    thread_type: str = field(default_factory=lambda: getenv("PYAV_THREAD_TYPE", "AUTO"))
+    """How PyAV spreads decoding over threads (AUTO, FRAME, SLICE or NONE)."""
+
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec("av") is not None
+
+    def iter_frames(
+        self, video_bytes: bytes, keyframes: bool = False
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        Yields `(index, frame)` for every frame as RGB arrays.
+
+        With `keyframes`, only the keyframes are decoded and converted.
+        """
+        import av  # type: ignore
+
+        with av.open(BytesIO(video_bytes)) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = self.thread_type
+            if keyframes:
+                # some codecs (vp9) still decode every frame
+                stream.codec_context.skip_frame = "NONKEY"
+            frames = container.decode(stream)
+            if keyframes:
+                frames = (frame for frame in frames if frame.key_frame)
+            for index, frame in enumerate(frames):
+                yield index, frame.to_ndarray(format="rgb24")
+
+
+@dataclass
+class ImageioDecoder:
+    """Decodes videos with imageio's legacy ffmpeg plugin."""
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    def iter_frames(
+        self, video_bytes: bytes, extension: str
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """Yields `(index, frame)` for every frame as RGB arrays."""
+        # naming the plugin skips imageio's probing of every installed plugin
+        frames = iio.imiter(video_bytes, plugin="FFMPEG", extension=extension)
+        yield from enumerate(frames)
+
+
+@dataclass
+class DecoderRegistry:
+    """
+    Picks the fastest available decoder for each container.
+
+    Availability is checked once, and the choice for each container is
+    cached.
+    """
+
+    ffmpeg: FFmpegPipeDecoder = field(default_factory=FFmpegPipeDecoder)
+    pyav: PyAVDecoder = field(default_factory=PyAVDecoder)
+    imageio: ImageioDecoder = field(default_factory=ImageioDecoder)
+    _available: dict[str, bool] = field(default_factory=dict, init=False, repr=False)
+    _choices: dict[tuple[str, str], str] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        self._available = {
+            "ffmpeg": bool(self.ffmpeg.ffmpeg),
+            "pyav": self.pyav.available(),
+            "imageio": self.imageio.available(),
+        }
+        decoder_logger.info(
+            "Available video decoders: "
+            + ", ".join(name for name, ok in self._available.items() if ok)
+        )
+
+    def available(self, name: str) -> bool:
+        return self._available.get(name, False)
+
+    def _supports(self, name: str, extension: str) -> bool:
+        if name == "imageio":
+            return extension in LEGACY_CONTAINERS
+        return True
+
+    def choose(self, extension: str, preferred: str = "auto") -> str:
+        """
+        Returns the decoder to use for a container.
+
+        `preferred` is used when it is available and supports the
+        container; otherwise decoders are tried by preference.
+        """
+        key = (extension, preferred)
+        choice = self._choices.get(key)
+        if choice is not None:
+            return choice
+        candidates = DECODER_PREFERENCE
+        if preferred != "auto":
+            candidates = [preferred, *candidates]
+        for name in candidates:
+            if self.available(name) and self._supports(name, extension):
+                decoder_logger.info(f"Decoding {extension} videos with {name}")
+                self._choices[key] = name
+                return name
+        raise ValueError(f"No video decoder available for {extension}")
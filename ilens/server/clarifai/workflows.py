@@ -2,7 +2,7 @@ from dataclasses import dataclass, field
 
 from clarifai_grpc.grpc.api.resources_pb2 import Input
 from clarifai_grpc.grpc.api.service_pb2 import PostWorkflowResultsRequest
-from ilens.server.clarifai.base import BaseWorkflow, Image, Text
+from ilens.server.clarifai.base import BaseWorkflow, Image, ImageProfile, Text
 from typing import Any, TypedDict
 from io import BytesIO
 from ilens.server.utils import getenv
@@ -22,6 +22,11 @@ class ClarifaiMultimodalToSpeechWF(BaseWorkflow[Text | Image, AudioResponse]):
     workflow_id: str = field(
         default_factory=lambda: getenv("CLARIFAI_MMTS_WORKFLOW_ID")
     )
+    image_profile: ImageProfile = field(
+        default_factory=lambda: ImageProfile.from_env(
+            "CLARIFAI_MMTS", max_width=1024, max_height=1024
+        )
+    )
 
     def _create_workflow_request(
         self, inputs: list[Input]
@@ -1,6 +1,9 @@
 import asyncio
+import hashlib
+import math
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Literal, TypedDict
+from typing import Any, Awaitable, Callable, Literal, Optional, TypedDict, TypeVar
 from uuid import uuid4
 from ilens.server.clarifai import ClarifaiTranscription
 from ilens.server.clarifai.base import Audio, Text
@@ -9,16 +12,61 @@ from ilens.server.clarifai.text_generation import (
     ClarifaiGPT4VAlternative,
 )
 from ilens.server.clarifai.workflows import ClarifaiMultimodalToSpeechWF
-from ilens.server.clarifai.image_processor import AsyncVideoProcessor
+from ilens.server.clarifai.image_processor import (
+    AsyncVideoProcessor,
+    SelectedFrame,
+    FrameSelection,
+)
+from ilens.server.clarifai.video_decoders import ClipStream
 from ilens.server.clarifai import (
     Image,
     ClarifaiImageRecognition,
     ClarifaiImageDetection,
 )
+from ilens.server.admission import LoadMonitor
+from ilens.server.audio import RESPONSE_FORMATS, AudioProcessor, PreparedAudio
+from ilens.server.cache import AsyncMemo
+from ilens.server.ratelimit import MemoryBuckets, RateLimiter, RedisBuckets
 from ilens.server.socket import server as sio
+from ilens.server.scheduler import PriorityLimiter, SessionScheduler
+from ilens.server.streaming import ChunkEmitter
+from ilens.server.tracking import AdaptiveSampler, ObstacleTracker
 from ilens.server.utils import timed
 from ilens.server.logger import CustomLogger
-from ilens.server.settings import SERVER_ID
+from ilens.server.settings import (
+    ADMISSION_CRITICAL_HEADROOM,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_LOOP_LAG,
+    ADMISSION_MAX_WAITING,
+    ADMISSION_RETRY_AFTER,
+    CLIP_CHUNK_TIMEOUT,
+    CLIP_MAX_SIZE,
+    CLIP_MAX_UPLOADS,
+    CLIP_UPLOAD_SLOTS,
+    CPU_SLOTS,
+    DETECT_STREAM_CHANGE_THRESHOLD,
+    DETECT_STREAM_MAX_INTERVAL,
+    DETECT_STREAM_MAX_MISSES,
+    DETECT_STREAM_MIN_INTERVAL,
+    DETECT_STREAM_MIN_IOU,
+    DETECT_STREAM_REFRESH,
+    DETECTION_FRAME_BUDGET,
+    EVENT_PRIORITIES,
+    FRAME_MEMO_SIZE,
+    FRAME_MEMO_TTL,
+    PRIORITY_AGING,
+    RATE_LIMIT_ADDRESS_FACTOR,
+    RATE_LIMIT_REDIS_URL,
+    RATE_LIMITS,
+    SCAN_DEADLINES,
+    SERVER_ID,
+    SESSION_QUEUE_SIZE,
+    SIMILARITY_THRESHOLDS,
+    SIMILARITY_TTL,
+    TRUSTED_PROXIES,
+    UPSTREAM_SLOTS,
+)
+from ilens.server.similarity import SimilarityCache
 import aiofiles  # type: ignore
 import aiofiles.os  # type: ignore
 
@@ -32,8 +80,65 @@ gpt4v = ClarifaiGPT4V()
 gpt4va = ClarifaiGPT4VAlternative()
 image_processor = AsyncVideoProcessor()
 image_detection = ClarifaiImageDetection()
+audio_processor = AudioProcessor()
+chunk_emitter = ChunkEmitter(sio)
+similarity_cache = SimilarityCache(SIMILARITY_TTL, SIMILARITY_THRESHOLDS)
+# selected frames, by (content hash, mimetype) of the clip or image. a
+# selection cut short by its budget is not kept for events without one
+frame_memo: AsyncMemo[tuple[str, str], SelectedFrame] = AsyncMemo(
+    FRAME_MEMO_SIZE, FRAME_MEMO_TTL, keep=lambda frame: not frame.timed_out
+)
 websocket_logger = CustomLogger("Websocket").get_logger()
 
+
+async def reject_queued(sid: str, name: str) -> None:
+    await sio.emit("queue-full", name, to=sid)
+
+
+# detections and recognitions are latest-wins per client, queries queue
+scheduler = SessionScheduler(
+    SESSION_QUEUE_SIZE, on_full=reject_queued, priorities=EVENT_PRIORITIES
+)
+# worker threads and Clarifai requests go to the most urgent event first
+cpu_limiter = PriorityLimiter("cpu", CPU_SLOTS, PRIORITY_AGING)
+upstream_limiter = PriorityLimiter("clarifai", UPSTREAM_SLOTS, PRIORITY_AGING)
+
+
+async def reject_busy(sid: str, busy: dict[str, Any]) -> None:
+    await sio.emit("busy", busy, to=sid)
+
+
+# new events are turned away with `busy` when the node is over capacity
+load_monitor = LoadMonitor(
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_WAITING,
+    ADMISSION_MAX_LOOP_LAG,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_CRITICAL_HEADROOM,
+    limiters=[cpu_limiter, upstream_limiter],
+    priorities=EVENT_PRIORITIES,
+    on_busy=reject_busy,
+)
+
+
+async def reject_limited(sid: str, limited: dict[str, Any]) -> None:
+    await sio.emit("rate-limited", limited, to=sid)
+
+
+# events over the client's rate are answered with `rate-limited` before
+# any of their data is decoded
+rate_limiter = RateLimiter(
+    RATE_LIMITS,
+    RATE_LIMIT_ADDRESS_FACTOR,
+    buckets=(
+        RedisBuckets(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryBuckets()
+    ),
+    on_limited=reject_limited,
+    proxies=TRUSTED_PROXIES,
+)
+
+T = TypeVar("T")
+
 # default base url, changes during runtime
 BASE_URL = "http://localhost:8000"
 
@@ -43,6 +148,37 @@ class resource(TypedDict):
     mimetype: str
 
 
+class clip_header(TypedDict):
+    request_id: str
+    mimetype: str
+    event: Literal["recognize", "detect", "scan"]
+
+
+class clip_data(TypedDict):
+    request_id: str
+    seq: int
+    raw: bytes
+
+
+class clip_footer(TypedDict):
+    request_id: str
+
+
+@dataclass
+class ClipUpload:
+    """A clip being uploaded in chunks, and the frame selection running on it."""
+
+    stream: ClipStream
+    selection: "asyncio.Task[FrameSelection]"
+    event: str
+    mimetype: str
+    next_seq: int = 0
+
+
+# clip uploads in progress, by (sid, request id)
+clip_uploads: dict[tuple[str, str], ClipUpload] = {}
+
+
 async def upload_file(content: bytes, filename: str, base_url: str):
     id = uuid4().hex[:8]
     location = BASE_DIR / "uploads" / f"{id}_{filename}"
@@ -62,35 +198,126 @@ async def connect(sid, environ):
     host = environ["HTTP_HOST"]
     scheme = environ["wsgi.url_scheme"]
     BASE_URL = f"{scheme}://{host}"
+    rate_limiter.connect(sid, environ)
     print(BASE_URL)
     websocket_logger.info(f"Connected {sid}")
     websocket_logger.info("Connected", sio.environ)
     await sio.emit("server-id", SERVER_ID, to=sid)
 
 
+async def in_thread(func: Callable[..., T], *args: Any) -> T:
+    """Runs blocking work on a worker thread once a CPU slot is granted."""
+    async with cpu_limiter.slot():
+        return await asyncio.to_thread(func, *args)
+
+
+async def content_key(raw: bytes, mimetype: str) -> tuple[str, str]:
+    """Returns the key of a clip or image in the frame memo."""
+    digest = await in_thread(hashlib.sha256, raw)
+    return digest.hexdigest(), mimetype
+
+
+async def prepare_selection(selection: Awaitable[FrameSelection]) -> SelectedFrame:
+    return await in_thread(image_processor.prepare_selection, await selection)
+
+
+async def encode_for(frame: SelectedFrame, model) -> bytes:
+    """Encodes the frame for the model's image profile."""
+    return await in_thread(image_processor.encode_for, frame, model.image_profile)
+
+
+async def select_clip_frame(
+    clip: resource, budget: Optional[float] = None
+) -> SelectedFrame:
+    """
+    Selects the best frame of a clip.
+
+    The result is memoized by the clip's content, so a clip sent to
+    several events is decoded once; concurrent requests for the same
+    clip share a single selection.
+    """
+    key = await content_key(clip["raw"], clip["mimetype"])
+
+    async def select() -> FrameSelection:
+        async with cpu_limiter.slot():
+            return await image_processor.select_frame(
+                clip["raw"], clip["mimetype"], budget
+            )
+
+    frame = await frame_memo.get(key, lambda: prepare_selection(select()))
+    if budget is None and frame.timed_out:
+        # shared with a selection that ran out of its budget
+        frame = await frame_memo.get(key, lambda: prepare_selection(select()))
+    return frame
+
+
+async def select_image_frame(image: resource) -> SelectedFrame:
+    """Decodes a still image. The result is memoized like clips."""
+    key = await content_key(image["raw"], "image")
+
+    async def select() -> FrameSelection:
+        async with cpu_limiter.slot():
+            return await image_processor.select_image([image["raw"]])
+
+    return await frame_memo.get(key, lambda: prepare_selection(select()))
+
+
+@timed.async_("Audio Analysis")
+async def prepare_audio(audio: resource) -> PreparedAudio:
+    """Checks the recording for speech and trims the silence around it."""
+    return await in_thread(audio_processor.prepare, audio["raw"], audio["mimetype"])
+
+
+async def send_recognition(sid, frame: SelectedFrame):
+    """Runs image recognition on the frame and sends the result."""
+    recognition = similarity_cache.lookup(sid, "recognize", frame.hash)
+    if recognition is not None:
+        websocket_logger.info("Reusing recognition of a similar frame")
+    else:
+        image_bytes = await encode_for(frame, image_recognition)
+        async with upstream_limiter.slot(), timed("Image Recognition"):
+            recognition = (
+                await image_recognition.run_async({"image": Image(base64=image_bytes)})
+            )[0]
+        similarity_cache.store(sid, "recognize", frame.hash, recognition)
+    await sio.emit(
+        "recognition",
+        recognition,
+        to=sid,
+    )
+
+
+async def send_detection(sid, frame: SelectedFrame):
+    """Runs obstacle detection on the frame and sends the warning."""
+    sentence = similarity_cache.lookup(sid, "detect", frame.hash)
+    if sentence is not None:
+        websocket_logger.info("Reusing detection of a similar frame")
+    else:
+        image_bytes = await encode_for(frame, image_detection)
+        async with upstream_limiter.slot(), timed("Image Detection"):
+            detection = await image_detection.run_async(
+                {"image": Image(base64=image_bytes)}
+            )
+        sentence = await in_thread(image_detection.construct_warning, detection[0])
+        similarity_cache.store(sid, "detect", frame.hash, sentence)
+    await sio.emit(
+        "detection",
+        sentence,
+        to=sid,
+    )
+
+
 @sio.event
+@rate_limiter.limit("recognize")
+@load_monitor.admit("recognize")
+@scheduler.latest("recognize")
 @timed.async_("Handle Recognition")
 async def recognize(sid, clip: resource):
     websocket_logger.info("Clip processing began")
     try:
         async with timed("Image Selection For Recognizer"):
-            best_frame = await image_processor.process_video(
-                clip["raw"], clip["mimetype"]
-            )
-            image_bytes = await asyncio.to_thread(
-                image_processor.convert_result_image_to_bytes, best_frame
-            )
-        recognition = (
-            await asyncio.to_thread(
-                timed("Image Recognition")(image_recognition.run),
-                {"image": Image(base64=image_bytes)},
-            )
-        )[0]
-        await sio.emit(
-            "recognition",
-            recognition,
-            to=sid,
-        )
+            frame = await select_clip_frame(clip)
+        await send_recognition(sid, frame)
     except Exception as e:
         websocket_logger.error("WebsocketError", exc_info=True)
         raise e
@@ -98,29 +325,384 @@ async def recognize(sid, clip: resource):
 
 
 @sio.event
+@rate_limiter.limit("recognize")
+@load_monitor.admit("recognize")
+@scheduler.latest("recognize")
+@timed.async_("Handle Image Recognition")
+async def recognize_image(sid, image: resource):
+    websocket_logger.info("Image processing began")
+    try:
+        async with timed("Image Decoding For Recognizer"):
+            frame = await select_image_frame(image)
+        await send_recognition(sid, frame)
+    except Exception as e:
+        websocket_logger.error("WebsocketError", exc_info=True)
+        raise e
+    websocket_logger.info("Image successfully processed")
+
+
+@sio.event
+@rate_limiter.limit("detect")
+@load_monitor.admit("detect")
+@scheduler.latest("detect")
 @timed.async_("Handle Detection")
 async def detect(sid, clip: resource):
     websocket_logger.info("Clip processing began")
     try:
         async with timed("Image Selection For Detector"):
-            best_frame = await image_processor.process_video(
-                clip["raw"], clip["mimetype"]
-            )
-            image_bytes = await asyncio.to_thread(
-                image_processor.convert_result_image_to_bytes, best_frame
-            )
-        detection = await asyncio.to_thread(
-            timed("Image Recognition")(image_detection.run),
-            {"image": Image(base64=image_bytes)},
-        )
-        sentence = await asyncio.to_thread(
-            image_detection.construct_warning, detection[0]
-        )
-        await sio.emit(
-            "detection",
-            sentence,
-            to=sid,
+            frame = await select_clip_frame(clip, DETECTION_FRAME_BUDGET)
+        await send_detection(sid, frame)
+    except Exception as e:
+        websocket_logger.error("WebsocketError", exc_info=True)
+        raise e
+    websocket_logger.info("Clip successfully processed")
+
+
+@sio.event
+@rate_limiter.limit("detect")
+@load_monitor.admit("detect")
+@scheduler.latest("detect")
+@timed.async_("Handle Image Detection")
+async def detect_image(sid, image: resource):
+    websocket_logger.info("Image processing began")
+    try:
+        async with timed("Image Decoding For Detector"):
+            frame = await select_image_frame(image)
+        await send_detection(sid, frame)
+    except Exception as e:
+        websocket_logger.error("WebsocketError", exc_info=True)
+        raise e
+    websocket_logger.info("Image successfully processed")
+
+
+async def send_within(
+    sid, name: str, send: Awaitable[None], deadline: Optional[float]
+) -> None:
+    """
+    Sends one result of a scan, unless it misses its deadline.
+
+    A result that misses its deadline is dropped and `scan-timeout` is
+    sent instead. Failures are logged without affecting other results.
+    """
+    try:
+        await asyncio.wait_for(send, deadline or None)
+    except asyncio.TimeoutError:
+        websocket_logger.info(f"Scan {name} missed its {deadline}s deadline")
+        await sio.emit("scan-timeout", name, to=sid)
+    except Exception:
+        websocket_logger.error("WebsocketError", exc_info=True)
+
+
+def scan_deadlines(deadlines: Any) -> Optional[dict[str, float]]:
+    """
+    Merges the deadlines a client sent for `scan` over `SCAN_DEADLINES`.
+
+    Returns None unless `deadlines` maps `detection` and `recognition`
+    to positive numbers of seconds.
+    """
+    if deadlines is None:
+        return SCAN_DEADLINES
+    if not isinstance(deadlines, dict) or not set(deadlines) <= set(SCAN_DEADLINES):
+        return None
+    merged = dict(SCAN_DEADLINES)
+    for name, deadline in deadlines.items():
+        if isinstance(deadline, bool):
+            return None
+        try:
+            merged[name] = float(deadline)
+        except (TypeError, ValueError):
+            return None
+        if not (math.isfinite(merged[name]) and merged[name] > 0):
+            return None
+    return merged
+
+
+async def send_scan(
+    sid, frame: SelectedFrame, deadlines: Optional[dict[str, float]] = None
+):
+    """Runs detection and recognition on the frame concurrently."""
+    deadlines = deadlines or SCAN_DEADLINES
+    await asyncio.gather(
+        send_within(
+            sid, "detection", send_detection(sid, frame), deadlines["detection"]
+        ),
+        send_within(
+            sid,
+            "recognition",
+            send_recognition(sid, frame),
+            deadlines["recognition"],
+        ),
+    )
+
+
+@sio.event
+@rate_limiter.limit("scan")
+@load_monitor.admit("scan")
+@scheduler.latest("scan")
+@timed.async_("Handle Scan")
+async def scan(sid, clip: resource, deadlines: Optional[dict[str, float]] = None):
+    """
+    Runs obstacle detection and image recognition on a single frame.
+
+    The frame is selected once. Both models run concurrently and each
+    result is sent as soon as it is ready, as `detection` and
+    `recognition`. `deadlines` overrides the per-result deadlines in
+    seconds; invalid deadlines are answered with `scan-error`.
+    """
+    limits = scan_deadlines(deadlines)
+    if limits is None:
+        return await sio.emit("scan-error", "invalid deadlines", to=sid)
+    websocket_logger.info("Clip processing began")
+    try:
+        async with timed("Image Selection For Scan"):
+            frame = await select_clip_frame(clip, DETECTION_FRAME_BUDGET)
+        await send_scan(sid, frame, limits)
+    except Exception as e:
+        websocket_logger.error("WebsocketError", exc_info=True)
+        raise e
+    websocket_logger.info("Clip successfully processed")
+
+
+@dataclass
+class DetectStream:
+    """A client's continuous detection, and the frames it pushed."""
+
+    sampler: AdaptiveSampler
+    tracker: ObstacleTracker
+    latest: Optional[resource] = None
+    """The last frame pushed since a frame was sampled."""
+    arrived: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional["asyncio.Task[None]"] = None
+    received: int = 0
+    sampled: int = 0
+    detected: int = 0
+    shed: int = 0
+    emitted: int = 0
+
+    def push(self, frame: resource) -> None:
+        """Keeps the frame, replacing the one not sampled yet."""
+        self.latest = frame
+        self.received += 1
+        self.arrived.set()
+
+    async def take(self) -> resource:
+        """Waits for a frame pushed since the last one was taken."""
+        await self.arrived.wait()
+        self.arrived.clear()
+        frame, self.latest = self.latest, None
+        assert frame is not None
+        return frame
+
+
+# continuous detections in progress, by sid
+detect_streams: dict[str, DetectStream] = {}
+
+
+async def sample_detect_stream(sid, stream: DetectStream, image: resource) -> None:
+    """Detects the sampled frame if the scene changed, and sends what changed."""
+    async with cpu_limiter.slot():
+        selection = await image_processor.select_image([image["raw"]])
+    # stream frames are not memoized: they are rarely sent twice and
+    # would push clips out of the memo
+    frame = await in_thread(image_processor.prepare_selection, selection)
+    stream.sampled += 1
+    if not stream.sampler.due(frame.hash):
+        return
+    if load_monitor.check("detect") is not None:
+        stream.shed += 1
+        return
+    image_bytes = await encode_for(frame, image_detection)
+    async with upstream_limiter.slot(), timed("Stream Detection"):
+        detection = await image_detection.run_async(
+            {"image": Image(base64=image_bytes)}
         )
+    stream.sampler.detected(frame.hash)
+    stream.detected += 1
+    if not stream.tracker.update(detection[0]):
+        return
+    sentence = await in_thread(
+        image_detection.construct_warning, stream.tracker.obstacles()
+    )
+    stream.emitted += 1
+    await sio.emit("detection", sentence, to=sid)
+
+
+async def run_detect_stream(sid, stream: DetectStream) -> None:
+    """Samples the client's frames until the stream is stopped."""
+    loop = asyncio.get_running_loop()
+    while True:
+        image = await stream.take()
+        sampled_at = loop.time()
+        try:
+            await sample_detect_stream(sid, stream, image)
+        except Exception:
+            websocket_logger.error("WebsocketError", exc_info=True)
+        pressure, _ = load_monitor.pressure()
+        interval = stream.sampler.next_interval(pressure)
+        await asyncio.sleep(max(0.0, sampled_at + interval - loop.time()))
+
+
+def stop_detect_stream(sid: str) -> None:
+    """Stops the client's continuous detection."""
+    stream = detect_streams.pop(sid, None)
+    if stream is None:
+        return
+    if stream.task is not None:
+        stream.task.cancel()
+    websocket_logger.info(
+        f"Detection stream of {sid} stopped: {stream.received} frames received,"
+        f" {stream.sampled} sampled, {stream.detected} detected,"
+        f" {stream.shed} shed, {stream.emitted} changes sent"
+    )
+
+
+@sio.on("detect-stream-start")
+@rate_limiter.limit("detect")
+@load_monitor.admit("detect")
+async def detect_stream_start(sid):
+    """
+    Starts continuous detection.
+
+    The client then pushes still images with `detect-frame` at its own
+    rate. Only the last frame pushed is kept: frames are sampled more
+    often while the scene changes and less often while it is still or
+    the node is loaded. Obstacles are tracked across detections and
+    `detection` is sent only when the near obstacles or their positions
+    change, with the warning for all of them.
+    """
+    stop_detect_stream(sid)
+    stream = DetectStream(
+        AdaptiveSampler(
+            DETECT_STREAM_MIN_INTERVAL,
+            DETECT_STREAM_MAX_INTERVAL,
+            DETECT_STREAM_REFRESH,
+            DETECT_STREAM_CHANGE_THRESHOLD,
+        ),
+        ObstacleTracker(DETECT_STREAM_MIN_IOU, DETECT_STREAM_MAX_MISSES),
+    )
+    stream.task = scheduler.spawn("detect", lambda: run_detect_stream(sid, stream))
+    detect_streams[sid] = stream
+    websocket_logger.info(f"Detection stream of {sid} started")
+
+
+@sio.on("detect-frame")
+async def detect_frame(sid, image: resource):
+    stream = detect_streams.get(sid)
+    if stream is None:
+        return await sio.emit("detect-stream-error", "stream not started", to=sid)
+    stream.push(image)
+
+
+@sio.on("detect-stream-stop")
+async def detect_stream_stop(sid):
+    stop_detect_stream(sid)
+
+
+CLIP_EVENTS: dict[str, Callable[[str, SelectedFrame], Awaitable[None]]] = {
+    "recognize": send_recognition,
+    "detect": send_detection,
+    "scan": send_scan,
+}
+
+
+def discard_upload(sid: str, request_id: str) -> None:
+    """Stops a clip upload and the frame selection running on it."""
+    upload = clip_uploads.pop((sid, request_id), None)
+    if upload is None:
+        return
+    upload.stream.close()
+    upload.selection.cancel()
+
+
+async def abort_upload(sid: str, request_id: str, error: str) -> None:
+    websocket_logger.info(f"Aborting clip upload {request_id}: {error}")
+    discard_upload(sid, request_id)
+    await sio.emit("clip-error", {"request_id": request_id, "error": error}, to=sid)
+
+
+async def select_upload(stream: ClipStream, mimetype: str) -> FrameSelection:
+    """
+    Selects the frame of a clip while it is uploaded.
+
+    The selection counts as in flight until the upload ends or stalls.
+    It mostly waits on the network, so it does not hold a CPU slot;
+    `CLIP_UPLOAD_SLOTS` bounds the uploads decoded at once instead.
+    """
+    with load_monitor.handling():
+        return await image_processor.select_frame(stream, mimetype)
+
+
+@sio.on("clip-begin")
+async def clip_begin(sid, header: clip_header):
+    """
+    Starts a chunked clip upload.
+
+    Frame selection starts right away and consumes the chunks as they
+    arrive; the result is sent once `clip-end` is received.
+    """
+    request_id = header["request_id"]
+    if header.get("event") not in CLIP_EVENTS:
+        return await abort_upload(sid, request_id, "unknown event")
+    if await rate_limiter.turn_away(sid, header["event"], request_id=request_id):
+        return
+    if await load_monitor.turn_away(sid, header["event"], request_id=request_id):
+        return
+    discard_upload(sid, request_id)
+    if sum(upload_sid == sid for upload_sid, _ in clip_uploads) >= CLIP_MAX_UPLOADS:
+        return await abort_upload(sid, request_id, "too many uploads")
+    if len(clip_uploads) >= CLIP_UPLOAD_SLOTS:
+        return await abort_upload(sid, request_id, "busy")
+    websocket_logger.info(f"Clip upload {request_id} began")
+    stream = ClipStream(timeout=CLIP_CHUNK_TIMEOUT)
+    selection = scheduler.spawn(
+        header["event"], lambda: select_upload(stream, header["mimetype"])
+    )
+    clip_uploads[(sid, request_id)] = ClipUpload(
+        stream, selection, header["event"], header["mimetype"]
+    )
+
+
+@sio.on("clip-chunk")
+async def clip_chunk(sid, chunk: clip_data):
+    request_id = chunk["request_id"]
+    upload = clip_uploads.get((sid, request_id))
+    if upload is None:
+        return await abort_upload(sid, request_id, "unknown request")
+    if chunk.get("seq", upload.next_seq) != upload.next_seq:
+        return await abort_upload(sid, request_id, "chunk out of order")
+    if upload.stream.size + len(chunk["raw"]) > CLIP_MAX_SIZE:
+        return await abort_upload(sid, request_id, "clip too large")
+    upload.stream.write(chunk["raw"])
+    upload.next_seq += 1
+
+
+@sio.on("clip-end")
+@timed.async_("Handle Clip Upload")
+async def clip_end(sid, footer: clip_footer):
+    request_id = footer["request_id"]
+    upload = clip_uploads.pop((sid, request_id), None)
+    if upload is None:
+        return await abort_upload(sid, request_id, "unknown request")
+    upload.stream.close()
+    websocket_logger.info(
+        f"Clip upload {request_id} ended after {upload.stream.size / 1024}KB"
+    )
+
+    async def pipeline():
+        try:
+            async with timed(f"Image Selection For Clip Upload ({upload.event})"):
+                # memoize the complete clip for events sent the same clip later
+                key = await content_key(upload.stream.getvalue(), upload.mimetype)
+                frame = await frame_memo.get(
+                    key, lambda: prepare_selection(upload.selection)
+                )
+        finally:
+            # on a memo hit the selection is not needed
+            upload.selection.cancel()
+        await CLIP_EVENTS[upload.event](sid, frame)
+
+    try:
+        await scheduler.run_latest(sid, upload.event, pipeline)
     except Exception as e:
         websocket_logger.error("WebsocketError", exc_info=True)
         raise e
@@ -128,13 +710,26 @@ async def detect(sid, clip: resource):
 
 
 @sio.event
+@rate_limiter.limit("query")
+@load_monitor.admit("query")
+@scheduler.queued("query")
 @timed.async_("Handle Query")
 async def query(
     sid,
     audio: resource,
     clip: resource,
     output_type: Literal["audio", "chunk", "text", "url"] = "audio",
+    output_format: Optional[Literal["wav", "opus", "aac", "mp3"]] = None,
 ):
+    """
+    Answers a spoken question about a clip.
+
+    The answer is sent as `text`, or as speech in `output_format` (the
+    server's default format when not given) for the `audio`, `chunk`
+    and `url` output types. `audio` and every `audio-chunk` carry the
+    mimetype of the speech as their last argument, as it is sent as WAV
+    when it cannot be transcoded.
+    """
     clip_raw = clip["raw"]
     clip_type = clip["mimetype"]
     clip_size = len(clip_raw) / 1024
@@ -150,26 +745,27 @@ async def query(
 
     @timed.async_("Image Selection For Query")
     async def get_image():
-        best_frame = await image_processor.process_video(clip_raw, clip_type)
-        image_bytes = await asyncio.to_thread(
-            image_processor.convert_result_image_to_bytes, best_frame
-        )
-        return image_bytes
+        frame = await select_clip_frame(clip)
+        return await encode_for(frame, llm_workflow)
 
     @timed.async_("Transcription")
-    async def get_transcript():
-        transcript = (
-            await asyncio.to_thread(
-                transcriber.run,
-                {
-                    "audio": Audio(base64=audio_raw),
-                },
-            )
-        )[0]["text"]
-        return transcript
+    async def get_transcript(speech: bytes):
+        async with upstream_limiter.slot():
+            outputs = await transcriber.run_async({"audio": Audio(base64=speech)})
+        return outputs[0]["text"]
 
+    # the frame is selected while the audio is checked and transcribed
+    image = asyncio.ensure_future(get_image())
     try:
-        image_bytes, transcript = await asyncio.gather(get_image(), get_transcript())
+        speech = await prepare_audio(audio)
+        if speech.verdict != "ok":
+            websocket_logger.info(
+                f"Audio rejected before transcription: {speech.verdict}"
+            )
+            return await sio.emit(speech.verdict, to=sid)
+        image_bytes, transcript = await asyncio.gather(
+            image, get_transcript(speech.audio)
+        )
         if not transcript:
             websocket_logger.info("No transcript found")
             return await sio.emit("no-audio", to=sid)
@@ -182,39 +778,58 @@ async def query(
         if output_type == "text":
             websocket_logger.info("Sending text")
             return await sio.emit("text", transcript, to=sid)
-        audio_stream = (
-            await asyncio.to_thread(
-                timed("MultiModal To Speech")(llm_workflow.run),
-                {
-                    "text": Text(raw=template.format(transcript=transcript)),
-                    "image": Image(base64=image_bytes),
-                },
-            )
-        )[0]["audio"]
+        async with upstream_limiter.slot(), timed("MultiModal To Speech"):
+            audio_stream = (
+                await llm_workflow.run_async(
+                    {
+                        "text": Text(raw=template.format(transcript=transcript)),
+                        "image": Image(base64=image_bytes),
+                    },
+                )
+            )[0]["audio"]
         audio_bytes = audio_stream.getvalue()
         websocket_logger.info(
             "Query successfully processed." f" Got {len(audio_bytes) / 1024}KB audio"
         )
+        format = audio_processor.response_format
+        if output_format in RESPONSE_FORMATS:
+            format = output_format
+        elif output_format is not None:
+            websocket_logger.warning(f"Unknown output format {output_format}")
+        async with timed(f"Audio Transcoding ({format})"):
+            audio_bytes, format = await in_thread(
+                audio_processor.transcode, audio_bytes, format
+            )
+        extension, mimetype, _ = RESPONSE_FORMATS[format]
         if output_type == "audio":
-            websocket_logger.info("Sending audio")
-            return await sio.emit("audio", audio_bytes, to=sid)
+            websocket_logger.info(f"Sending {mimetype} audio")
+            return await sio.emit(
+                "audio",
+                (audio_bytes, mimetype),
+                to=sid,
+                ignore_queue=chunk_emitter.is_local(sid),
+            )
         elif output_type == "chunk":
-            websocket_logger.info("Sending audio in chunks")
-            for i in range(0, len(audio_bytes), 1024):
-                await sio.emit("audio-chunk", audio_bytes[i : i + 1024], to=sid)
-            await asyncio.sleep(0.1)
-            await sio.emit("audio-chunk", b"", to=sid)
-            websocket_logger.info("Finished sending chunks")
+            websocket_logger.info(f"Sending {mimetype} audio in chunks")
+            chunks = await chunk_emitter.emit(
+                "audio-chunk", sid, audio_bytes, mimetype=mimetype
+            )
+            websocket_logger.info(f"Finished sending {chunks} chunks")
         elif output_type == "url":
             websocket_logger.info("Sending audio url")
-            url = await upload_file(audio_bytes, "query.wav", BASE_URL)
+            url = await upload_file(audio_bytes, f"query.{extension}", BASE_URL)
             await sio.emit("audio-url", url, to=sid)
     except Exception as e:
         websocket_logger.error("WebsocketError", exc_info=True)
         raise e
+    finally:
+        image.cancel()
 
 
 @sio.on("query_with_images")
+@rate_limiter.limit("query")
+@load_monitor.admit("query")
+@scheduler.queued("query")
 @timed.async_("Handle Query")
 async def query_with_images(
     sid,
@@ -233,29 +848,31 @@ async def query_with_images(
 
     @timed.async_("Image Selection For Query")
     async def get_image():
-        frames = [image_processor.bytes_to_ndarray(image["raw"]) for image in images]
-        gray_frames = [frame for frame in image_processor._grays_scale_image(frames)]
-        best_frame_index = image_processor._get_sharpest_frame(gray_frames)
-        best_frame = frames[best_frame_index]
-        image_bytes = await asyncio.to_thread(
-            image_processor.convert_result_image_to_bytes, best_frame
-        )
-        return image_bytes
+        async with cpu_limiter.slot():
+            selection = await image_processor.select_image(
+                [image["raw"] for image in images]
+            )
+        frame = await in_thread(image_processor.prepare_selection, selection)
+        return await encode_for(frame, gpt4va)
 
     @timed.async_("Transcription")
-    async def get_transcript():
-        transcript = (
-            await asyncio.to_thread(
-                transcriber.run,
-                {
-                    "audio": Audio(base64=audio_raw),
-                },
-            )
-        )[0]["text"]
-        return transcript
+    async def get_transcript(speech: bytes):
+        async with upstream_limiter.slot():
+            outputs = await transcriber.run_async({"audio": Audio(base64=speech)})
+        return outputs[0]["text"]
 
+    # the frame is selected while the audio is checked and transcribed
+    image = asyncio.ensure_future(get_image())
     try:
-        image_bytes, transcript = await asyncio.gather(get_image(), get_transcript())
+        speech = await prepare_audio(audio)
+        if speech.verdict != "ok":
+            websocket_logger.info(
+                f"Audio rejected before transcription: {speech.verdict}"
+            )
+            return await sio.emit(speech.verdict, to=sid)
+        image_bytes, transcript = await asyncio.gather(
+            image, get_transcript(speech.audio)
+        )
         if not transcript:
             websocket_logger.info("No transcript found")
             return await sio.emit("no-audio", to=sid)
@@ -266,22 +883,32 @@ async def query_with_images(
             websocket_logger.info("Transcript too short")
             return await sio.emit("short-audio", to=sid)
         print(f"image_bytes: {image_bytes[:10]}")
-        answer = (
-            await asyncio.to_thread(
-                gpt4va.run,
-                {
-                    "text": Text(raw=template.format(transcript=transcript)),
-                    "image": Image(base64=image_bytes),
-                },
-            )
-        )[0]["text"]
+        async with upstream_limiter.slot():
+            answer = (
+                await asyncio.to_thread(
+                    gpt4va.run,
+                    {
+                        "text": Text(raw=template.format(transcript=transcript)),
+                        "image": Image(base64=image_bytes),
+                    },
+                )
+            )[0]["text"]
         await sio.emit("text", answer, to=sid)
         websocket_logger.info("Query successfully processed.")
     except Exception as e:
         websocket_logger.error("WebsocketError", exc_info=True)
         raise e
+    finally:
+        image.cancel()
 
 
 @sio.event
 async def disconnect(sid):
+    for upload_sid, request_id in list(clip_uploads):
+        if upload_sid == sid:
+            discard_upload(sid, request_id)
+    scheduler.cancel(sid)
+    stop_detect_stream(sid)
+    similarity_cache.forget(sid)
+    rate_limiter.forget(sid)
     websocket_logger.info(f"Disconnected {sid}")
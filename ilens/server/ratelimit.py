@@ -0,0 +1,280 @@
+import ipaddress
+import time
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import Any, Awaitable, Callable, Iterable, Optional, Protocol, Union
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from ilens.server.logger import CustomLogger
+
+ratelimit_logger = CustomLogger("RateLimit").get_logger()
+
+# refills a bucket for the time since it was last used, then takes
+# `count` tokens if there are enough. returns the seconds until there are
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= count then
+  tokens = math.min(burst, tokens - count)
+else
+  wait = (count - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class Buckets(Protocol):
+    async def take(
+        self, key: str, rate: float, burst: float, count: float = 1
+    ) -> float:
+        """
+        Takes `count` tokens from the bucket at `key`. A negative count
+        gives tokens back.
+
+        Returns 0 when the tokens were taken, or the seconds until they
+        are available.
+        """
+
+
+@dataclass
+class MemoryBuckets:
+    """Token buckets kept in this process."""
+
+    max_size: int = 10_000
+    """The number of buckets above which full buckets are dropped."""
+    # tokens, when they were counted, and when the bucket will be full
+    _buckets: dict[str, tuple[float, float, float]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    def _prune(self, now: float) -> None:
+        """Drops buckets that have refilled; they are recreated full."""
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items() if bucket[2] > now
+        }
+
+    async def take(
+        self, key: str, rate: float, burst: float, count: float = 1
+    ) -> float:
+        now = time.monotonic()
+        tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= count:
+            tokens = min(burst, tokens - count)
+        else:
+            wait = (count - tokens) / rate
+        self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        if len(self._buckets) > self.max_size:
+            self._prune(now)
+        return wait
+
+    def forget(self, prefix: str) -> None:
+        for key in [key for key in self._buckets if key.startswith(prefix)]:
+            del self._buckets[key]
+
+
+@dataclass
+class RedisBuckets:
+    """
+    Token buckets shared by every worker through redis.
+
+    When redis cannot be reached, buckets fall back to this process.
+    """
+
+    url: str
+    """The redis url."""
+    prefix: str = "ilens:ratelimit:"
+    """The prefix of the bucket keys."""
+    fallback: MemoryBuckets = field(default_factory=MemoryBuckets)
+    _redis: aioredis.Redis = field(init=False, repr=False)
+    _take: Any = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._redis = aioredis.Redis.from_url(self.url)
+        self._take = self._redis.register_script(TAKE_SCRIPT)
+
+    async def take(
+        self, key: str, rate: float, burst: float, count: float = 1
+    ) -> float:
+        try:
+            wait = await self._take(keys=[self.prefix + key], args=[rate, burst, count])
+        except RedisError:
+            ratelimit_logger.warning("Redis unavailable, limiting locally")
+            return await self.fallback.take(key, rate, burst, count)
+        return float(wait)
+
+    def forget(self, prefix: str) -> None:
+        # redis expires idle buckets by itself
+        self.fallback.forget(prefix)
+
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def parse_networks(networks: Iterable[str]) -> list[Network]:
+    """Parses addresses and networks such as `10.0.0.0/8`."""
+    return [
+        ipaddress.ip_network(network.strip(), strict=False)
+        for network in networks
+        if network.strip()
+    ]
+
+
+def _within(address: str, networks: list[Network]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+
+def client_address(
+    peer: Optional[str], forwarded: Optional[str], proxies: list[Network]
+) -> Optional[str]:
+    """
+    Returns the address of the client behind the trusted proxies.
+
+    `forwarded` is the `X-Forwarded-For` header. It is only read when
+    the peer is one of `proxies`, since anyone else could forge it.
+    Every proxy appends the address it saw, so the client is the last
+    entry that is not a proxy.
+    """
+    if not peer or not forwarded or not _within(peer, proxies):
+        return peer
+    for address in reversed(forwarded.split(",")):
+        address = address.strip()
+        if address and not _within(address, proxies):
+            return address
+    return peer
+
+
+@dataclass
+class RateLimiter:
+    """
+    Limits how often each client may send each kind of event.
+
+    Every client has a token bucket per kind of event, and so does
+    every source address, with `address_factor` times the client's rate
+    and burst since several clients may share an address. An event
+    takes a token from both; when either is empty the event is rejected
+    and the token taken from the other is given back.
+    """
+
+    limits: dict[str, tuple[float, float]]
+    """The rate in events per second and the burst, by kind of event."""
+    address_factor: float
+    """How many clients' worth of events a source address may send."""
+    buckets: Buckets = field(default_factory=MemoryBuckets)
+    """Where the buckets are kept."""
+    proxies: list[str] = field(default_factory=list)
+    """The addresses or networks of the proxies trusted with `X-Forwarded-For`."""
+    on_limited: Optional[Callable[[str, dict[str, Any]], Awaitable[Any]]] = None
+    """Called with the client and the `rate-limited` payload of a rejected event."""
+    rejected: int = field(default=0, init=False)
+    _addresses: dict[str, str] = field(default_factory=dict, init=False, repr=False)
+    _proxies: list[Network] = field(default_factory=list, init=False, repr=False)
+
+    def __post_init__(self):
+        self._proxies = parse_networks(self.proxies)
+
+    def address(self, peer: Optional[str], forwarded: Optional[str]) -> Optional[str]:
+        """Returns the source address of a request from `peer`."""
+        return client_address(peer, forwarded, self._proxies)
+
+    def connect(self, sid: str, environ: dict[str, Any]) -> None:
+        """Remembers the client's source address."""
+        # the sanic driver of engineio reports 127.0.0.1 as REMOTE_ADDR
+        request = environ.get("sanic.request")
+        peer = request.ip if request is not None else environ.get("REMOTE_ADDR")
+        address = self.address(peer, environ.get("HTTP_X_FORWARDED_FOR"))
+        if address:
+            self._addresses[sid] = address
+
+    def forget(self, sid: str) -> None:
+        self._addresses.pop(sid, None)
+        forget = getattr(self.buckets, "forget", None)
+        if forget is not None:
+            forget(f"sid:{sid}:")
+
+    async def check(self, sid: str, name: str) -> Optional[dict[str, Any]]:
+        """Returns the `rate-limited` payload if an event must be rejected."""
+        rate, burst = self.limits.get(name, (0.0, 0.0))
+        if rate <= 0:
+            return None
+        key = f"sid:{sid}:{name}"
+        wait = await self.buckets.take(key, rate, burst)
+        address = self._addresses.get(sid)
+        if not wait and address:
+            wait = await self._take_address(address, name, rate, burst)
+            if wait:
+                await self.buckets.take(key, rate, burst, -1)
+        return self._limited(name, wait)
+
+    async def check_address(self, address: str, name: str) -> Optional[dict[str, Any]]:
+        """
+        Returns the `rate-limited` payload if a request that has no
+        client, such as an HTTP request, must be rejected.
+        """
+        rate, burst = self.limits.get(name, (0.0, 0.0))
+        if rate <= 0:
+            return None
+        return self._limited(name, await self._take_address(address, name, rate, burst))
+
+    async def _take_address(
+        self, address: str, name: str, rate: float, burst: float
+    ) -> float:
+        factor = self.address_factor
+        return await self.buckets.take(
+            f"ip:{address}:{name}", rate * factor, burst * factor
+        )
+
+    def _limited(self, name: str, wait: float) -> Optional[dict[str, Any]]:
+        if not wait:
+            return None
+        return {"event": name, "retry_after": round(wait, 2)}
+
+    async def turn_away(self, sid: str, name: str, **details: Any) -> bool:
+        """
+        Rejects an event if the client is over its rate.
+
+        The `rate-limited` payload, with `details` added, is passed to
+        `on_limited`. Returns whether the event was rejected.
+        """
+        limited = await self.check(sid, name)
+        if limited is None:
+            return False
+        self.rejected += 1
+        ratelimit_logger.info(
+            f"Rate limited {name} from {sid}"
+            f" (retry after {limited['retry_after']}s)"
+        )
+        if self.on_limited is not None:
+            await self.on_limited(sid, {**limited, **details})
+        return True
+
+    def limit(self, name: str):
+        """Decorates an event handler to reject it when over the rate."""
+
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(sid, *args, **kwargs):
+                if await self.turn_away(sid, name):
+                    return None
+                return await handler(sid, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
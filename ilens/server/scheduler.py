@@ -0,0 +1,291 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+from ilens.server.logger import CustomLogger
+
+scheduler_logger = CustomLogger("Scheduler").get_logger()
+
+T = TypeVar("T")
+
+# the priority of the event being handled. tasks started while handling
+# it inherit it, so limiters deep in a pipeline see the event's priority
+current_priority: ContextVar[int] = ContextVar("current_priority", default=0)
+
+
+class QueueFull(Exception):
+    """Raised when a client already has too many events of a kind waiting."""
+
+
+@dataclass
+class _Lane:
+    """The events of one kind from one client, which run one at a time."""
+
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    waiting: int = 0
+    closed: bool = False
+
+
+@dataclass
+class SessionScheduler:
+    """
+    Runs each client's event pipelines under a per-event policy.
+
+    With `latest`, a client has at most one pipeline of a kind running:
+    a new event cancels the pipeline it supersedes, since that result
+    would be stale. With `queued`, a client's events of a kind run one
+    at a time, with at most `queue_size` waiting; further events raise
+    `QueueFull`. Pipelines run in their own tasks, so cancelling one
+    never cancels the handler that started it.
+    """
+
+    queue_size: int
+    """The number of queued events a client may have waiting, per kind."""
+    on_full: Optional[Callable[[str, str], Awaitable[Any]]] = None
+    """Called with the client and the kind of an event rejected by `queued`."""
+    priorities: dict[str, int] = field(default_factory=dict)
+    """The priority of each kind of event's pipelines. Lower runs first."""
+    _latest: dict[tuple[str, str], "asyncio.Task[Any]"] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _lanes: dict[tuple[str, str], _Lane] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _tasks: dict[str, set["asyncio.Task[Any]"]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    async def _track(self, sid: str, task: "asyncio.Task[T]") -> T:
+        """Waits for a pipeline task, keeping it where `cancel` can reach it."""
+        tasks = self._tasks.setdefault(sid, set())
+        tasks.add(task)
+        try:
+            return await task
+        finally:
+            tasks.discard(task)
+            if not tasks and self._tasks.get(sid) is tasks:
+                del self._tasks[sid]
+
+    def spawn(
+        self, name: str, pipeline: Callable[[], Awaitable[T]]
+    ) -> "asyncio.Task[T]":
+        """Starts the pipeline in a task running at the event's priority."""
+        token = current_priority.set(self.priorities.get(name, 0))
+        try:
+            return asyncio.ensure_future(pipeline())
+        finally:
+            current_priority.reset(token)
+
+    async def run_latest(
+        self, sid: str, name: str, pipeline: Callable[[], Awaitable[T]]
+    ) -> Optional[T]:
+        """
+        Runs the pipeline, cancelling the client's previous `name` pipeline.
+
+        Returns None when the pipeline is superseded in turn, or when the
+        client disconnects.
+        """
+        key = (sid, name)
+        previous = self._latest.get(key)
+        if previous is not None and not previous.done():
+            scheduler_logger.info(f"Cancelling superseded {name} for {sid}")
+            previous.cancel()
+        task = self.spawn(name, pipeline)
+        self._latest[key] = task
+        try:
+            return await self._track(sid, task)
+        except asyncio.CancelledError:
+            if self._latest.get(key) is not task:
+                return None
+            raise
+        finally:
+            if self._latest.get(key) is task:
+                del self._latest[key]
+
+    async def run_queued(
+        self, sid: str, name: str, pipeline: Callable[[], Awaitable[T]]
+    ) -> Optional[T]:
+        """
+        Runs the pipeline after the client's other `name` pipelines.
+
+        Returns None when the client disconnects first.
+        """
+        key = (sid, name)
+        lane = self._lanes.setdefault(key, _Lane())
+        if lane.lock.locked() and lane.waiting >= self.queue_size:
+            raise QueueFull(f"{sid} already has {lane.waiting} {name} waiting")
+        lane.waiting += 1
+        try:
+            await lane.lock.acquire()
+        finally:
+            lane.waiting -= 1
+        try:
+            if lane.closed:
+                return None
+            return await self._track(sid, self.spawn(name, pipeline))
+        except asyncio.CancelledError:
+            if lane.closed:
+                return None
+            raise
+        finally:
+            lane.lock.release()
+            if not lane.waiting and self._lanes.get(key) is lane:
+                del self._lanes[key]
+
+    def latest(self, name: str):
+        """Decorates an event handler to run with `run_latest`."""
+
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(sid, *args, **kwargs):
+                return await self.run_latest(
+                    sid, name, lambda: handler(sid, *args, **kwargs)
+                )
+
+            return wrapper
+
+        return decorator
+
+    def queued(self, name: str):
+        """
+        Decorates an event handler to run with `run_queued`.
+
+        Rejected events are passed to `on_full`.
+        """
+
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(sid, *args, **kwargs):
+                try:
+                    return await self.run_queued(
+                        sid, name, lambda: handler(sid, *args, **kwargs)
+                    )
+                except QueueFull as e:
+                    scheduler_logger.info(f"Rejected {name}: {e}")
+                    if self.on_full is not None:
+                        await self.on_full(sid, name)
+
+            return wrapper
+
+        return decorator
+
+    def cancel(self, sid: str) -> None:
+        """Cancels every pipeline of the client and forgets the client."""
+        for task in self._tasks.pop(sid, set()):
+            task.cancel()
+        for key in [key for key in self._latest if key[0] == sid]:
+            del self._latest[key]
+        for key in [key for key in self._lanes if key[0] == sid]:
+            self._lanes.pop(key).closed = True
+
+
+@dataclass
+class QueueStats:
+    """How long work of one priority waited for a slot."""
+
+    granted: int = 0
+    """The number of slots granted."""
+    total_delay: float = 0.0
+    """The total time waited, in seconds."""
+    max_delay: float = 0.0
+    """The longest time waited, in seconds."""
+
+    def record(self, delay: float) -> None:
+        self.granted += 1
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+
+    @property
+    def mean_delay(self) -> float:
+        return self.total_delay / self.granted if self.granted else 0.0
+
+
+@dataclass
+class PriorityLimiter:
+    """
+    Limits how much work runs at once, granting free slots by priority.
+
+    Lower priorities are granted first. Waiting work is promoted by one
+    priority every `aging` seconds, so low priority work is delayed
+    under load but never starved. Queueing delay is recorded per
+    priority.
+    """
+
+    name: str
+    """A name for the limited resource, used in logs."""
+    slots: int
+    """The number of jobs that may run at once."""
+    aging: float
+    """The time in seconds after which waiting work is promoted."""
+    in_use: int = field(default=0, init=False)
+    stats: dict[int, QueueStats] = field(default_factory=dict, init=False)
+    _waiters: list[tuple[float, int, "asyncio.Future[None]"]] = field(
+        default_factory=list, init=False, repr=False
+    )
+    _order: Iterator[int] = field(
+        default_factory=itertools.count, init=False, repr=False
+    )
+
+    @property
+    def waiting(self) -> int:
+        """The number of jobs waiting for a slot."""
+        return sum(not future.done() for _, _, future in self._waiters)
+
+    def _release(self) -> None:
+        """Hands the slot to the most urgent waiter, or frees it."""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[int] = None) -> AsyncIterator[None]:
+        """
+        Holds a slot for the duration of the block.
+
+        `priority` defaults to the priority of the event being handled.
+        """
+        if priority is None:
+            priority = current_priority.get()
+        enqueued = time.monotonic()
+        if self.in_use < self.slots and not self.waiting:
+            self.in_use += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            # aging promotes every waiter at the same rate, so the order
+            # of two waiters never changes and a heap can keep it
+            urgency = enqueued + priority * self.aging
+            heapq.heappush(self._waiters, (urgency, next(self._order), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was handed over just before the cancellation
+                    self._release()
+                raise
+        delay = time.monotonic() - enqueued
+        self.stats.setdefault(priority, QueueStats()).record(delay)
+        if delay > self.aging:
+            scheduler_logger.info(
+                f"Priority {priority} work waited {delay:.2f}s for a {self.name} slot"
+            )
+        try:
+            yield
+        finally:
+            self._release()
@@ -1,5 +1,13 @@
-from ilens.server.utils import getboolenv, getenv, getintenv, loadenv
+from ilens.server.utils import (
+    getboolenv,
+    getenv,
+    getfloatenv,
+    getintenv,
+    getlistenv,
+    loadenv,
+)
 from socket import gethostname
+import os
 
 # load the environment variables from the env file if it exists
 loadenv()
@@ -53,6 +61,27 @@ SOCKET_PING_INTERVAL = getintenv("SOCKET_PING_INTERVAL", 25)
 # before disconnecting
 SOCKET_PING_TIMEOUT = getintenv("SOCKET_PING_TIMEOUT", 20)
 
+# the transports clients may use. when several workers share a port,
+# restrict this to `websocket`: a polling request may reach a worker
+# that does not own the session
+SOCKET_TRANSPORTS = getlistenv("SOCKET_TRANSPORTS", ["polling", "websocket"])
+
+# the socket.io packet format, `default` or `msgpack`. msgpack sends
+# events with binary fields as one frame instead of one frame per
+# field, but clients must use a msgpack parser too
+SOCKET_SERIALIZERS = ("default", "msgpack")
+SOCKET_SERIALIZER = getenv("SOCKET_SERIALIZER", "default")
+assert (
+    SOCKET_SERIALIZER in SOCKET_SERIALIZERS
+), f"Socket serializer {SOCKET_SERIALIZER} not supported."
+
+# the redis url of the message queue shared by every worker, e.g.
+# redis://localhost:6379/0. unset runs each worker on its own
+SOCKET_REDIS_URL = getenv("SOCKET_REDIS_URL", None)
+
+# the redis channel the workers exchange messages on
+SOCKET_REDIS_CHANNEL = getenv("SOCKET_REDIS_CHANNEL", "ilens")
+
 # the maximum allowed packet size in bytes
 _20MB = 20 * 1024 * 1024
 SOCKET_MAX_HTTP_BUFFER_SIZE = getintenv("SOCKET_BUFFER_SIZE", _20MB)
@@ -63,3 +92,161 @@ SOCKET_HTTP_COMPRESS = getboolenv("SOCKET_HTTP_COMPRESS", True)
 # the HTTP compression threshold in bytes. Below this value, packets will
 # not be compressed
 SOCKET_COMPRESSION_THRESHOLD = getintenv("SOCKET_COMPRESSION_THRESHOLD", 1024)
+
+# the time in seconds `detect` may spend selecting a frame before it
+# settles for the best frame found so far. 0 disables the budget
+DETECTION_FRAME_BUDGET = getfloatenv("DETECTION_FRAME_BUDGET", 1.0)
+
+# the maximum size in bytes of a clip uploaded in chunks
+CLIP_MAX_SIZE = getintenv("CLIP_MAX_SIZE", SOCKET_MAX_HTTP_BUFFER_SIZE)
+
+# the time in seconds to wait for the next chunk of a clip upload
+CLIP_CHUNK_TIMEOUT = getfloatenv("CLIP_CHUNK_TIMEOUT", 30.0)
+
+# the number of clip uploads a client may have in progress at once. each
+# one holds a worker thread while it is decoded
+CLIP_MAX_UPLOADS = getintenv("CLIP_MAX_UPLOADS", 2)
+
+# the time in seconds a recognition or detection result may be reused
+# for a frame that looks nearly identical
+SIMILARITY_TTL = getfloatenv("SIMILARITY_TTL", 10.0)
+
+# the maximum perceptual hash distance (out of 64 bits) at which two
+# frames count as the same scene, per event. negative disables reuse
+SIMILARITY_THRESHOLDS = {
+    "detect": getintenv("SIMILARITY_THRESHOLD_DETECT", 3),
+    "recognize": getintenv("SIMILARITY_THRESHOLD_RECOGNIZE", 6),
+}
+
+# the number of selected frames kept, by clip content, so the same clip
+# sent to several events is only decoded once. 0 disables the memo
+FRAME_MEMO_SIZE = getintenv("FRAME_MEMO_SIZE", 16)
+
+# the time in seconds a selected frame is kept
+FRAME_MEMO_TTL = getfloatenv("FRAME_MEMO_TTL", 60.0)
+
+# the time in seconds `scan` waits for each of its results before giving
+# up on it, by result. 0 disables the deadline
+SCAN_DEADLINES = {
+    "detection": getfloatenv("SCAN_DETECTION_DEADLINE", 0.0),
+    "recognition": getfloatenv("SCAN_RECOGNITION_DEADLINE", 0.0),
+}
+
+# the number of queries a client may have waiting while one of its
+# queries is being answered. further queries are rejected
+SESSION_QUEUE_SIZE = getintenv("SESSION_QUEUE_SIZE", 2)
+
+# the priority of each kind of event when worker threads or Clarifai
+# requests are contended. lower runs first
+EVENT_PRIORITIES = {
+    "detect": getintenv("PRIORITY_DETECT", 0),
+    "scan": getintenv("PRIORITY_SCAN", 0),
+    "recognize": getintenv("PRIORITY_RECOGNIZE", 1),
+    "query": getintenv("PRIORITY_QUERY", 2),
+    "batch": getintenv("PRIORITY_BATCH", 3),
+}
+
+# the time in seconds after which waiting work is promoted by one
+# priority, so queries are delayed under load but never starved
+PRIORITY_AGING = getfloatenv("PRIORITY_AGING", 2.0)
+
+# the number of jobs run on worker threads at once
+CPU_SLOTS = getintenv("CPU_SLOTS", os.cpu_count() or 4)
+
+# the number of Clarifai requests in flight at once
+UPSTREAM_SLOTS = getintenv("UPSTREAM_SLOTS", 16)
+
+# the number of clip uploads decoded at once, by all clients. uploads are
+# decoded on worker threads outside the CPU slots, as they mostly wait
+# on the network; this bound keeps slow uploads from crowding out the
+# other work
+CLIP_UPLOAD_SLOTS = getintenv("CLIP_UPLOAD_SLOTS", max(1, CPU_SLOTS // 2))
+
+# the number of events a node handles at once before it turns new ones
+# away with `busy`. 0 disables the limit
+ADMISSION_MAX_IN_FLIGHT = getintenv("ADMISSION_MAX_IN_FLIGHT", 64)
+
+# the number of jobs that may wait for a worker thread or a Clarifai
+# request before new events are turned away. 0 disables the limit
+ADMISSION_MAX_WAITING = getintenv("ADMISSION_MAX_WAITING", 4 * CPU_SLOTS)
+
+# the event loop lag in seconds at which new events are turned away.
+# 0 disables the limit
+ADMISSION_MAX_LOOP_LAG = getfloatenv("ADMISSION_MAX_LOOP_LAG", 0.25)
+
+# the time in seconds clients are told to wait before retrying when the
+# node is just at capacity. it grows with the load
+ADMISSION_RETRY_AFTER = getfloatenv("ADMISSION_RETRY_AFTER", 2.0)
+
+# how far over the limits the most urgent events (priority 0) are still
+# accepted, so detection keeps working after queries are turned away
+ADMISSION_CRITICAL_HEADROOM = getfloatenv("ADMISSION_CRITICAL_HEADROOM", 1.5)
+
+# the rate in events per second, and the burst, each client may send of
+# each kind of event before it is answered with `rate-limited`. a rate
+# of 0 disables the limit
+RATE_LIMITS = {
+    "detect": (
+        getfloatenv("RATE_LIMIT_DETECT", 5.0),
+        getfloatenv("RATE_BURST_DETECT", 10),
+    ),
+    "scan": (
+        getfloatenv("RATE_LIMIT_SCAN", 5.0),
+        getfloatenv("RATE_BURST_SCAN", 10),
+    ),
+    "recognize": (
+        getfloatenv("RATE_LIMIT_RECOGNIZE", 2.0),
+        getfloatenv("RATE_BURST_RECOGNIZE", 5),
+    ),
+    "query": (
+        getfloatenv("RATE_LIMIT_QUERY", 0.5),
+        getfloatenv("RATE_BURST_QUERY", 3),
+    ),
+    "batch": (
+        getfloatenv("RATE_LIMIT_BATCH", 0.2),
+        getfloatenv("RATE_BURST_BATCH", 2),
+    ),
+}
+
+# how many clients' worth of events a single source address may send,
+# since several clients may share an address
+RATE_LIMIT_ADDRESS_FACTOR = getfloatenv("RATE_LIMIT_ADDRESS_FACTOR", 4.0)
+
+# the redis url the rate limits are counted in, so every worker shares
+# them. unset counts them in each worker
+RATE_LIMIT_REDIS_URL = getenv("RATE_LIMIT_REDIS_URL", SOCKET_REDIS_URL)
+
+# the addresses or networks of the load balancers. the client address
+# they add to X-Forwarded-For is only trusted on requests coming from them
+TRUSTED_PROXIES = getlistenv("TRUSTED_PROXIES", [])
+
+# the shortest and longest time in seconds between the frames a
+# `detect-stream` samples. it samples faster while the scene changes and
+# slower while the scene is still or the node is loaded
+DETECT_STREAM_MIN_INTERVAL = getfloatenv("DETECT_STREAM_MIN_INTERVAL", 0.3)
+DETECT_STREAM_MAX_INTERVAL = getfloatenv("DETECT_STREAM_MAX_INTERVAL", 2.0)
+
+# the time in seconds after which a still scene is detected again
+DETECT_STREAM_REFRESH = getfloatenv("DETECT_STREAM_REFRESH", 5.0)
+
+# the perceptual hash distance (out of 64 bits) from the last detected
+# frame at which a sampled frame counts as a new scene
+DETECT_STREAM_CHANGE_THRESHOLD = getintenv("DETECT_STREAM_CHANGE_THRESHOLD", 4)
+
+# the overlap (intersection over union) at which obstacles in two
+# detections count as the same obstacle
+DETECT_STREAM_MIN_IOU = getfloatenv("DETECT_STREAM_MIN_IOU", 0.3)
+
+# the number of detections in a row an obstacle may be missing from
+# before it counts as gone
+DETECT_STREAM_MAX_MISSES = getintenv("DETECT_STREAM_MAX_MISSES", 1)
+
+# the number of images sent to Clarifai in each request of a batch
+BATCH_SIZE = getintenv("BATCH_SIZE", 32)
+
+# the number of files a batch may contain
+BATCH_MAX_FILES = getintenv("BATCH_MAX_FILES", 256)
+
+# the number of frames selected at once for batches, across every batch,
+# so batches leave worker threads for the socket events
+BATCH_CONCURRENCY = getintenv("BATCH_CONCURRENCY", max(1, CPU_SLOTS // 2))
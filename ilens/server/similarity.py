@@ -0,0 +1,168 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Generic, Hashable, Iterator, Optional, TypeVar
+
+import cv2
+import numpy as np
+
+T = TypeVar("T")
+
+
+def dhash(frame: np.ndarray, size: int = 8) -> int:
+    """
+    Computes the difference hash of a frame.
+
+    The frame is shrunk to a `(size + 1) x size` grayscale thumbnail and
+    every bit records whether a pixel is brighter than its right-hand
+    neighbour. Near-identical frames get hashes a few bits apart.
+    """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    thumbnail = np.asarray(
+        cv2.resize(frame, (size + 1, size), interpolation=cv2.INTER_AREA),
+        dtype=np.uint8,
+    )
+    bits = np.greater(thumbnail[:, 1:], thumbnail[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    """Returns the number of bits that differ between two hashes."""
+    return (a ^ b).bit_count()
+
+
+@dataclass
+class _Node(Generic[T]):
+    hash: int
+    value: T
+    expires: float
+    children: dict[int, "_Node[T]"] = field(default_factory=dict)
+
+
+@dataclass
+class SimilarityIndex(Generic[T]):
+    """
+    A BK-tree of perceptual hashes whose entries expire.
+
+    Expired entries are skipped by searches and dropped the next time
+    the tree is rebuilt.
+    """
+
+    ttl: float
+    """Seconds an entry stays valid."""
+    max_size: int = 1024
+    """The number of entries kept. The oldest entries are dropped first."""
+    _root: Optional[_Node[T]] = field(default=None, init=False, repr=False)
+    _size: int = field(default=0, init=False, repr=False)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _nodes(self) -> Iterator[_Node[T]]:
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def _insert(self, node: _Node[T]) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming(node.hash, current.hash)
+            child = current.children.get(distance)
+            if child is None:
+                current.children[distance] = node
+                return
+            current = child
+
+    def _rebuild(self, now: float) -> None:
+        nodes = sorted(
+            (node for node in self._nodes() if node.expires > now),
+            key=lambda node: node.expires,
+        )[-(self.max_size // 2) :]
+        self._root, self._size = None, 0
+        for node in nodes:
+            node.children = {}
+            self._insert(node)
+
+    def add(self, hash: int, value: T) -> None:
+        """Adds an entry to the index."""
+        now = time.monotonic()
+        if self._size >= self.max_size:
+            self._rebuild(now)
+        self._insert(_Node(hash, value, now + self.ttl))
+
+    def search(self, hash: int, threshold: int) -> Optional[T]:
+        """Returns the value of the closest live entry within `threshold` bits."""
+        now = time.monotonic()
+        best: Optional[_Node[T]] = None
+        best_distance = threshold + 1
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(hash, node.hash)
+            if distance < best_distance and node.expires > now:
+                best, best_distance = node, distance
+            for child_distance, child in node.children.items():
+                if abs(child_distance - distance) <= threshold:
+                    stack.append(child)
+        return best.value if best is not None else None
+
+
+@dataclass
+class SimilarityCache:
+    """
+    Reuses results computed for near-identical frames.
+
+    Results are looked up in the session's own index first, then in the
+    index shared by every session. Each event has its own indexes and
+    its own similarity threshold.
+    """
+
+    ttl: float
+    """Seconds a result stays reusable."""
+    thresholds: dict[str, int]
+    """The maximum hash distance per event. Events not listed are not cached."""
+    max_size: int = 1024
+    """The number of entries kept per index."""
+    _indexes: dict[Hashable, SimilarityIndex[Any]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    def _index(self, key: Hashable) -> SimilarityIndex[Any]:
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = SimilarityIndex(self.ttl, self.max_size)
+        return index
+
+    def lookup(self, sid: str, event: str, hash: int) -> Optional[Any]:
+        """Returns a result computed for a similar frame, if any."""
+        threshold = self.thresholds.get(event)
+        if threshold is None or threshold < 0:
+            return None
+        for key in ((sid, event), event):
+            index = self._indexes.get(key)
+            if index is None:
+                continue
+            result = index.search(hash, threshold)
+            if result is not None:
+                return result
+        return None
+
+    def store(self, sid: str, event: str, hash: int, result: Any) -> None:
+        """Stores the result computed for a frame."""
+        threshold = self.thresholds.get(event)
+        if threshold is None or threshold < 0:
+            return
+        self._index((sid, event)).add(hash, result)
+        self._index(event).add(hash, result)
+
+    def forget(self, sid: str) -> None:
+        """Drops the session's indexes."""
+        for key in list(self._indexes):
+            if isinstance(key, tuple) and key[0] == sid:
+                del self._indexes[key]
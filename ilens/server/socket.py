@@ -1,8 +1,18 @@
+from socketio.async_redis_manager import AsyncRedisManager
 from socketio.async_server import AsyncServer
 from ilens.server import settings
 import socket
 
+# workers share rooms and can emit to each other's clients through redis
+client_manager = None
+if settings.SOCKET_REDIS_URL:
+    client_manager = AsyncRedisManager(
+        settings.SOCKET_REDIS_URL, channel=settings.SOCKET_REDIS_CHANNEL
+    )
+
 server = AsyncServer(
+    client_manager=client_manager,
+    serializer=settings.SOCKET_SERIALIZER,
     async_mode=settings.SOCKET_ASYNC_MODE,
     cors_allowed_origins=settings.CORS_ALLOWED_ORIGINS,
     logger=settings.SOCKET_LOGGER,
@@ -14,6 +24,7 @@ server = AsyncServer(
     max_http_buffer_size=settings.SOCKET_MAX_HTTP_BUFFER_SIZE,
     http_compression=settings.SOCKET_HTTP_COMPRESS,
     compression_threshold=settings.SOCKET_COMPRESSION_THRESHOLD,
+    transports=settings.SOCKET_TRANSPORTS,
 )
 server.instrument(
     auth={
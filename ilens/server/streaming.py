@@ -0,0 +1,143 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, AsyncIterator, Optional, Union
+
+import socketio  # type: ignore
+
+from ilens.server.logger import CustomLogger
+from ilens.server.utils import getfloatenv, getintenv
+
+streaming_logger = CustomLogger("Streaming").get_logger()
+
+Streamable = Union[bytes, AsyncIterable[bytes]]
+
+
+@dataclass
+class ChunkEmitter:
+    """
+    Streams binary data to a client as numbered chunks.
+
+    Every chunk is sent as `(data, seq)`, or `(data, seq, mimetype)`
+    when the mimetype of the data is given, and the stream ends with an
+    empty chunk. Before each chunk the emitter checks how many packets
+    are still queued for the client; while the queue is above the high
+    watermark it waits for the transport to drain and shrinks the chunk
+    size, and while the queue is empty it grows it.
+    """
+
+    server: socketio.AsyncServer
+    chunk_size: int = field(
+        default_factory=lambda: getintenv("STREAM_CHUNK_SIZE", 16 * 1024)
+    )
+    """The size of the first chunk in bytes."""
+    min_chunk_size: int = field(
+        default_factory=lambda: getintenv("STREAM_MIN_CHUNK_SIZE", 4 * 1024)
+    )
+    """The smallest chunk size used on a congested connection."""
+    max_chunk_size: int = field(
+        default_factory=lambda: getintenv("STREAM_MAX_CHUNK_SIZE", 64 * 1024)
+    )
+    """The largest chunk size used on an idle connection."""
+    high_watermark: int = field(
+        default_factory=lambda: getintenv("STREAM_HIGH_WATERMARK", 8)
+    )
+    """The number of queued packets above which sending pauses."""
+    drain_timeout: float = field(
+        default_factory=lambda: getfloatenv("STREAM_DRAIN_TIMEOUT", 10.0)
+    )
+    """Seconds to wait for the queue to drain before sending anyway."""
+
+    def _queue_size(self, sid: str, namespace: str) -> Optional[int]:
+        """Returns the number of packets queued for the client, if known."""
+        eio_sid = self.server.manager.eio_sid_from_sid(sid, namespace)
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            return None
+        return socket.queue.qsize()
+
+    def is_local(self, sid: str, namespace: str = "/") -> bool:
+        """Returns whether the client is connected to this worker."""
+        eio_sid = self.server.manager.eio_sid_from_sid(sid, namespace)
+        return eio_sid in self.server.eio.sockets
+
+    async def _drain(self, sid: str, namespace: str) -> Optional[bool]:
+        """
+        Waits while the client's queue is above the high watermark.
+
+        Returns whether it had to wait, or None when the client is not
+        connected to this worker.
+        """
+        size = self._queue_size(sid, namespace)
+        if size is None:
+            return None
+        if size <= self.high_watermark:
+            return False
+        deadline = time.monotonic() + self.drain_timeout
+        while size is not None and size > self.high_watermark:
+            if time.monotonic() >= deadline:
+                streaming_logger.warning(f"Queue for {sid} did not drain in time")
+                break
+            await asyncio.sleep(0.01)
+            size = self._queue_size(sid, namespace)
+        return True
+
+    async def _pieces(self, source: Streamable) -> AsyncIterator[bytes]:
+        if isinstance(source, bytes):
+            yield source
+            return
+        async for piece in source:
+            yield piece
+
+    async def emit(
+        self,
+        event: str,
+        sid: str,
+        source: Streamable,
+        namespace: str = "/",
+        mimetype: Optional[str] = None,
+    ) -> int:
+        """
+        Streams `source` to the client and returns the number of chunks.
+
+        `source` may be the complete data or an async iterable producing
+        it; chunks are sent as soon as enough data has been produced.
+        """
+        seq = 0
+        size = self.chunk_size
+        pending = b""
+        extra = (mimetype,) if mimetype else ()
+        local = self.is_local(sid, namespace)
+
+        async def send(chunk: bytes) -> None:
+            nonlocal seq, size
+            waited = await self._drain(sid, namespace)
+            if waited:
+                size = max(self.min_chunk_size, size // 2)
+            elif waited is False and self._queue_size(sid, namespace) == 0:
+                size = min(self.max_chunk_size, size * 2)
+            await self.server.emit(
+                event,
+                (chunk, seq, *extra),
+                to=sid,
+                namespace=namespace,
+                ignore_queue=local,
+            )
+            seq += 1
+
+        async for piece in self._pieces(source):
+            pending = pending + piece if pending else piece
+            # packets are only recognised as binary when they hold bytes, so
+            # every chunk is sliced out of the pending data once
+            start = 0
+            while len(pending) - start >= size:
+                chunk = pending[start : start + size]
+                start += len(chunk)
+                await send(chunk)
+            pending = pending[start:]
+        if pending:
+            await send(pending)
+        await self.server.emit(
+            event, (b"", seq, *extra), to=sid, namespace=namespace, ignore_queue=local
+        )
+        return seq
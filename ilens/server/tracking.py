@@ -0,0 +1,164 @@
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from ilens.server.clarifai.image_processing import LocationInfo, ObstacleInfo
+from ilens.server.similarity import hamming
+
+
+def iou(a: LocationInfo, b: LocationInfo) -> float:
+    """Returns the intersection over union of two bounding boxes."""
+    width = min(a["right"], b["right"]) - max(a["left"], b["left"])
+    height = min(a["bottom"], b["bottom"]) - max(a["top"], b["top"])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (a["right"] - a["left"]) * (a["bottom"] - a["top"])
+    area_b = (b["right"] - b["left"]) * (b["bottom"] - b["top"])
+    return intersection / (area_a + area_b - intersection)
+
+
+@dataclass
+class AdaptiveSampler:
+    """
+    Decides how often a stream of frames is sampled, and which samples
+    are worth a detection.
+
+    A sample is compared with the last detected frame through their
+    perceptual hashes. While the scene changes, frames are sampled every
+    `min_interval` and detected; while it is still, the interval grows
+    towards `max_interval` and detection only runs every `refresh`
+    seconds. The interval also grows with the load of the node.
+    """
+
+    min_interval: float
+    """The time in seconds between samples while the scene changes."""
+    max_interval: float
+    """The time in seconds between samples while the scene is still."""
+    refresh: float
+    """The time in seconds after which a still scene is detected again."""
+    threshold: int
+    """The hash distance from the last detected frame that counts as a change."""
+    backoff: float = 1.5
+    """How much the interval grows with every still sample."""
+    interval: float = field(init=False)
+    _reference: Optional[int] = field(default=None, init=False, repr=False)
+    _detected_at: float = field(default=float("-inf"), init=False, repr=False)
+
+    def __post_init__(self):
+        self.interval = self.min_interval
+
+    def due(self, hash: int) -> bool:
+        """Returns whether a sampled frame should be detected."""
+        changed = (
+            self._reference is None or hamming(hash, self._reference) > self.threshold
+        )
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return changed or time.monotonic() - self._detected_at >= self.refresh
+
+    def detected(self, hash: int) -> None:
+        """Records that the frame was detected."""
+        self._reference = hash
+        self._detected_at = time.monotonic()
+
+    def next_interval(self, pressure: float) -> float:
+        """
+        Returns the time until the next sample.
+
+        `pressure` is the load of the node relative to its capacity.
+        """
+        return min(self.max_interval, self.interval * (1 + max(0.0, pressure)))
+
+
+@dataclass
+class Track:
+    """An obstacle followed across detections."""
+
+    id: int
+    obstacle: ObstacleInfo
+    """The obstacle as last detected."""
+    misses: int = 0
+    """The number of detections in a row the obstacle was missing from."""
+
+
+@dataclass
+class ObstacleTracker:
+    """
+    Follows obstacles across detections and tells when they changed.
+
+    An obstacle is matched with the track of the same name whose box
+    overlaps it the most. A track is kept through `max_misses` missing
+    detections, so an obstacle the model misses once does not disappear
+    and reappear. The obstacles changed when their names, positions or
+    distances did; moving within the same position does not count.
+    """
+
+    min_iou: float
+    """The overlap at which two boxes count as the same obstacle."""
+    max_misses: int
+    """The number of detections an obstacle may be missing from."""
+    tracks: list[Track] = field(default_factory=list, init=False)
+    _ids: Iterator[int] = field(default_factory=itertools.count, init=False, repr=False)
+    _reported: tuple[tuple[str, str, str], ...] = field(
+        default=(), init=False, repr=False
+    )
+
+    def _match(self, obstacles: list[ObstacleInfo]) -> list[Optional[Track]]:
+        """Returns the track of each obstacle, matching the best overlaps first."""
+        pairs = sorted(
+            (
+                (iou(track.obstacle["location"], obstacle["location"]), i, j)
+                for i, track in enumerate(self.tracks)
+                for j, obstacle in enumerate(obstacles)
+                if track.obstacle["name"] == obstacle["name"]
+            ),
+            reverse=True,
+        )
+        matches: list[Optional[Track]] = [None] * len(obstacles)
+        matched: set[int] = set()
+        for overlap, i, j in pairs:
+            if overlap < self.min_iou:
+                break
+            if i in matched or matches[j] is not None:
+                continue
+            matches[j] = self.tracks[i]
+            matched.add(i)
+        return matches
+
+    def update(self, obstacles: list[ObstacleInfo]) -> bool:
+        """Adds a detection. Returns whether the obstacles changed."""
+        matches = self._match(obstacles)
+        seen = {id(track) for track in matches if track is not None}
+        tracks = []
+        for track in self.tracks:
+            if id(track) not in seen:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            tracks.append(track)
+        for obstacle, match in zip(obstacles, matches):
+            if match is None:
+                tracks.append(Track(next(self._ids), obstacle))
+            else:
+                match.obstacle, match.misses = obstacle, 0
+        self.tracks = tracks
+        state = tuple(
+            sorted(
+                (
+                    track.obstacle["name"],
+                    track.obstacle["position"],
+                    track.obstacle["distance"],
+                )
+                for track in tracks
+            )
+        )
+        changed, self._reported = state != self._reported, state
+        return changed
+
+    def obstacles(self) -> list[ObstacleInfo]:
+        """Returns the obstacles being tracked."""
+        return [track.obstacle for track in self.tracks]
@@ -0,0 +1,106 @@
+import io
+import unittest
+import wave
+from unittest import mock
+
+import numpy as np
+
+from ilens.server.audio import AudioProcessor
+
+RATE = 16000
+
+
+def recording(duration: float, speech: tuple[float, float] = (0, 0)) -> np.ndarray:
+    """Returns quiet noise with a loud tone between the `speech` times."""
+    rng = np.random.default_rng(0)
+    pcm = rng.normal(0, 30, int(duration * RATE))
+    start, end = (int(t * RATE) for t in speech)
+    t = np.arange(end - start) / RATE
+    pcm[start:end] += 8000 * np.sin(2 * np.pi * 220 * t)
+    return pcm.astype(np.int16)
+
+
+def processor(**options) -> AudioProcessor:
+    options = {
+        "enabled": True,
+        "sample_rate": RATE,
+        "frame_ms": 30,
+        "silence_threshold": -45.0,
+        "noise_margin": 10.0,
+        "padding": 0.25,
+        "min_speech": 0.4,
+        "max_speech": 30.0,
+        "codec": "wav",
+        "ffmpeg": "ffmpeg",
+        **options,
+    }
+    return AudioProcessor(**options)
+
+
+class DetectSpeechTest(unittest.TestCase):
+    def test_finds_the_speech_with_padding(self):
+        analysis = processor().detect_speech(recording(3, speech=(1.0, 2.0)))
+        self.assertAlmostEqual(analysis.duration, 3.0)
+        self.assertAlmostEqual(analysis.speech, 1.0, delta=0.06)
+        self.assertAlmostEqual(analysis.start, 0.75, delta=0.03)
+        self.assertAlmostEqual(analysis.end, 2.25, delta=0.03)
+
+    def test_padding_stays_within_the_recording(self):
+        audio = processor()
+        self.assertEqual(
+            audio.detect_speech(recording(2, speech=(0.0, 0.5))).start, 0.0
+        )
+        self.assertEqual(audio.detect_speech(recording(2, speech=(1.5, 2.0))).end, 2.0)
+
+    def test_constant_sound_is_not_speech(self):
+        analysis = processor().detect_speech(recording(1, speech=(0.0, 1.0)))
+        self.assertEqual(analysis.speech, 0.0)
+
+    def test_silence_has_no_speech(self):
+        analysis = processor().detect_speech(recording(2))
+        self.assertEqual(analysis.speech, 0.0)
+
+    def test_recordings_shorter_than_a_frame(self):
+        analysis = processor().detect_speech(recording(0.01, speech=(0, 0.01)))
+        self.assertEqual(analysis.speech, 0.0)
+
+
+class PrepareTest(unittest.TestCase):
+    def prepare(self, pcm: np.ndarray, **options):
+        audio = processor(**options)
+        with mock.patch.object(audio, "decode", return_value=pcm):
+            return audio.prepare(b"recording", "audio/webm")
+
+    def test_speech_is_trimmed(self):
+        prepared = self.prepare(recording(3, speech=(1.0, 2.0)))
+        self.assertEqual(prepared.verdict, "ok")
+        self.assertEqual(prepared.mimetype, "audio/wav")
+        with wave.open(io.BytesIO(prepared.audio)) as trimmed:
+            self.assertAlmostEqual(trimmed.getnframes() / RATE, 1.5, delta=0.06)
+
+    def test_rejected_recordings(self):
+        self.assertEqual(self.prepare(recording(2)).verdict, "no-audio")
+        self.assertEqual(
+            self.prepare(recording(2, speech=(1.0, 1.2))).verdict, "short-audio"
+        )
+        self.assertEqual(
+            self.prepare(recording(3, speech=(0.5, 2.5)), max_speech=1.0).verdict,
+            "long-audio",
+        )
+
+    def test_recordings_are_sent_as_is_without_a_codec(self):
+        prepared = self.prepare(recording(3, speech=(1.0, 2.0)), codec="none")
+        self.assertEqual(
+            (prepared.verdict, prepared.audio, prepared.mimetype),
+            ("ok", b"recording", "audio/webm"),
+        )
+
+    def test_undecodable_recordings_are_passed_through(self):
+        audio = processor()
+        with mock.patch.object(audio, "decode", side_effect=RuntimeError("bad")):
+            prepared = audio.prepare(b"recording", "audio/webm")
+        self.assertEqual((prepared.verdict, prepared.audio), ("ok", b"recording"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from ilens.server.cache import AsyncMemo
+
+
+class AsyncMemoTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one_computation(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(max_size=4, ttl=60)
+        calls = 0
+        release = asyncio.Event()
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return 42
+
+        waiters = [asyncio.ensure_future(memo.get("a", compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await asyncio.gather(*waiters), [42, 42, 42])
+        self.assertEqual(calls, 1)
+        self.assertEqual((memo.hits, memo.misses), (2, 1))
+
+    async def test_results_are_memoized_until_they_expire(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(max_size=4, ttl=10)
+        compute = mock.AsyncMock(side_effect=[1, 2])
+        with mock.patch("ilens.server.cache.time.monotonic", return_value=0):
+            self.assertEqual(await memo.get("a", compute), 1)
+        with mock.patch("ilens.server.cache.time.monotonic", return_value=9):
+            self.assertEqual(await memo.get("a", compute), 1)
+        with mock.patch("ilens.server.cache.time.monotonic", return_value=10):
+            self.assertEqual(await memo.get("a", compute), 2)
+        self.assertEqual(compute.await_count, 2)
+
+    async def test_least_recently_used_results_are_dropped(self):
+        memo: AsyncMemo[str, str] = AsyncMemo(max_size=2, ttl=60)
+        for key in ("a", "b"):
+            await memo.get(key, mock.AsyncMock(return_value=key))
+        await memo.get("a", mock.AsyncMock())
+        await memo.get("c", mock.AsyncMock(return_value="c"))
+        self.assertEqual(list(memo._entries), ["a", "c"])
+
+    async def test_failures_are_not_memoized(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(max_size=4, ttl=60)
+        compute = mock.AsyncMock(side_effect=[ValueError("bad clip"), 1])
+        with self.assertRaises(ValueError):
+            await memo.get("a", compute)
+        self.assertEqual(await memo.get("a", compute), 1)
+
+    async def test_results_that_are_not_kept_are_only_shared(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(
+            max_size=4, ttl=60, keep=lambda value: value > 0
+        )
+        compute = mock.AsyncMock(side_effect=[0, 0, 1])
+        self.assertEqual(
+            await asyncio.gather(memo.get("a", compute), memo.get("a", compute)),
+            [0, 0],
+        )
+        self.assertEqual(await memo.get("a", compute), 0)
+        self.assertEqual(await memo.get("a", compute), 1)
+        self.assertEqual(await memo.get("a", compute), 1)
+        self.assertEqual(compute.await_count, 3)
+
+    async def test_computation_runs_while_a_caller_waits(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(max_size=4, ttl=60)
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return 1
+
+        first = asyncio.ensure_future(memo.get("a", compute))
+        second = asyncio.ensure_future(memo.get("a", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await second, 1)
+        self.assertTrue(first.cancelled())
+
+    async def test_computation_is_cancelled_with_its_last_caller(self):
+        memo: AsyncMemo[str, int] = AsyncMemo(max_size=4, ttl=60)
+        cancelled = asyncio.Event()
+
+        async def compute():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return 1
+
+        callers = [asyncio.ensure_future(memo.get("a", compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        self.assertFalse(memo._pending)
+        self.assertFalse(memo._entries)
+
+
+if __name__ == "__main__":
+    unittest.main()
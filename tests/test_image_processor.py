@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+import unittest
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from ilens.server.clarifai.image_processor import AsyncVideoProcessor, MotionFilter
+from tests.test_video_decoders import render_clip
+
+
+class MotionFilterTest(unittest.TestCase):
+    def frame(self, value: int) -> np.ndarray:
+        return np.full((48, 64), value, dtype=np.uint8)
+
+    def test_near_duplicates_are_skipped_and_motion_rejected(self):
+        motion_filter = MotionFilter(still_threshold=2, motion_threshold=40)
+        decisions = [
+            motion_filter.should_score(self.frame(value)) for value in (0, 1, 10, 100)
+        ]
+        self.assertEqual(decisions, [True, False, True, False])
+        self.assertEqual((motion_filter.skipped, motion_filter.rejected), (1, 1))
+
+    def test_duplicates_are_measured_from_the_last_scored_frame(self):
+        motion_filter = MotionFilter(still_threshold=2, motion_threshold=0)
+        decisions = [motion_filter.should_score(self.frame(v)) for v in (0, 1, 2)]
+        self.assertEqual(decisions, [True, False, True])
+
+    def test_colour_frames(self):
+        motion_filter = MotionFilter(still_threshold=2, motion_threshold=40)
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        self.assertTrue(motion_filter.should_score(frame))
+        self.assertFalse(motion_filter.should_score(frame))
+
+
+class DecodeImageTest(unittest.TestCase):
+    def test_photos_are_turned_upright(self):
+        # stored sideways: red on the left, blue on the right
+        image = Image.new("RGB", (40, 20), (0, 0, 255))
+        image.paste((255, 0, 0), (0, 0, 20, 20))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # orientation: rotate 90 degrees clockwise to view
+        photo = BytesIO()
+        image.save(photo, "JPEG", exif=exif)
+        frame = AsyncVideoProcessor().decode_image(photo.getvalue())
+        self.assertEqual(frame.shape, (40, 20, 3))
+        # the left of the stored image is now on top
+        self.assertGreater(frame[5, 10, 0], 200)
+        self.assertGreater(frame[35, 10, 2], 200)
+
+
+class SelectFrameTest(unittest.TestCase):
+    def processor(self, **options) -> AsyncVideoProcessor:
+        options = {
+            "decoder": "ffmpeg",
+            "analysis_fps": 10,
+            "analysis_width": 32,
+            "analysis_height": 32,
+            "still_threshold": 0,
+            "motion_threshold": 0,
+            **options,
+        }
+        return AsyncVideoProcessor(**options)
+
+    def test_the_sharpest_frame_is_selected(self):
+        clip = render_clip(".mp4", blur_until=0.5)
+        selection = self.processor()._select_frame(clip, "video/mp4", None)
+        self.assertGreaterEqual(selection.index, 5)
+        self.assertEqual(selection.evaluated, 10)
+        self.assertEqual(selection.frame.shape, (48, 64, 3))
+        self.assertFalse(selection.timed_out or selection.keyframe)
+
+    def test_near_duplicates_are_counted(self):
+        clip = render_clip(".webm")
+        processor = self.processor(still_threshold=255)
+        selection = processor._select_frame(clip, "video/webm", None)
+        self.assertEqual((selection.evaluated, selection.skipped), (1, 9))
+
+    def test_keyframes_are_scored_first_under_a_deadline(self):
+        clip = render_clip(".mp4", blur_until=0.5)
+        processor = self.processor()
+        deadline = time.monotonic() + 60
+        selection = processor._select_frame(clip, "video/mp4", deadline)
+        # both keyframes, then every frame
+        self.assertEqual(selection.evaluated, 12)
+        self.assertFalse(selection.timed_out)
+
+    def test_selection_stops_at_the_deadline(self):
+        clip = render_clip(".mp4")
+        deadline = time.monotonic() - 1
+        selection = self.processor()._select_frame(clip, "video/mp4", deadline)
+        self.assertEqual(selection.evaluated, 1)
+        self.assertTrue(selection.timed_out and selection.keyframe)
+        self.assertEqual(selection.frame.shape, (48, 64, 3))
+
+    def test_cancelled_selection(self):
+        clip = render_clip(".webm")
+        cancelled = threading.Event()
+        cancelled.set()
+        with self.assertRaises(asyncio.CancelledError):
+            self.processor()._select_frame(clip, "video/webm", None, cancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
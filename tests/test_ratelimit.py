@@ -0,0 +1,138 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from ilens.server.ratelimit import (
+    MemoryBuckets,
+    RateLimiter,
+    client_address,
+    parse_networks,
+)
+
+
+class MemoryBucketsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.now = 0.0
+        patcher = mock.patch(
+            "ilens.server.ratelimit.time.monotonic", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buckets = MemoryBuckets()
+
+    async def test_burst_then_rate(self):
+        waits = [await self.buckets.take("a", 2, 3) for _ in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 0.5])
+        self.now = 0.5
+        self.assertEqual(await self.buckets.take("a", 2, 3), 0)
+        self.assertGreater(await self.buckets.take("a", 2, 3), 0)
+
+    async def test_buckets_refill_up_to_the_burst(self):
+        for _ in range(3):
+            await self.buckets.take("a", 1, 3)
+        self.now = 100
+        waits = [await self.buckets.take("a", 1, 3) for _ in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 1])
+
+    async def test_negative_counts_give_tokens_back(self):
+        await self.buckets.take("a", 1, 1)
+        self.assertEqual(await self.buckets.take("a", 1, 1, -1), 0)
+        self.assertEqual(await self.buckets.take("a", 1, 1), 0)
+        await self.buckets.take("b", 1, 1, -1)
+        self.assertEqual(self.buckets._buckets["b"][0], 1)
+
+    async def test_full_buckets_are_pruned(self):
+        buckets = MemoryBuckets(max_size=2)
+        await buckets.take("a", 1, 1)
+        self.now = 2
+        await buckets.take("b", 1, 1)
+        await buckets.take("c", 1, 1)
+        self.assertEqual(set(buckets._buckets), {"b", "c"})
+
+    async def test_forget(self):
+        await self.buckets.take("sid:a:detect", 1, 1)
+        await self.buckets.take("sid:b:detect", 1, 1)
+        self.buckets.forget("sid:a:")
+        self.assertEqual(set(self.buckets._buckets), {"sid:b:detect"})
+
+
+class ClientAddressTest(unittest.TestCase):
+    proxies = parse_networks(["10.0.0.1", "192.168.0.0/16"])
+
+    def test_forwarded_for_is_read_from_trusted_proxies(self):
+        self.assertEqual(
+            client_address("10.0.0.1", "1.1.1.1, 2.2.2.2", self.proxies), "2.2.2.2"
+        )
+        self.assertEqual(
+            client_address("192.168.1.5", "2.2.2.2, 10.0.0.1", self.proxies),
+            "2.2.2.2",
+        )
+
+    def test_forwarded_for_is_ignored_from_other_peers(self):
+        self.assertEqual(client_address("3.3.3.3", "2.2.2.2", self.proxies), "3.3.3.3")
+        self.assertEqual(client_address("3.3.3.3", "2.2.2.2", []), "3.3.3.3")
+
+    def test_falls_back_to_the_peer(self):
+        self.assertEqual(client_address("10.0.0.1", None, self.proxies), "10.0.0.1")
+        self.assertEqual(
+            client_address("10.0.0.1", "10.0.0.1, ", self.proxies), "10.0.0.1"
+        )
+        self.assertIsNone(client_address(None, "2.2.2.2", self.proxies))
+
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patcher = mock.patch("ilens.server.ratelimit.time.monotonic", return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def limiter(self) -> RateLimiter:
+        return RateLimiter(
+            {"detect": (1.0, 2.0)},
+            address_factor=1.0,
+            buckets=MemoryBuckets(),
+            proxies=["10.0.0.1"],
+        )
+
+    def environ(self, peer: str, forwarded: str = "") -> dict:
+        return {
+            "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_X_FORWARDED_FOR": forwarded,
+            "sanic.request": SimpleNamespace(ip=peer),
+        }
+
+    async def test_clients_are_limited_by_address(self):
+        limiter = self.limiter()
+        limiter.connect("a", self.environ("10.0.0.1", "2.2.2.2"))
+        limiter.connect("b", self.environ("10.0.0.1", "2.2.2.2"))
+        self.assertEqual(limiter._addresses, {"a": "2.2.2.2", "b": "2.2.2.2"})
+        self.assertIsNone(await limiter.check("a", "detect"))
+        self.assertIsNone(await limiter.check("a", "detect"))
+        limited = await limiter.check("b", "detect")
+        self.assertEqual(limited, {"event": "detect", "retry_after": 1.0})
+
+    async def test_address_rejections_do_not_spend_the_client_quota(self):
+        limiter = self.limiter()
+        limiter.connect("a", self.environ("3.3.3.3"))
+        limiter.connect("b", self.environ("3.3.3.3"))
+        await limiter.check("a", "detect")
+        await limiter.check("a", "detect")
+        for _ in range(3):
+            self.assertIsNotNone(await limiter.check("b", "detect"))
+        limiter.connect("b", self.environ("4.4.4.4"))
+        self.assertIsNone(await limiter.check("b", "detect"))
+        self.assertIsNone(await limiter.check("b", "detect"))
+
+    async def test_the_peer_is_used_without_a_request(self):
+        limiter = self.limiter()
+        limiter.connect("a", {"REMOTE_ADDR": "3.3.3.3"})
+        self.assertEqual(limiter._addresses["a"], "3.3.3.3")
+
+    async def test_unlimited_events(self):
+        limiter = self.limiter()
+        for _ in range(5):
+            self.assertIsNone(await limiter.check("a", "query"))
+
+
+if __name__ == "__main__":
+    unittest.main()
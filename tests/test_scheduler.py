@@ -0,0 +1,184 @@
+import asyncio
+import unittest
+from typing import Optional
+from unittest import mock
+
+from ilens.server.scheduler import (
+    PriorityLimiter,
+    QueueFull,
+    SessionScheduler,
+    current_priority,
+)
+
+
+class PriorityLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.now = 0.0
+        patcher = mock.patch(
+            "ilens.server.scheduler.time.monotonic", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = PriorityLimiter("test", slots=1, aging=1.0)
+        self.order: list[str] = []
+        self.release = asyncio.Event()
+        self.holder = asyncio.ensure_future(self.hold())
+        await asyncio.sleep(0)
+
+    async def hold(self):
+        async with self.limiter.slot(0):
+            await self.release.wait()
+
+    async def wait(self, name: str, priority: Optional[int]) -> "asyncio.Task[None]":
+        async def run():
+            async with self.limiter.slot(priority):
+                self.order.append(name)
+
+        task = asyncio.ensure_future(run())
+        await asyncio.sleep(0)
+        return task
+
+    async def finish(self, *tasks: "asyncio.Task[None]") -> None:
+        self.release.set()
+        await asyncio.gather(self.holder, *tasks, return_exceptions=True)
+
+    async def test_waiters_are_granted_by_priority(self):
+        tasks = [
+            await self.wait("low", 2),
+            await self.wait("high", 0),
+            await self.wait("normal", 1),
+            await self.wait("high again", 0),
+        ]
+        self.assertEqual(self.limiter.waiting, 4)
+        await self.finish(*tasks)
+        self.assertEqual(self.order, ["high", "high again", "normal", "low"])
+        self.assertEqual(self.limiter.in_use, 0)
+
+    async def test_waiting_work_is_promoted_with_age(self):
+        low = await self.wait("low", 2)
+        self.now = 2.5
+        high = await self.wait("high", 0)
+        await self.finish(low, high)
+        self.assertEqual(self.order, ["low", "high"])
+
+    async def test_cancelled_waiters_give_up_their_turn(self):
+        first = await self.wait("first", 0)
+        second = await self.wait("second", 1)
+        first.cancel()
+        await self.finish(first, second)
+        self.assertEqual(self.order, ["second"])
+        self.assertEqual(self.limiter.in_use, 0)
+
+    async def test_priority_defaults_to_the_current_event(self):
+        token = current_priority.set(2)
+        try:
+            low = await self.wait("low", None)
+        finally:
+            current_priority.reset(token)
+        high = await self.wait("high", 1)
+        await self.finish(low, high)
+        self.assertEqual(self.order, ["high", "low"])
+
+    async def test_queueing_delay_is_recorded_per_priority(self):
+        task = await self.wait("low", 2)
+        self.now = 3.0
+        await self.finish(task)
+        self.assertEqual(self.limiter.stats[0].granted, 1)
+        self.assertEqual(self.limiter.stats[2].max_delay, 3.0)
+
+
+class SessionSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.on_full = mock.AsyncMock()
+        self.scheduler = SessionScheduler(queue_size=1, on_full=self.on_full)
+        self.release = asyncio.Event()
+        self.started: list[str] = []
+        self.cancelled: list[str] = []
+
+    def pipeline(self, name: str):
+        async def run():
+            self.started.append(name)
+            try:
+                await self.release.wait()
+            except asyncio.CancelledError:
+                self.cancelled.append(name)
+                raise
+            return name
+
+        return run
+
+    async def start(self, run, *args) -> "asyncio.Task[Optional[str]]":
+        task = asyncio.ensure_future(run(*args))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return task
+
+    async def test_a_new_event_cancels_the_one_it_supersedes(self):
+        run = self.scheduler.run_latest
+        first = await self.start(run, "a", "detect", self.pipeline("first"))
+        other = await self.start(run, "b", "detect", self.pipeline("other"))
+        second = await self.start(run, "a", "detect", self.pipeline("second"))
+        self.release.set()
+        self.assertEqual(
+            await asyncio.gather(first, other, second), [None, "other", "second"]
+        )
+        self.assertEqual(self.cancelled, ["first"])
+        self.assertFalse(self.scheduler._latest or self.scheduler._tasks)
+
+    async def test_queued_events_run_one_at_a_time(self):
+        run = self.scheduler.run_queued
+        first = await self.start(run, "a", "query", self.pipeline("first"))
+        second = await self.start(run, "a", "query", self.pipeline("second"))
+        other = await self.start(run, "b", "query", self.pipeline("other"))
+        self.assertEqual(self.started, ["first", "other"])
+        with self.assertRaises(QueueFull):
+            await run("a", "query", self.pipeline("third"))
+        self.release.set()
+        self.assertEqual(
+            await asyncio.gather(first, second, other), ["first", "second", "other"]
+        )
+        self.assertFalse(self.scheduler._lanes or self.scheduler._tasks)
+
+    async def test_rejected_events_are_reported(self):
+        handler = self.scheduler.queued("query")(
+            lambda sid, name: self.pipeline(name)()
+        )
+        running = await self.start(handler, "a", "first")
+        waiting = await self.start(handler, "a", "second")
+        self.assertIsNone(await handler("a", "third"))
+        self.on_full.assert_awaited_once_with("a", "query")
+        self.release.set()
+        self.assertEqual(await asyncio.gather(running, waiting), ["first", "second"])
+
+    async def test_disconnecting_cancels_the_clients_pipelines(self):
+        latest = await self.start(
+            self.scheduler.run_latest, "a", "detect", self.pipeline("detect")
+        )
+        running = await self.start(
+            self.scheduler.run_queued, "a", "query", self.pipeline("running")
+        )
+        waiting = await self.start(
+            self.scheduler.run_queued, "a", "query", self.pipeline("waiting")
+        )
+        self.scheduler.cancel("a")
+        self.assertEqual(
+            await asyncio.gather(latest, running, waiting), [None, None, None]
+        )
+        self.assertEqual(sorted(self.cancelled), ["detect", "running"])
+        self.assertNotIn("waiting", self.started)
+        self.assertFalse(
+            self.scheduler._latest or self.scheduler._lanes or self.scheduler._tasks
+        )
+
+    async def test_pipelines_run_at_their_event_priority(self):
+        self.scheduler.priorities = {"query": 2}
+
+        async def priority():
+            return current_priority.get()
+
+        self.assertEqual(await self.scheduler.spawn("query", priority), 2)
+        self.assertEqual(await self.scheduler.spawn("detect", priority), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
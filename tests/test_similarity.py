@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ilens.server.similarity import (
+    SimilarityCache,
+    SimilarityIndex,
+    dhash,
+    hamming,
+)
+
+
+def gradient(width: int = 64, height: int = 48) -> np.ndarray:
+    """Returns an RGB frame with some structure to hash."""
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:, None]
+    gray = (np.sin(x / 20) * 60 + np.cos(y / 15) * 60 + 128).astype(np.uint8)
+    return np.dstack([gray, gray, gray])
+
+
+class DhashTest(unittest.TestCase):
+    def test_identical_frames_hash_equal(self):
+        self.assertEqual(dhash(gradient()), dhash(gradient()))
+
+    def test_noise_moves_the_hash_a_few_bits(self):
+        frame = gradient()
+        noise = np.random.default_rng(0).integers(-3, 4, frame.shape)
+        noisy = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        self.assertLessEqual(hamming(dhash(frame), dhash(noisy)), 4)
+
+    def test_different_frames_hash_far_apart(self):
+        self.assertGreater(hamming(dhash(gradient()), dhash(gradient()[:, ::-1])), 16)
+
+    def test_grayscale_frames(self):
+        frame = gradient()
+        self.assertEqual(dhash(frame[:, :, 0]), dhash(frame))
+
+
+class SimilarityIndexTest(unittest.TestCase):
+    def test_search_returns_the_closest_entry_within_threshold(self):
+        index: SimilarityIndex[str] = SimilarityIndex(ttl=60)
+        index.add(0b0000, "zero")
+        index.add(0b0111, "three")
+        index.add(0b1111, "four")
+        self.assertEqual(index.search(0b0001, 2), "zero")
+        self.assertEqual(index.search(0b1110, 1), "four")
+        self.assertIsNone(index.search(0b1111 << 8, 2))
+
+    def test_search_matches_a_linear_scan(self):
+        rng = np.random.default_rng(1)
+        hashes = [int(h) for h in rng.integers(0, 2**16, 200)]
+        index: SimilarityIndex[int] = SimilarityIndex(ttl=60)
+        for h in hashes:
+            index.add(h, h)
+        for query in (int(q) for q in rng.integers(0, 2**16, 50)):
+            found = index.search(query, 3)
+            best = min(hashes, key=lambda h: hamming(h, query))
+            if hamming(best, query) > 3:
+                self.assertIsNone(found)
+            else:
+                self.assertIsNotNone(found)
+                self.assertEqual(hamming(found, query), hamming(best, query))
+
+    def test_expired_entries_are_skipped(self):
+        index: SimilarityIndex[str] = SimilarityIndex(ttl=10)
+        with mock.patch("ilens.server.similarity.time.monotonic", return_value=0):
+            index.add(0, "old")
+        with mock.patch("ilens.server.similarity.time.monotonic", return_value=11):
+            self.assertIsNone(index.search(0, 0))
+
+    def test_rebuild_keeps_the_newest_entries(self):
+        index: SimilarityIndex[int] = SimilarityIndex(ttl=60, max_size=4)
+        for i in range(5):
+            with mock.patch("ilens.server.similarity.time.monotonic", return_value=i):
+                index.add(1 << i, i)
+        self.assertEqual(len(index), 3)
+        with mock.patch("ilens.server.similarity.time.monotonic", return_value=5):
+            self.assertIsNone(index.search(1 << 0, 0))
+            self.assertEqual(index.search(1 << 4, 0), 4)
+            self.assertEqual(index.search(1 << 3, 0), 3)
+
+
+class SimilarityCacheTest(unittest.TestCase):
+    def test_results_are_shared_between_sessions(self):
+        cache = SimilarityCache(ttl=60, thresholds={"detect": 2})
+        cache.store("a", "detect", 0b1000, "chair")
+        self.assertEqual(cache.lookup("a", "detect", 0b1001), "chair")
+        self.assertEqual(cache.lookup("b", "detect", 0b1001), "chair")
+        self.assertIsNone(cache.lookup("b", "detect", 0b0111))
+
+    def test_events_without_a_threshold_are_not_cached(self):
+        cache = SimilarityCache(ttl=60, thresholds={"detect": -1})
+        cache.store("a", "detect", 0, "chair")
+        cache.store("a", "recognize", 0, "tree")
+        self.assertIsNone(cache.lookup("a", "detect", 0))
+        self.assertIsNone(cache.lookup("a", "recognize", 0))
+
+    def test_forget_drops_the_session_index_only(self):
+        cache = SimilarityCache(ttl=60, thresholds={"detect": 0})
+        cache.store("a", "detect", 0, "chair")
+        cache.forget("a")
+        self.assertNotIn(("a", "detect"), cache._indexes)
+        self.assertEqual(cache.lookup("a", "detect", 0), "chair")
+
+
+if __name__ == "__main__":
+    unittest.main()
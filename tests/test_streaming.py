@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from typing import Optional
+
+from ilens.server.streaming import ChunkEmitter
+
+
+class FakeServer:
+    """Records emitted packets and reports a queue of `queued` packets."""
+
+    def __init__(self, queued: Optional[list[int]] = None):
+        self.emitted: list[tuple] = []
+        self.ignored_queue: list[bool] = []
+        self.queued = queued
+        self.manager = SimpleNamespace(eio_sid_from_sid=lambda sid, namespace: sid)
+        self.eio = SimpleNamespace(sockets=self)
+
+    def __contains__(self, eio_sid) -> bool:
+        return self.queued is not None
+
+    def get(self, eio_sid):
+        if self.queued is None:
+            return None
+        size = self.queued.pop(0) if len(self.queued) > 1 else self.queued[0]
+        return SimpleNamespace(queue=SimpleNamespace(qsize=lambda: size))
+
+    async def emit(self, event, data, to, namespace, ignore_queue=False):
+        self.emitted.append(data)
+        self.ignored_queue.append(ignore_queue)
+
+
+def emitter(server: FakeServer, **options) -> ChunkEmitter:
+    options = {
+        "chunk_size": 4,
+        "min_chunk_size": 2,
+        "max_chunk_size": 16,
+        "high_watermark": 8,
+        "drain_timeout": 1.0,
+        **options,
+    }
+    return ChunkEmitter(server, **options)  # type: ignore[arg-type]
+
+
+async def pieces(*data: bytes):
+    for piece in data:
+        await asyncio.sleep(0)
+        yield piece
+
+
+class ChunkEmitterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_chunks_are_numbered_and_end_empty(self):
+        server = FakeServer()
+        count = await emitter(server).emit("audio-chunk", "a", b"0123456789")
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            server.emitted, [(b"0123", 0), (b"4567", 1), (b"89", 2), (b"", 3)]
+        )
+        self.assertTrue(all(type(data) is bytes for data, _ in server.emitted))
+
+    async def test_chunks_carry_the_mimetype(self):
+        server = FakeServer()
+        await emitter(server).emit("audio-chunk", "a", b"012345", mimetype="audio/ogg")
+        self.assertEqual(
+            server.emitted,
+            [(b"0123", 0, "audio/ogg"), (b"45", 1, "audio/ogg"), (b"", 2, "audio/ogg")],
+        )
+
+    async def test_only_remote_clients_are_published(self):
+        local = FakeServer(queued=[0])
+        await emitter(local).emit("audio-chunk", "a", b"0123")
+        self.assertEqual(local.ignored_queue, [True, True])
+        remote = FakeServer()
+        await emitter(remote).emit("audio-chunk", "a", b"0123")
+        self.assertEqual(remote.ignored_queue, [False, False])
+
+    async def test_produced_pieces_are_regrouped_into_chunks(self):
+        server = FakeServer()
+        await emitter(server).emit("audio-chunk", "a", pieces(b"01", b"2345", b"6"))
+        self.assertEqual(server.emitted, [(b"0123", 0), (b"456", 1), (b"", 2)])
+
+    async def test_chunks_grow_while_the_queue_is_empty(self):
+        server = FakeServer(queued=[0])
+        await emitter(server).emit("audio-chunk", "a", bytes(range(28)))
+        sizes = [len(data) for data, _ in server.emitted]
+        self.assertEqual(sizes, [4, 8, 16, 0])
+
+    async def test_chunks_shrink_while_the_queue_is_full(self):
+        server = FakeServer(queued=[9, 0, 9, 0, 5])
+        await emitter(server).emit("audio-chunk", "a", bytes(range(9)))
+        sizes = [len(data) for data, _ in server.emitted]
+        self.assertEqual(sizes, [4, 2, 2, 1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
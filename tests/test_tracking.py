@@ -0,0 +1,122 @@
+import unittest
+from unittest import mock
+
+from ilens.server.clarifai.image_processing import LocationInfo, ObstacleInfo
+from ilens.server.tracking import AdaptiveSampler, ObstacleTracker, iou
+
+
+def box(left: float, top: float, right: float, bottom: float) -> LocationInfo:
+    return {"left": left, "top": top, "right": right, "bottom": bottom}
+
+
+def obstacle(
+    name: str,
+    left: float = 0.0,
+    position: str = "center",
+    distance: str = "near",
+    width: float = 0.2,
+) -> ObstacleInfo:
+    return {
+        "name": name,
+        "position": position,
+        "distance": distance,
+        "depth": 0.5,
+        "value": 0.9,
+        "location": box(left, 0.2, left + width, 0.6),
+    }
+
+
+class IouTest(unittest.TestCase):
+    def test_overlaps(self):
+        self.assertEqual(iou(box(0, 0, 1, 1), box(0, 0, 1, 1)), 1.0)
+        self.assertAlmostEqual(iou(box(0, 0, 2, 1), box(1, 0, 3, 1)), 1 / 3)
+        self.assertEqual(iou(box(0, 0, 1, 1), box(1, 0, 2, 1)), 0.0)
+        self.assertEqual(iou(box(0, 0, 1, 1), box(2, 2, 3, 3)), 0.0)
+
+
+class ObstacleTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = ObstacleTracker(min_iou=0.3, max_misses=1)
+
+    def test_moving_within_a_position_is_not_a_change(self):
+        self.assertTrue(self.tracker.update([obstacle("chair", 0.40)]))
+        track = self.tracker.tracks[0]
+        self.assertFalse(self.tracker.update([obstacle("chair", 0.42)]))
+        self.assertIs(self.tracker.tracks[0], track)
+        self.assertEqual(track.obstacle["location"]["left"], 0.42)
+
+    def test_position_and_distance_changes(self):
+        self.tracker.update([obstacle("chair", 0.4)])
+        self.assertTrue(self.tracker.update([obstacle("chair", 0.4, position="left")]))
+        self.assertTrue(
+            self.tracker.update(
+                [obstacle("chair", 0.4, position="left", distance="far")]
+            )
+        )
+
+    def test_obstacles_are_kept_through_missed_detections(self):
+        self.tracker.update([obstacle("chair", 0.4)])
+        self.assertFalse(self.tracker.update([]))
+        self.assertEqual(self.tracker.tracks[0].misses, 1)
+        self.assertFalse(self.tracker.update([obstacle("chair", 0.4)]))
+        self.assertEqual(self.tracker.tracks[0].misses, 0)
+        self.tracker.update([])
+        self.assertTrue(self.tracker.update([]))
+        self.assertEqual(self.tracker.obstacles(), [])
+
+    def test_boxes_are_matched_by_name_and_best_overlap(self):
+        self.tracker.update([obstacle("chair", 0.0), obstacle("chair", 0.5)])
+        first, second = self.tracker.tracks
+        self.tracker.update([obstacle("chair", 0.52), obstacle("chair", 0.02)])
+        self.assertEqual(first.obstacle["location"]["left"], 0.02)
+        self.assertEqual(second.obstacle["location"]["left"], 0.52)
+        self.assertTrue(self.tracker.update([obstacle("table", 0.02)]))
+        self.assertEqual(
+            [track.obstacle["name"] for track in self.tracker.tracks],
+            ["chair", "chair", "table"],
+        )
+
+    def test_distant_boxes_start_new_tracks(self):
+        self.tracker.update([obstacle("chair", 0.0)])
+        self.tracker.update([obstacle("chair", 0.6)])
+        self.assertEqual([track.id for track in self.tracker.tracks], [0, 1])
+
+
+class AdaptiveSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch(
+            "ilens.server.tracking.time.monotonic", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sampler = AdaptiveSampler(
+            min_interval=0.2, max_interval=1.0, refresh=5.0, threshold=4, backoff=2.0
+        )
+
+    def test_changes_are_detected_at_the_fastest_rate(self):
+        self.assertTrue(self.sampler.due(0))
+        self.sampler.detected(0)
+        self.assertTrue(self.sampler.due(0b11111))
+        self.assertEqual(self.sampler.interval, 0.2)
+
+    def test_still_scenes_back_off_and_refresh(self):
+        self.sampler.due(0)
+        self.sampler.detected(0)
+        intervals = []
+        for _ in range(4):
+            self.assertFalse(self.sampler.due(0b1))
+            intervals.append(self.sampler.interval)
+        self.assertEqual(intervals, [0.4, 0.8, 1.0, 1.0])
+        self.now = 5.0
+        self.assertTrue(self.sampler.due(0b1))
+
+    def test_load_lengthens_the_interval(self):
+        self.assertEqual(self.sampler.next_interval(0.0), 0.2)
+        self.assertEqual(self.sampler.next_interval(1.0), 0.4)
+        self.assertEqual(self.sampler.next_interval(10.0), 1.0)
+        self.assertEqual(self.sampler.next_interval(-1.0), 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
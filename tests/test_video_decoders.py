@@ -0,0 +1,238 @@
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+import numpy as np
+
+from ilens.server.clarifai.video_decoders import (
+    ClipStream,
+    DecoderRegistry,
+    FFmpegPipeDecoder,
+    _read_into,
+    _read_pgm_header,
+    get_ffmpeg_exe,
+    sniff_container,
+)
+
+CODECS = {
+    ".mp4": ["-c:v", "mpeg4"],
+    ".webm": ["-c:v", "libvpx"],
+}
+
+
+def find_ffmpeg() -> Optional[str]:
+    try:
+        return get_ffmpeg_exe()
+    except RuntimeError:
+        return None
+
+
+FFMPEG = find_ffmpeg()
+
+
+def render_clip(extension: str, duration: float = 1.0, blur_until: float = 0) -> bytes:
+    """
+    Renders a 64x48 test pattern at 10 fps, with a keyframe every 5
+    frames, blurred until `blur_until` seconds.
+    """
+    if FFMPEG is None:
+        raise unittest.SkipTest("ffmpeg is not available")
+    source = f"testsrc2=size=64x48:rate=10:duration={duration}"
+    blur = f"gblur=sigma=4:enable='lt(t,{blur_until})'"
+    with tempfile.NamedTemporaryFile(suffix=extension) as output:
+        try:
+            subprocess.run(
+                [
+                    FFMPEG,
+                    "-hide_banner",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    source,
+                    "-vf",
+                    blur,
+                    *CODECS[extension],
+                    "-g",
+                    "5",
+                    output.name,
+                ],
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise unittest.SkipTest(f"ffmpeg cannot encode {extension}: {e.stderr}")
+        return Path(output.name).read_bytes()
+
+
+class SniffContainerTest(unittest.TestCase):
+    def test_containers(self):
+        heads = {
+            b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01webm": ".webm",
+            b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01matroska": ".mkv",
+            b"\x00\x00\x00\x18ftypisom": ".mp4",
+            b"\x00\x00\x00\x14ftypqt  ": ".mov",
+            b"\x00\x00\x00\x18ftyp3gp4": ".3gp",
+            b"\x00\x00\x00\x18ftypM4V ": ".m4v",
+            b"\x00\x00\x00\x08wide": ".mov",
+            b"OggS\x00\x02": ".ogg",
+            b"RIFF\x00\x00\x00\x00AVI LIST": ".avi",
+            b"FLV\x01": ".flv",
+            b"\x00\x00\x01\xba\x44": ".mpeg",
+            b"\x47" + bytes(187) + b"\x47": ".ts",
+        }
+        for head, extension in heads.items():
+            self.assertEqual(sniff_container(head), extension, head[:12])
+
+    def test_unknown_containers(self):
+        self.assertIsNone(sniff_container(b""))
+        self.assertIsNone(sniff_container(b"\xff\xd8\xff\xe0 not a video"))
+
+
+class PgmReaderTest(unittest.TestCase):
+    def test_frames_are_read_into_the_buffer(self):
+        stream = BytesIO(b"P5\n3 2\n255\n" + bytes(range(6)) + b"P5\n3 2\n255\n")
+        self.assertEqual(_read_pgm_header(stream), (3, 2))
+        buffer = np.empty((2, 3), dtype=np.uint8)
+        self.assertTrue(_read_into(stream, buffer))
+        np.testing.assert_array_equal(buffer, [[0, 1, 2], [3, 4, 5]])
+        # the second frame was cut short
+        self.assertEqual(_read_pgm_header(stream), (3, 2))
+        self.assertFalse(_read_into(stream, buffer))
+        self.assertIsNone(_read_pgm_header(stream))
+
+    def test_unexpected_output(self):
+        with self.assertRaises(RuntimeError):
+            _read_pgm_header(BytesIO(b"P6\n3 2\n255\n"))
+
+
+class ClipStreamTest(unittest.TestCase):
+    def test_chunks_end_with_the_clip(self):
+        stream = ClipStream(timeout=1.0)
+        stream.write(b"ab")
+        stream.write(b"c")
+        stream.close()
+        self.assertEqual(list(stream.chunks()), [b"ab", b"c"])
+        self.assertFalse(stream.truncated)
+        self.assertEqual(stream.getvalue(), b"abc")
+
+    def test_a_stalled_upload_is_cut_at_the_deadline(self):
+        stream = ClipStream(timeout=5.0)
+        stream.write(b"ab")
+        started = time.monotonic()
+        chunks = list(stream.chunks(deadline=started + 0.2))
+        self.assertEqual(chunks, [b"ab"])
+        self.assertTrue(stream.truncated)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_a_stalled_upload_is_cut_at_the_chunk_timeout(self):
+        stream = ClipStream(timeout=0.2)
+        stream.write(b"ab")
+        self.assertEqual(list(stream.chunks()), [b"ab"])
+        self.assertTrue(stream.truncated)
+
+    def test_waits_stop_once_cancelled(self):
+        stream = ClipStream(timeout=5.0)
+        cancelled = threading.Event()
+        threading.Timer(0.1, cancelled.set).start()
+        started = time.monotonic()
+        self.assertEqual(stream.peek(4, cancelled=cancelled), b"")
+        self.assertEqual(list(stream.chunks(cancelled=cancelled)), [])
+        self.assertTrue(stream.truncated)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+class FFmpegPipeDecoderTest(unittest.TestCase):
+    def gray_frames(self, source, extension: str, **options) -> list[np.ndarray]:
+        frames = FFmpegPipeDecoder().iter_gray_frames(
+            source, extension, 5, 32, 32, **options
+        )
+        return [frame.copy() for _, frame in frames]
+
+    def test_frames_are_sampled_and_scaled(self):
+        for extension in (".mp4", ".webm"):
+            frames = self.gray_frames(render_clip(extension), extension)
+            self.assertEqual(len(frames), 5, extension)
+            # scaled to fit, keeping the aspect ratio
+            self.assertEqual({frame.shape for frame in frames}, {(24, 32)})
+
+    def test_keyframes(self):
+        clip = render_clip(".mp4")
+        frames = self.gray_frames(clip, ".mp4", keyframes=True)
+        self.assertEqual(len(frames), 2)
+        frame = FFmpegPipeDecoder().read_frame(clip, ".mp4", 1, None, keyframes=True)
+        self.assertEqual(frame.shape, (48, 64, 3))
+
+    def test_clip_streams_are_decoded_while_they_arrive(self):
+        clip = render_clip(".webm")
+        stream = ClipStream(timeout=5.0)
+
+        def upload():
+            for start in range(0, len(clip), 1024):
+                stream.write(clip[start : start + 1024])
+                time.sleep(0.01)
+            stream.close()
+
+        threading.Thread(target=upload).start()
+        self.assertEqual(len(self.gray_frames(stream, ".webm")), 5)
+        self.assertFalse(stream.truncated)
+
+    def test_read_frame_decodes_in_colour(self):
+        clip = render_clip(".webm")
+        frame = FFmpegPipeDecoder().read_frame(clip, ".webm", 2, 5)
+        self.assertEqual((frame.shape, frame.dtype), ((48, 64, 3), np.uint8))
+        with self.assertRaises(RuntimeError):
+            FFmpegPipeDecoder().read_frame(clip, ".webm", 50, 5)
+
+    def test_a_cancelled_spill_is_not_decoded(self):
+        decoder = FFmpegPipeDecoder()
+        stream = ClipStream(timeout=5.0)
+        stream.write(b"\x00\x00\x00\x18ftypmp42")
+        cancelled = threading.Event()
+        threading.Timer(0.1, cancelled.set).start()
+        with mock.patch.object(decoder, "_popen") as popen:
+            frames = decoder.iter_gray_frames(
+                stream, ".mp4", 10, 32, 32, cancelled=cancelled
+            )
+            self.assertEqual(list(frames), [])
+        popen.assert_not_called()
+
+
+class DecoderRegistryTest(unittest.TestCase):
+    def registry(self, **available: bool) -> DecoderRegistry:
+        registry = DecoderRegistry()
+        registry._available = {"ffmpeg": False, "pyav": False, "imageio": False}
+        registry._available.update(available)
+        return registry
+
+    def test_decoders_are_chosen_by_preference(self):
+        registry = self.registry(ffmpeg=True, pyav=True, imageio=True)
+        self.assertEqual(registry.choose(".webm"), "ffmpeg")
+        self.assertEqual(registry.choose(".webm", "imageio"), "imageio")
+
+    def test_unsupported_or_missing_decoders_fall_back(self):
+        registry = self.registry(ffmpeg=True, imageio=True)
+        self.assertEqual(registry.choose(".webm", "pyav"), "ffmpeg")
+        self.assertEqual(registry.choose(".ogg", "imageio"), "ffmpeg")
+        registry = self.registry(imageio=True)
+        self.assertEqual(registry.choose(".mp4"), "imageio")
+        with self.assertRaises(ValueError):
+            registry.choose(".ogg")
+
+    def test_choices_are_cached(self):
+        registry = self.registry(ffmpeg=True)
+        self.assertEqual(registry.choose(".mp4"), "ffmpeg")
+        registry._available["ffmpeg"] = False
+        self.assertEqual(registry.choose(".mp4"), "ffmpeg")
+
+
+if __name__ == "__main__":
+    unittest.main()